@@ -1,8 +1,14 @@
 import asyncio
 import logging
 from config import load_app_config, load_package_info
+from integrations.apt import AptProvider
 from integrations.docker import DockerProvider
+from executor import UpdateExecutor
+from metrics import REGISTRY, MetricsServer
 from mqtt import MqttClient
+from scheduler import ScanScheduler
+from state_store import StateStore, store_source_type
+from integrations.registry_cache import RegistryDigestCache
 import uuid
 import structlog
 import time
@@ -12,10 +18,11 @@ log = structlog.get_logger()
 CONF_FILE = "conf/config.yaml"
 PKG_INFO_FILE = "common_packages.yaml"
 UPDATE_INTERVAL = 60 * 60 * 4
+# longest startup waits for the broker before publishing the saved snapshot anyway
+CONNECT_WAIT = 30
 
 # #TODO
 # Set install in progress
-# Support apt
 # Retry on registry fetch fail
 # Fetcher in subproc or thread
 # Clear command message after install
@@ -25,7 +32,7 @@ UPDATE_INTERVAL = 60 * 60 * 4
 class App:
     def __init__(self):
         self.cfg = load_app_config(CONF_FILE)
-        self.common_pkg = load_package_info(PKG_INFO_FILE)
+        self.pkg_index = load_package_info(PKG_INFO_FILE)
         structlog.configure(
             wrapper_class=structlog.make_filtering_bound_logger(
                 logging.getLevelName(self.cfg.log.level)
@@ -33,12 +40,54 @@ class App:
         )
 
         self.publisher = MqttClient(
-            self.cfg.mqtt, self.cfg.node, self.cfg.homeassistant
+            self.cfg.mqtt,
+            self.cfg.node,
+            self.cfg.homeassistant,
+            # item access, as `update` is also a DictConfig method
+            executor=UpdateExecutor(self.cfg["update"].workers),
+        )
+
+        self.store = StateStore(self.cfg.state_path) if self.cfg.state_path else None
+        if self.store:
+            self.publisher.state_listener = self.store.save
+
+        self.scheduler = (
+            ScanScheduler(self.cfg.schedule, self.cfg.scan_interval)
+            if self.cfg.schedule.enabled
+            else None
         )
 
         self.scanners = []
+        self.watchers = []
+        self.ready = asyncio.Event()
         if self.cfg.docker.enabled:
-            self.scanners.append(DockerProvider(self.cfg.docker, self.common_pkg))
+            registry_cache = RegistryDigestCache(
+                ttl=self.cfg.docker.registry_cache_ttl,
+                max_size=self.cfg.docker.registry_cache_size,
+                path=self.cfg.docker.registry_cache_path,
+            )
+            host_urls = {}
+            for host in self.cfg.docker.hosts or [None]:
+                provider = DockerProvider(
+                    self.cfg.docker,
+                    self.pkg_index,
+                    host=host,
+                    registry_cache=registry_cache,
+                )
+                # entities, topics and saved state are all keyed by node name
+                node_name = provider.node_name or self.cfg.node.name
+                if node_name in host_urls:
+                    raise ValueError(
+                        "Docker hosts %s and %s would both publish as node %s, set `node` for each"
+                        % (host_urls[node_name], host and host.url, node_name)
+                    )
+                host_urls[node_name] = host and host.url
+                self.scanners.append(provider)
+        if self.cfg.apt.enabled:
+            self.scanners.append(AptProvider(self.cfg.apt))
+        if self.scheduler:
+            for scanner in self.scanners:
+                scanner.is_due = self.scheduler.is_due
         log.info(
             "App configured",
             node=self.cfg.node.name,
@@ -46,38 +95,157 @@ class App:
         )
 
     async def scan(self):
-        for scanner in self.scanners:
-            log.info("Starting scan", source_type=scanner.source_type)
-            session = uuid.uuid4().hex
-            log.info("Scanning", source=scanner.source_type, session=session)
-            async for discovery in scanner.scan(session):
-                async with asyncio.TaskGroup() as tg:
-                    tg.create_task(self.on_discovery(discovery))
-            await self.publisher.clean_topics(scanner, session)
+        """Scan all providers concurrently, publishing discoveries as they arrive"""
+        discoveries = asyncio.Queue(maxsize=self.cfg.scan_queue_size)
+        consumer = asyncio.create_task(self.consume(discoveries))
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(
+                *(self.scan_provider(scanner, discoveries) for scanner in self.scanners)
+            )
+            # failed scans skip waiting on the queue, so publish what they left there
+            try:
+                async with asyncio.timeout(self.cfg.scan_timeout):
+                    await discoveries.join()
+            except TimeoutError:
+                log.warn("Discoveries left unpublished", count=discoveries.qsize())
+        finally:
+            consumer.cancel()
+        REGISTRY.observe("scan_seconds", time.perf_counter() - started)
+        summary = REGISTRY.summary()
+        summary["scan_seconds"] = summary.get("scan_seconds_last")
+        self.publisher.publish_diagnostics(summary)
 
-            log.info("Scan complete", source_type=scanner.source_type)
+    async def scan_provider(self, scanner, discoveries: asyncio.Queue):
+        session = uuid.uuid4().hex
+        slog = log.bind(
+            source_type=scanner.source_type,
+            node=getattr(scanner, "node_name", None),
+            session=session,
+        )
+        slog.info("Scanning")
+        started = time.perf_counter()
+        try:
+            async with asyncio.timeout(self.cfg.scan_timeout):
+                async for discovery in scanner.scan(session):
+                    await discoveries.put(discovery)
+                # topics must be republished with the new session before stale ones are cleaned
+                await discoveries.join()
+        except TimeoutError:
+            slog.warn("Scan timed out, skipping clean", timeout=self.cfg.scan_timeout)
+            return
+        except Exception as e:
+            slog.error("Scan failed, skipping clean: %s", e, exc_info=1)
+            return
+        REGISTRY.observe(
+            "provider_scan_seconds",
+            time.perf_counter() - started,
+            source_type=scanner.source_type,
+            node=getattr(scanner, "node_name", None) or self.cfg.node.name,
+        )
+        await self.publisher.clean_topics(scanner, session)
+        if self.store:
+            self.store.prune(store_source_type(scanner), session)
+        slog.info("Scan complete")
+
+    async def consume(self, discoveries: asyncio.Queue):
+        while True:
+            discovery = await discoveries.get()
+            try:
+                await self.on_discovery(discovery)
+            except Exception as e:
+                log.error("Discovery handling failed: %s", e, name=discovery.name, exc_info=1)
+            finally:
+                discoveries.task_done()
 
     async def run(self):
+        """Serve commands and the saved snapshot as soon as the broker is up, then scan
+
+        Providers connect to their daemons lazily, so the first scan, not startup,
+        waits on them
+        """
+        started = time.perf_counter()
+        if self.cfg.metrics.enabled:
+            MetricsServer(self.cfg.metrics.host, self.cfg.metrics.port).start()
+        self.publisher.connect_listener = self.on_connected
         self.publisher.start()
         for scanner in self.scanners:
             self.publisher.subscribe_hass_command(scanner)
+        if not await self.publisher.wait_connected(CONNECT_WAIT):
+            log.warn("Broker not connected yet, publishing saved state once it is", wait=CONNECT_WAIT)
+        log.info("Ready", startup_seconds=round(time.perf_counter() - started, 3))
+        self.ready.set()
+        for scanner in self.scanners:
+            self.watchers.append(asyncio.create_task(self.watch(scanner)))
+        await self.scan_loop()
+
+    async def scan_loop(self):
         while True:
             await self.scan()
-            await asyncio.sleep(self.cfg.scan_interval)
+            next_scan = time.time() + self.cfg.scan_interval
+            while time.time() < next_scan:
+                if self.scheduler is None:
+                    await asyncio.sleep(next_scan - time.time())
+                else:
+                    await asyncio.sleep(min(self.cfg.schedule.tick, next_scan - time.time()))
+                    await self.check_due()
+
+    async def check_due(self):
+        """Rescan discoveries whose scheduled check time has come, between full scans"""
+        loop = asyncio.get_running_loop()
+        for discovery in self.scheduler.due():
+            try:
+                result = await loop.run_in_executor(
+                    None, discovery.provider.rescan, discovery, True
+                )
+            except Exception as e:
+                log.warn("Scheduled rescan failed: %s", e, name=discovery.name)
+                result = None
+            if result:
+                await self.on_discovery(result)
+            else:
+                self.scheduler.forget(discovery)
+
+    def on_connected(self):
+        """Publish buttons and the saved snapshot on each connect, as the broker may
+        have lost them, and publishes made while disconnected are dropped
+        """
+        for scanner in self.scanners:
+            if self.cfg.homeassistant.discovery.enabled and scanner.supports_install_all:
+                self.publisher.publish_hass_install_all(scanner)
+        self.restore()
+
+    def restore(self):
+        """Publish discoveries saved by the previous run, ahead of the first scan"""
+        if not self.store:
+            return
+        for scanner in self.scanners:
+            restored = scanner.restore(self.store.load(store_source_type(scanner)))
+            for discovery in restored:
+                if self.cfg.homeassistant.discovery.enabled:
+                    self.publisher.publish_hass_config(discovery)
+                self.publisher.publish_hass_state(discovery)
+            log.info("Restored state", source_type=scanner.source_type, count=len(restored))
+
+    async def watch(self, scanner):
+        try:
+            async for discovery in scanner.watch():
+                log.info("Change detected", source_type=scanner.source_type, name=discovery.name)
+                await self.on_discovery(discovery)
+        except Exception as e:
+            log.error("Watch failed: %s", e, source_type=scanner.source_type, exc_info=1)
 
     async def on_discovery(self, discovery):
         dlog = log.bind(name=discovery.name)
+        if self.scheduler:
+            self.scheduler.record(discovery)
         if self.cfg.homeassistant.discovery.enabled:
             self.publisher.publish_hass_config(discovery)
 
         self.publisher.publish_hass_state(discovery)
+        await self.publisher.drain()
         if discovery.update_policy == "Auto":
-            try:
-                last_update = time.mktime(
-                    time.strptime(discovery.update_last_attempt, "%Y-%m-%dT%H:%M:%S.%f")
-                )
-            except Exception:
-                last_update = None
+            last_update = discovery.update_last_attempt
             if last_update is None or time.time() - last_update > UPDATE_INTERVAL:
                 dlog.info("Initiate auto update")
                 self.publisher.local_message(discovery, "install")
@@ -0,0 +1,761 @@
+"""Benchmarks for scanning and publishing, against stand-in docker daemon and MQTT broker
+
+Run from the repo root, results are written as JSON for tracking across changes:
+
+    python benchmark.py --sizes 10 100 1000 --output bench.json
+
+Docker API and registry calls are simulated with sleeps, so wall time reflects the
+configured latencies, and CPU time is for the whole process, including the broker thread.
+"""
+
+import argparse
+import asyncio
+from contextlib import contextmanager
+from dataclasses import replace
+import datetime
+import functools
+import gc
+import hashlib
+import json
+import os
+import os.path
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from unittest import mock
+import docker
+import structlog
+import app
+from config import AptConfig, DockerConfig, HomeAssistantConfig, MqttConfig, NodeConfig, PackageIndex
+from integrations.apt import AptProvider
+from integrations.docker import DockerProvider
+from metrics import REGISTRY
+from model import ReleaseProvider
+from mqtt import MqttClient
+import serializer
+
+BENCHMARKS = (
+    "provider_scan",
+    "analyze",
+    "publish_hass",
+    "clean_topics",
+    "app_scan",
+    "app_startup",
+    "apt_scan",
+)
+
+
+class FakeImage:
+    def __init__(self, ref: str, digest: str):
+        self.id = "sha256:%s" % digest
+        self.tags = [ref]
+        self.attrs = {
+            "RepoDigests": ["%s@sha256:%s" % (ref.split(":")[0], digest)],
+            "Os": "linux",
+            "Architecture": "amd64",
+        }
+
+
+class FakeRegistryData:
+    def __init__(self, digest: str):
+        self.short_id = "sha256:%s" % digest[:12]
+
+
+class FakeContainer:
+    def __init__(self, daemon, index: int, sparse=True):
+        self.daemon = daemon
+        self.id = hashlib.sha256(b"container%d" % index).hexdigest()
+        self.index = index
+        ref = daemon.image_ref(index)
+        labels = {"com.docker.compose.version": "2.20.2"}
+        if index % 3 == 0:
+            labels["com.docker.compose.project.working_dir"] = "/srv/stack%d" % (index % 10)
+        self.attrs = {
+            "Id": self.id,
+            "Names": ["/app%d" % index],
+            "Image": ref,
+            "ImageID": daemon.image(ref).id,
+            "Labels": labels,
+            "State": "running",
+        }
+        if not sparse:
+            self.reload()
+
+    @property
+    def name(self):
+        return self.attrs.get("Name", "").lstrip("/") or None
+
+    @property
+    def labels(self):
+        return self.attrs.get("Config", {}).get("Labels") or self.attrs.get("Labels", {})
+
+    @property
+    def status(self):
+        state = self.attrs["State"]
+        return state["Status"] if isinstance(state, dict) else state
+
+    @property
+    def image(self):
+        self.daemon.api_call()
+        return self.daemon.image(self.attrs["Image"])
+
+    def reload(self):
+        self.daemon.api_call()
+        self.attrs = dict(
+            self.attrs,
+            Name="/app%d" % self.index,
+            Config={
+                "Env": ["PATH=/usr/local/bin:/usr/bin", "TZ=Europe/London", "APP_ID=%d" % self.index],
+                "Labels": self.attrs["Labels"],
+            },
+            State={"Status": "running"},
+        )
+
+
+class FakeContainers:
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def list(self, sparse=False, **_kwargs):
+        self.daemon.api_call()
+        return [FakeContainer(self.daemon, i, sparse=sparse) for i in range(self.daemon.size)]
+
+    def get(self, container_id):
+        self.daemon.api_call()
+        for i in range(self.daemon.size):
+            c = FakeContainer(self.daemon, i)
+            if container_id in (c.id, "app%d" % i):
+                c.reload()
+                return c
+        raise docker.errors.NotFound(container_id)
+
+
+class FakeImages:
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def get_registry_data(self, image_ref: str):
+        self.daemon.registry_calls += 1
+        time.sleep(self.daemon.registry_latency)
+        return FakeRegistryData(self.daemon.latest_digest(image_ref))
+
+
+class FakeDockerClient:
+    """Docker client stand-in for `size` containers, with simulated call latency
+
+    Containers share images, `image_sharing` to each, and every other image
+    has a newer digest in the registry
+    """
+
+    def __init__(self, size: int, api_latency=0.0, registry_latency=0.0, image_sharing=2):
+        self.size = size
+        self.api_latency = api_latency
+        self.registry_latency = registry_latency
+        self.image_count = max(1, size // image_sharing)
+        self.images_by_ref = {}
+        self.api_calls = self.registry_calls = 0
+        self.lock = threading.Lock()
+        self.containers = FakeContainers(self)
+        self.images = FakeImages(self)
+
+    def api_call(self):
+        self.api_calls += 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+
+    def image_ref(self, index: int):
+        return "bench/image%d:latest" % (index % self.image_count)
+
+    def image(self, ref: str):
+        with self.lock:
+            if ref not in self.images_by_ref:
+                self.images_by_ref[ref] = FakeImage(ref, hashlib.sha256(ref.encode()).hexdigest())
+            return self.images_by_ref[ref]
+
+    def latest_digest(self, ref: str):
+        local = self.image(ref).id[7:]
+        if int(local, 16) % 2:
+            return hashlib.sha256(local.encode()).hexdigest()
+        return local
+
+    def events(self, **_kwargs):
+        return iter(())
+
+    def close(self):
+        pass
+
+
+class StubBroker:
+    """MQTT 3.1.1 and 5 broker stand-in, run on its own thread and event loop
+
+    Handles QoS 0 publishes, keeps retained messages and replays them to matching
+    subscriptions. Live messages are counted but not forwarded. MQTT 5 clients are
+    offered up to `alias_maximum` topic aliases, and turned away with an unsupported
+    protocol version if 5 isn't in `protocols`, as a 3.1.1 broker would.
+    """
+
+    def __init__(self, protocols=(4, 5), alias_maximum=65535):
+        self.protocols = protocols
+        self.alias_maximum = alias_maximum
+        self.retained = {}
+        self.received = 0
+        self.received_bytes = 0
+        self.writers = set()
+        self.loop = None
+        self.server = None
+        self.port = None
+        self.thread = None
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self.handle, "127.0.0.1", 0)
+            )
+            self.port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True, name="stub_broker")
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def shutdown(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        handlers = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        v5 = False
+        aliases = {}
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, multiplier, size = 0, 1, 1
+                while True:
+                    digit = (await reader.readexactly(1))[0]
+                    size += 1
+                    length += (digit & 127) * multiplier
+                    multiplier *= 128
+                    if not digit & 128:
+                        break
+                body = await reader.readexactly(length)
+                packet_type = header >> 4
+                if packet_type == 1:  # CONNECT
+                    if body[6] not in self.protocols:
+                        writer.write(b"\x20\x02\x00\x01")
+                        await writer.drain()
+                        break
+                    v5 = body[6] == 5
+                    if v5:
+                        properties = b"\x22" + self.alias_maximum.to_bytes(2, "big")
+                        writer.write(packet(0x20, b"\x00\x00" + varint(len(properties)) + properties))
+                    else:
+                        writer.write(b"\x20\x02\x00\x00")
+                elif packet_type == 3:  # PUBLISH
+                    self.received_bytes += size + length
+                    self.on_publish(header & 0x0F, body, aliases if v5 else None)
+                elif packet_type == 8:  # SUBSCRIBE
+                    filters = topic_filters(skip_properties(body, 2) if v5 else body[2:])
+                    acks = body[:2] + (b"\x00" if v5 else b"") + bytes(len(filters))
+                    writer.write(packet(0x90, acks))
+                    for topic, payload in list(self.retained.items()):
+                        if any(filter_regex(f).fullmatch(topic) for f in filters):
+                            writer.write(publish_packet(topic, payload, v5))
+                elif packet_type == 10:  # UNSUBSCRIBE
+                    if v5:
+                        filters = topic_filters(skip_properties(body, 2), options=False)
+                        writer.write(packet(0xB0, body[:2] + b"\x00" + bytes(len(filters))))
+                    else:
+                        writer.write(packet(0xB0, body[:2]))
+                elif packet_type == 12:  # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif packet_type == 14:  # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def on_publish(self, flags: int, body: bytes, aliases=None):
+        """Record a publish, with aliases a dict of the connection's topic aliases for MQTT 5"""
+        self.received += 1
+        topic_length = int.from_bytes(body[:2], "big")
+        topic = body[2 : 2 + topic_length].decode()
+        offset = 2 + topic_length + (2 if flags & 0x06 else 0)
+        if aliases is not None:
+            properties, offset = publish_properties(body, offset)
+            alias = properties.get(0x23)
+            if alias is not None:
+                if topic:
+                    aliases[alias] = topic
+                else:
+                    topic = aliases[alias]
+        payload = body[offset:]
+        if flags & 0x01:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+
+
+def varint(value: int):
+    encoded = bytearray()
+    while True:
+        digit, value = value % 128, value // 128
+        encoded.append(digit | 128 if value else digit)
+        if not value:
+            return bytes(encoded)
+
+
+def read_varint(body: bytes, offset: int):
+    value, multiplier = 0, 1
+    while True:
+        digit = body[offset]
+        offset += 1
+        value += (digit & 127) * multiplier
+        multiplier *= 128
+        if not digit & 128:
+            return value, offset
+
+
+def skip_properties(body: bytes, offset: int):
+    length, offset = read_varint(body, offset)
+    return body[offset + length :]
+
+
+# MQTT 5 publish property widths by identifier, for those with fixed sizes
+PROPERTY_WIDTHS = {0x01: 1, 0x02: 4, 0x23: 2}
+
+
+def publish_properties(body: bytes, offset: int):
+    """Fixed width MQTT 5 publish properties by identifier, and the payload offset"""
+    length, offset = read_varint(body, offset)
+    end = offset + length
+    properties = {}
+    while offset < end:
+        identifier = body[offset]
+        width = PROPERTY_WIDTHS.get(identifier)
+        if width is None:
+            raise ValueError("Unsupported publish property %s" % identifier)
+        properties[identifier] = int.from_bytes(body[offset + 1 : offset + 1 + width], "big")
+        offset += 1 + width
+    return properties, end
+
+
+def packet(header: int, body: bytes):
+    return bytes([header]) + varint(len(body)) + body
+
+
+def publish_packet(topic: str, payload: bytes, v5=False):
+    encoded = topic.encode()
+    return packet(0x31, len(encoded).to_bytes(2, "big") + encoded + (b"\x00" if v5 else b"") + payload)
+
+
+@functools.lru_cache
+def filter_regex(topic_filter: str):
+    levels, multi = topic_filter.split("/"), ""
+    if levels[-1] == "#":
+        levels, multi = levels[:-1], "(/.*)?" if len(levels) > 1 else ".*"
+    pattern = "/".join("[^/]*" if level == "+" else re.escape(level) for level in levels)
+    return re.compile(pattern + multi)
+
+
+def topic_filters(body: bytes, options=True):
+    """Topic filters from a subscribe payload, each followed by an options byte, or unsubscribe"""
+    filters = []
+    while body:
+        length = int.from_bytes(body[:2], "big")
+        filters.append(body[2 : 2 + length].decode())
+        body = body[2 + length + (1 if options else 0) :]
+    return filters
+
+
+class SweepProvider(ReleaseProvider):
+    source_type = "docker"
+
+
+@contextmanager
+def measure(results, name: str, size: int, trace_memory=False, **extra):
+    """Record wall time, process CPU time and memory for the enclosed block
+
+    The block may add its own figures to the yielded dict
+    """
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    result = {"benchmark": name, "n": size}
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    try:
+        yield result
+    finally:
+        result["wall_s"] = round(time.perf_counter() - started, 4)
+        result["cpu_s"] = round(time.process_time() - cpu_started, 4)
+        if trace_memory:
+            result["peak_traced_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        result["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if result.get("publishes") and result["wall_s"]:
+            result["publishes_per_s"] = round(result["publishes"] / result["wall_s"], 1)
+        result.update(extra)
+        results.append(result)
+        print(json.dumps(result), file=sys.stderr)
+
+
+async def wait_until(predicate, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Benchmark wait timed out")
+        await asyncio.sleep(0.005)
+
+
+def bench_provider(client: FakeDockerClient, workers: int):
+    cfg = DockerConfig(scan_workers=workers, watch_events=False)
+    provider = DockerProvider(cfg, PackageIndex())
+    provider.docker_client = client
+    return provider
+
+
+async def connect_client(broker: StubBroker, transport: str, protocol: str = "3.1.1"):
+    cfg = MqttConfig(
+        host="127.0.0.1",
+        port=broker.port,
+        user="bench",
+        password="bench",
+        transport=transport,
+        protocol=protocol,
+    )
+    client = MqttClient(cfg, NodeConfig(name="bench"), HomeAssistantConfig())
+    client.start(asyncio.get_running_loop())
+    await wait_until(client.client.is_connected, timeout=10)
+    return client
+
+
+async def run_provider_scan(results, size: int, args):
+    client = FakeDockerClient(size, args.api_latency, args.registry_latency)
+    provider = bench_provider(client, args.scan_workers)
+    for name in ("provider_scan_cold", "provider_scan_warm"):
+        client.api_calls = client.registry_calls = 0
+        with measure(results, name, size, args.trace_memory) as result:
+            discoveries = [d async for d in provider.scan(name)]
+        result.update(
+            discoveries=len(discoveries),
+            api_calls=client.api_calls,
+            registry_calls=client.registry_calls,
+        )
+
+
+async def run_analyze(results, size: int, args):
+    client = FakeDockerClient(size)
+    provider = bench_provider(client, args.scan_workers)
+    [d async for d in provider.scan("warmup")]
+    containers = client.containers.list(sparse=True)
+    with measure(results, "analyze", size, args.trace_memory) as result:
+        for c in containers:
+            provider.analyze(c, "analyze", provider.discoveries.get(c.attrs["Names"][0][1:]))
+    result["per_container_us"] = round(result["wall_s"] / size * 1e6, 1)
+
+
+async def run_publish_hass(results, size: int, args):
+    provider = bench_provider(FakeDockerClient(size), args.scan_workers)
+    discoveries = [d async for d in provider.scan("publish")]
+    for transport in args.transports:
+        broker = StubBroker(alias_maximum=args.topic_alias_maximum).start()
+        publisher = await connect_client(broker, transport, args.mqtt_protocol)
+        try:
+            # a rescan where every latest version has moved on
+            changed = [replace(d, latest_version="%s.1" % d.latest_version) for d in discoveries]
+            for name, batch in (
+                ("publish_hass", discoveries),
+                ("publish_hass_unchanged", discoveries),
+                ("publish_hass_changed", changed),
+            ):
+                received, sent = broker.received, publisher.sent_count
+                received_bytes = broker.received_bytes
+                with measure(
+                    results, name, size, args.trace_memory, transport=transport
+                ) as result:
+                    for discovery in batch:
+                        publisher.publish_hass_config(discovery)
+                        publisher.publish_hass_state(discovery)
+                        await publisher.drain()
+                    await wait_until(
+                        lambda: broker.received - received >= publisher.sent_count - sent
+                    )
+                    result["publishes"] = broker.received - received
+                    result["bytes"] = broker.received_bytes - received_bytes
+                result["suppressed"] = publisher.suppressed_count
+        finally:
+            publisher.stop()
+            broker.stop()
+
+
+async def run_clean_topics(results, size: int, args):
+    """Clean retained topics where half are from a previous session
+
+    The broker also holds `--broker-topics` config topics from other nodes, which
+    the sweep's node scoped subscription leaves out, once past the first clean's
+    sweep of the previous topic layout
+    """
+    broker = StubBroker(alias_maximum=args.topic_alias_maximum).start()
+    publisher = await connect_client(broker, args.transports[0], args.mqtt_protocol)
+    provider = SweepProvider()
+    config = b'{"name":"app docker on other","unique_id":"docker_other_app","state_topic":"x"}'
+    for i in range(args.broker_topics):
+        broker.retained["homeassistant/update/other%d_docker/app%d/config" % (i % 50, i)] = config
+    publisher.legacy_swept.add(provider)
+    try:
+        for i in range(size):
+            topics = (
+                "%s/app%d" % (publisher.command_topic(provider), i),
+                "homeassistant/update/bench_docker/app%d/config" % i,
+            )
+            for topic in topics:
+                broker.retained[topic] = b'{"state": "on"}'
+                # stale topics known from restored state, needed when MQTT 5 skips the sweep
+                publisher.topic_sessions[topic] = "current" if i % 2 == 0 else "previous"
+        with measure(
+            results, "clean_topics", size, args.trace_memory, quiet_period=args.quiet_period
+        ) as result:
+            await publisher.clean_topics(provider, "current", quiet_period=args.quiet_period)
+            await wait_until(
+                lambda: len(broker.retained) <= size + size % 2 + args.broker_topics
+            )
+        result["retained"] = size * 2
+        result["broker_topics"] = size * 2 + args.broker_topics
+        result["removed"] = size * 2 + args.broker_topics - len(broker.retained)
+    finally:
+        publisher.stop()
+        broker.stop()
+
+
+def bench_app(broker: StubBroker, client: FakeDockerClient, tmp_dir: str, args):
+    """App configured against the stub broker and fake docker, with state kept in tmp_dir"""
+    conf_file = os.path.join(tmp_dir, "config.yaml")
+    with open(conf_file, "w") as f:
+        json.dump(
+            {
+                "log": {"level": "WARNING"},
+                "node": {"name": "bench"},
+                "mqtt": {
+                    "host": "127.0.0.1",
+                    "port": broker.port,
+                    "user": "bench",
+                    "password": "bench",
+                    "transport": args.transports[0],
+                    "protocol": args.mqtt_protocol,
+                },
+                "docker": {"scan_workers": args.scan_workers, "watch_events": False},
+                "state_path": os.path.join(tmp_dir, "state.db"),
+            },
+            f,
+        )
+    with mock.patch.multiple(
+        app,
+        CONF_FILE=conf_file,
+        PKG_INFO_FILE=os.path.join(os.path.dirname(__file__), "common_packages.yaml"),
+    ):
+        application = app.App()
+    for scanner in application.scanners:
+        scanner.docker_client = client
+    return application
+
+
+def stop_app(application):
+    application.publisher.stop()
+    if application.store:
+        application.store.close()
+
+
+async def run_app_scan(results, size: int, args):
+    """Full app scan, including publish and clean, with the default clean quiet period"""
+    broker = StubBroker(alias_maximum=args.topic_alias_maximum).start()
+    client = FakeDockerClient(size, args.api_latency, args.registry_latency)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        application = bench_app(broker, client, tmp_dir, args)
+        application.publisher.start(asyncio.get_running_loop())
+        await wait_until(application.publisher.client.is_connected, timeout=10)
+        try:
+            for name in ("app_scan_cold", "app_scan_warm"):
+                received = broker.received
+                with measure(results, name, size, args.trace_memory) as result:
+                    await application.scan()
+                    result["publishes"] = broker.received - received
+        finally:
+            stop_app(application)
+            broker.stop()
+
+
+async def run_app_startup(results, size: int, args):
+    """Time from app start until commands are served and the saved snapshot is published
+
+    State is saved by a first run, so the measured restart has a snapshot to restore
+    """
+    broker = StubBroker(alias_maximum=args.topic_alias_maximum).start()
+    client = FakeDockerClient(size, args.api_latency, args.registry_latency)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        application = bench_app(broker, client, tmp_dir, args)
+        application.publisher.start(asyncio.get_running_loop())
+        await wait_until(application.publisher.client.is_connected, timeout=10)
+        try:
+            await application.scan()
+        finally:
+            stop_app(application)
+        application = bench_app(broker, client, tmp_dir, args)
+        running = None
+        try:
+            with measure(results, "app_ready", size, args.trace_memory) as result:
+                running = asyncio.create_task(application.run())
+                await application.ready.wait()
+                result["publishes"] = application.publisher.sent_count
+        finally:
+            if running is not None:
+                running.cancel()
+            for watcher in application.watchers:
+                watcher.cancel()
+            stop_app(application)
+            broker.stop()
+
+
+def write_apt_files(root: str, size: int):
+    """dpkg status with size installed packages, a tenth upgradable, and lists of ten times as many"""
+    with open(os.path.join(root, "status"), "w") as f:
+        for i in range(size):
+            f.write(
+                "Package: pkg%d\nStatus: install ok installed\nPriority: optional\n"
+                "Architecture: amd64\nVersion: 1.%d-1+deb12u1\nDescription: package %d\n\n" % (i, i, i)
+            )
+    os.mkdir(os.path.join(root, "lists"))
+    with open(os.path.join(root, "lists", "bench_dists_main_binary-amd64_Packages"), "w") as f:
+        for i in range(size * 10):
+            f.write(
+                "Package: pkg%d\nPriority: optional\nArchitecture: amd64\nVersion: 1.%d-1+deb12u%d\n"
+                "Filename: pool/main/p/pkg%d.deb\nSize: 1024\nDescription: package %d\n\n"
+                % (i, i, 2 if i % 10 == 0 else 1, i, i)
+            )
+
+
+async def run_apt_scan(results, size: int, args):
+    with tempfile.TemporaryDirectory() as root:
+        write_apt_files(root, size)
+        provider = AptProvider(
+            AptConfig(
+                containers=False,
+                dpkg_status_path=os.path.join(root, "status"),
+                lists_path=os.path.join(root, "lists"),
+            )
+        )
+        for name in ("apt_scan_cold", "apt_scan_warm"):
+            parses = provider.cache.parses
+            with measure(results, name, size, args.trace_memory) as result:
+                discoveries = [d async for d in provider.scan(name)]
+            result.update(discoveries=len(discoveries), parses=provider.cache.parses - parses)
+
+
+RUNNERS = {
+    "provider_scan": run_provider_scan,
+    "analyze": run_analyze,
+    "publish_hass": run_publish_hass,
+    "clean_topics": run_clean_topics,
+    "app_scan": run_app_scan,
+    "app_startup": run_app_startup,
+    "apt_scan": run_apt_scan,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+async def main(args):
+    results = []
+    for size in args.sizes:
+        for name in args.benchmarks:
+            REGISTRY.reset()
+            await RUNNERS[name](results, size, args)
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "settings": {
+                "api_latency": args.api_latency,
+                "registry_latency": args.registry_latency,
+                "scan_workers": args.scan_workers,
+                "transports": args.transports,
+                "mqtt_protocol": args.mqtt_protocol,
+                "topic_alias_maximum": args.topic_alias_maximum,
+                "quiet_period": args.quiet_period,
+                "broker_topics": args.broker_topics,
+                "serializer": serializer.BACKEND,
+            },
+        },
+        "results": results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--api-latency", type=float, default=0.002, help="seconds per docker API call")
+    parser.add_argument("--registry-latency", type=float, default=0.05, help="seconds per registry lookup")
+    parser.add_argument("--scan-workers", type=int, default=DockerConfig.scan_workers)
+    parser.add_argument("--transports", nargs="+", choices=("threaded", "asyncio"), default=["threaded", "asyncio"])
+    parser.add_argument("--mqtt-protocol", choices=("3.1.1", "5"), default="3.1.1")
+    parser.add_argument(
+        "--topic-alias-maximum", type=int, default=65535, help="topic aliases the broker offers MQTT 5 clients"
+    )
+    parser.add_argument("--quiet-period", type=float, default=0.5, help="clean_topics quiet period")
+    parser.add_argument(
+        "--broker-topics", type=int, default=20000, help="other nodes' retained topics for clean_topics"
+    )
+    parser.add_argument("--trace-memory", action="store_true", help="trace peak allocations, slows the run")
+    parser.add_argument("--output", help="write JSON results to file rather than stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(30),
+        logger_factory=structlog.PrintLoggerFactory(sys.stderr),
+    )
+    report = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
@@ -1,7 +1,8 @@
 from dataclasses import dataclass, field
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 from omegaconf import OmegaConf
 import os
+import re
 from omegaconf import MISSING
 import structlog
 
@@ -14,6 +15,18 @@ class MqttConfig:
     password: str = MISSING
     port: int = 1883
     topic_root: str = "rel2mqtt"
+    transport: str = "threaded"
+    max_pending: int = 1000
+    protocol: str = "3.1.1"
+    message_expiry: int = 60 * 60 * 24
+
+
+@dataclass
+class DockerHostConfig:
+    url: str = MISSING
+    node: Optional[str] = None
+    tls: bool = False
+    use_ssh_client: bool = False
 
 
 @dataclass
@@ -27,6 +40,31 @@ class DockerConfig:
         "https://www.docker.com/wp-content/uploads/2022/03/Moby-logo.png"
     )
     device_icon: str = "mdi:train-car-container"
+    hosts: List[DockerHostConfig] = field(default_factory=list)
+    scan_workers: int = 4
+    registry_cache_ttl: int = 60 * 60
+    registry_cache_size: int = 1000
+    registry_cache_path: Optional[str] = None
+    registry_client: str = "docker"
+    registry_timeout: int = 10
+    insecure_registries: List[str] = field(default_factory=list)
+    watch_events: bool = True
+    git_check_ttl: int = 60 * 60
+    git_check_budget: int = 30
+    events_debounce: float = 2.0
+    pull_progress_interval: float = 2.0
+    batch_update_workers: int = 2
+
+
+@dataclass
+class AptConfig:
+    enabled: bool = False
+    host: bool = True
+    containers: bool = True
+    packages: List[str] = field(default_factory=list)
+    dpkg_status_path: str = "/var/lib/dpkg/status"
+    lists_path: str = "/var/lib/apt/lists"
+    device_icon: str = "mdi:package-variant"
 
 
 @dataclass
@@ -53,6 +91,28 @@ class LogConfig:
     level: str = "INFO"
 
 
+@dataclass
+class UpdateConfig:
+    workers: int = 2
+
+
+@dataclass
+class ScheduleConfig:
+    enabled: bool = True
+    min_interval: int = 60 * 30
+    max_interval: int = 60 * 60 * 24
+    backoff: float = 1.5
+    jitter: float = 0.2
+    tick: int = 60
+
+
+@dataclass
+class MetricsConfig:
+    enabled: bool = False
+    host: str = "127.0.0.1"
+    port: int = 9464
+
+
 @dataclass
 class Config:
     log: LogConfig = field(default_factory=LogConfig)
@@ -60,12 +120,20 @@ class Config:
     mqtt: MqttConfig = field(default_factory=MqttConfig)
     homeassistant: HomeAssistantConfig = field(default_factory=HomeAssistantConfig)
     docker: DockerConfig = field(default_factory=DockerConfig)
+    apt: AptConfig = field(default_factory=AptConfig)
+    update: UpdateConfig = field(default_factory=UpdateConfig)
+    metrics: MetricsConfig = field(default_factory=MetricsConfig)
+    schedule: ScheduleConfig = field(default_factory=ScheduleConfig)
     scan_interval: int = 60 * 60 * 3
+    scan_timeout: int = 60 * 30
+    scan_queue_size: int = 100
+    state_path: Optional[str] = "conf/state.db"
 
 
 @dataclass
 class DockerPackageUpdateInfo:
-    image_name: str = MISSING
+    image_name: Optional[str] = None
+    image_pattern: Optional[str] = None
 
 
 @dataclass
@@ -80,6 +148,127 @@ class UpdateInfoConfig:
     common_packages: Dict[str, PackageUpdateInfo] = field(default_factory=lambda: {})
 
 
+def normalize_image_name(image_name: str):
+    """Strip tag, digest, registry host and docker hub `library/` from an image name"""
+    name = image_name.split("@")[0]
+    if ":" in name.rsplit("/", 1)[-1]:
+        name = name.rsplit(":", 1)[0]
+    parts = name.split("/")
+    if len(parts) > 1 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        parts = parts[1:]
+    if len(parts) > 1 and parts[0] == "library":
+        parts = parts[1:]
+    return "/".join(parts)
+
+
+PATTERN_META = set(".^$*+?{}[]|()\\")
+
+
+def literal_pattern(pattern: str):
+    """Literal text a regex matches, and whether it is followed by `.*`
+
+    None for any other regex, which has to be matched against each image name
+    """
+    literal = []
+    pos = 0
+    while pos < len(pattern):
+        if pattern[pos:] == ".*":
+            return "".join(literal), True
+        c = pattern[pos]
+        if c == "\\" and pos + 1 < len(pattern) and not pattern[pos + 1].isalnum():
+            literal.append(pattern[pos + 1])
+            pos += 2
+        elif c in PATTERN_META:
+            return None
+        else:
+            literal.append(c)
+            pos += 1
+    return "".join(literal), False
+
+
+class PackageIndex:
+    """Common package info indexed by docker image name
+
+    Lookups try an exact name, then the normalized name ( so registry mirrors and
+    prefixed names match ), then any regex `image_pattern`, and are memoized.
+    Literal patterns, and literal prefixes followed by `.*`, are indexed too, so only
+    other regexes are tried one by one. The first pattern listed still wins
+    """
+
+    def __init__(self, common_packages=None):
+        self.exact = {}
+        self.normalized = {}
+        self.pattern_names = {}
+        self.pattern_prefixes = {}
+        self.prefix_lengths = []
+        self.patterns = []
+        self.pattern_count = 0
+        self.memo = {}
+        for pkg_name, pkg in (common_packages or {}).items():
+            docker = pkg.get("docker") or {}
+            info = PackageUpdateInfo(
+                docker=DockerPackageUpdateInfo(
+                    image_name=docker.get("image_name"),
+                    image_pattern=docker.get("image_pattern"),
+                ),
+                logo_url=pkg.get("logo_url"),
+                release_notes_url=pkg.get("release_notes_url"),
+            )
+            if info.docker.image_name:
+                self.exact.setdefault(info.docker.image_name, info)
+                self.normalized.setdefault(normalize_image_name(info.docker.image_name), info)
+            if info.docker.image_pattern:
+                self.add_pattern(pkg_name, info)
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.pattern_prefixes})
+
+    def add_pattern(self, pkg_name, info):
+        order = self.pattern_count
+        self.pattern_count += 1
+        literal = literal_pattern(info.docker.image_pattern)
+        if literal is None:
+            try:
+                self.patterns.append((order, re.compile(info.docker.image_pattern), info))
+            except re.error as e:
+                log.warn("Invalid image pattern for %s: %s", pkg_name, e)
+        elif literal[1]:
+            self.pattern_prefixes.setdefault(literal[0], (order, info))
+        else:
+            self.pattern_names.setdefault(literal[0], (order, info))
+
+    def __len__(self):
+        return (
+            len(self.exact)
+            + len(self.patterns)
+            + len(self.pattern_names)
+            + len(self.pattern_prefixes)
+        )
+
+    def lookup(self, image_name: str):
+        if image_name is None:
+            return None
+        if image_name not in self.memo:
+            self.memo[image_name] = self.find(image_name)
+        return self.memo[image_name]
+
+    def find(self, image_name: str):
+        if image_name in self.exact:
+            return self.exact[image_name]
+        normalized = normalize_image_name(image_name)
+        if normalized in self.normalized:
+            return self.normalized[normalized]
+        indexed = []
+        for name in (image_name, normalized):
+            indexed.append(self.pattern_names.get(name))
+            indexed.extend(self.pattern_prefixes.get(name[:n]) for n in self.prefix_lengths)
+        best = min(filter(None, indexed), key=lambda hit: hit[0], default=None)
+        for order, pattern, info in self.patterns:
+            if best is not None and order > best[0]:
+                break
+            if pattern.fullmatch(image_name) or pattern.fullmatch(normalized):
+                return info
+        return best and best[1]
+
+
 def load_package_info(pkginfo_file_path):
     if os.path.exists(pkginfo_file_path):
         log.debug("Loading common package update info from %s", pkginfo_file_path)
@@ -87,8 +276,9 @@ def load_package_info(pkginfo_file_path):
     else:
         log.warn("No common package update info found at %s", pkginfo_file_path)
         cfg = OmegaConf.structured(UpdateInfoConfig)
-    OmegaConf.set_readonly(cfg, True)   
-    return cfg
+    index = PackageIndex(OmegaConf.to_container(cfg.common_packages))
+    log.debug("Indexed %s common packages", len(index))
+    return index
 
 
 def load_app_config(conf_file_path):
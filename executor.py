@@ -0,0 +1,74 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import structlog
+
+log = structlog.get_logger()
+
+
+class UpdateExecutor:
+    """Runs provider commands in a worker pool, off the event loop
+
+    Jobs are keyed by a tuple ending with the entity name, or the command name for
+    provider wide commands like `install_all`. Only one job per key is
+    queued or running at a time, so duplicate commands collapse into the job
+    already in hand.
+    """
+
+    def __init__(self, workers: int = 2, on_change=None):
+        self.pool = ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="update"
+        )
+        self.jobs = {}
+        self.running = set()
+        self.lock = threading.Lock()
+        self.on_change = on_change
+        self.log = structlog.get_logger().bind(integration="executor")
+
+    async def submit(self, key, fn, *args):
+        """Run `fn(*args)` in the pool and return its result
+
+        Returns None without running if a job for the same key is already in hand
+        """
+        with self.lock:
+            if key in self.jobs:
+                self.log.info("Skipping duplicate job", key=key)
+                return None
+            future = self.pool.submit(self.run, key, fn, *args)
+            self.jobs[key] = future
+        self.changed()
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            with self.lock:
+                if self.jobs.get(key) is future:
+                    del self.jobs[key]
+            self.changed()
+
+    def run(self, key, fn, *args):
+        with self.lock:
+            self.running.add(key)
+        self.changed()
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.running.discard(key)
+
+    def status(self):
+        with self.lock:
+            return {
+                "queued": len(self.jobs) - len(self.running),
+                "running": len(self.running),
+                "jobs": sorted(str(key[-1]) for key in self.running),
+            }
+
+    def changed(self):
+        if self.on_change:
+            try:
+                self.on_change(self.status())
+            except Exception as e:
+                self.log.warn("Unable to report executor status: %s", e)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -1,6 +1,16 @@
-def hass_format_config(
-    discovery, object_id, node_name, state_topic, command_topic, session
-):
+def hass_config_key(discovery):
+    """Hashable summary of the discovery fields that hass_format_config depends on"""
+    return (
+        discovery.can_update,
+        discovery.release_url,
+        discovery.entity_picture_url,
+        discovery.device_icon,
+        discovery.update_policy,
+        discovery.custom,
+    )
+
+
+def hass_format_config(discovery, object_id, node_name, state_topic, command_topic):
     features = []
     if discovery.can_update:
         features.append("INSTALL")
@@ -15,7 +25,6 @@ def hass_format_config(
         "command_topic": command_topic,
         "payload_install": '{"source_type":"%s","name":"%s","command":"install"}'
         % (discovery.source_type, discovery.name),
-        "source_session": session,
         "supported_features": features,
         "entity_picture": discovery.entity_picture_url,
         "icon": discovery.device_icon,
@@ -27,17 +36,48 @@ def hass_format_config(
     return config
 
 
-def hass_format_state(discovery, node_name, session, in_progress=False):
+def hass_format_button(name, object_id, command_topic, payload_press):
+    return {
+        "name": name,
+        "unique_id": object_id,
+        "command_topic": command_topic,
+        "payload_press": payload_press,
+        "icon": "mdi:update",
+    }
+
+
+def hass_format_state(discovery, node_name, in_progress=False, progress=None):
+    state = hass_state_dynamic(discovery, in_progress=in_progress, progress=progress)
+    state.update(hass_state_static(discovery, node_name))
+    return state
+
+
+def hass_state_static(discovery, node_name):
+    """State fields that only change when the entity is reconfigured"""
+    return {
+        "title": discovery.title_template.format(name=discovery.name, node=node_name),
+        "release_url": discovery.release_url,
+        "release_summary": discovery.release_summary,
+        "auto_update": discovery.update_policy == 'Auto'
+    }
+
+
+def hass_state_static_key(discovery):
+    return (
+        discovery.title_template,
+        discovery.release_url,
+        discovery.release_summary,
+        discovery.update_policy,
+    )
+
+
+def hass_state_dynamic(discovery, in_progress=False, progress=None):
     state = {
         "state": discovery.status,
         "installed_version": discovery.current_version,
         "latest_version": discovery.latest_version,
-        "title": discovery.title_template.format(name=discovery.name, node=node_name),
-        "release_url": discovery.release_url,
-        "release_summary": discovery.release_summary,
-        "source_session": session,
         "in_progress": in_progress,
-        "auto_update": discovery.update_policy == 'Auto'
+        "update_percentage": progress,
     }
     custom_state = discovery.provider.hass_state_format(discovery)
     if custom_state:
@@ -0,0 +1,346 @@
+import asyncio
+from dataclasses import dataclass
+import glob
+import io
+import os
+import os.path
+import re
+import tarfile
+from typing import Optional
+import docker
+import structlog
+from config import AptConfig
+from metrics import REGISTRY
+from model import CustomFields, Discovery, ReleaseProvider
+
+log = structlog.get_logger()
+
+DPKG_STATUS_PATH = "/var/lib/dpkg/status"
+APT_LISTS_PATH = "/var/lib/apt/lists"
+CONTROL_FIELD_RE = re.compile(r"^(Package|Version|Architecture|Status): (.*)$", re.M)
+UNSAFE_NAME_RE = re.compile(r"[^A-Za-z0-9_-]")
+
+
+def parse_control(text: str):
+    """Package, Version, Architecture and Status of each stanza of a dpkg control file"""
+    for stanza in text.split("\n\n"):
+        fields = dict(CONTROL_FIELD_RE.findall(stanza))
+        if "Package" in fields and "Version" in fields:
+            yield fields
+
+
+def parse_installed(text: str):
+    """Installed version by (package, architecture) from dpkg status"""
+    return {
+        (fields["Package"], fields.get("Architecture")): fields["Version"]
+        for fields in parse_control(text)
+        if fields.get("Status", "").endswith(" installed")
+    }
+
+
+def parse_available(text: str, available: dict = None):
+    """Highest version by (package, architecture) from an apt Packages list"""
+    available = {} if available is None else available
+    for fields in parse_control(text):
+        key = (fields["Package"], fields.get("Architecture"))
+        version = fields["Version"]
+        if key not in available or compare_versions(version, available[key]) > 0:
+            available[key] = version
+    return available
+
+
+def char_order(c: str):
+    # dpkg ordering: tilde before anything, even the end of a part, then letters, then the rest
+    if c == "~":
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+def part_key(part: str):
+    """Sort key for an upstream version or revision, per dpkg's verrevcmp"""
+    key = []
+    pos = 0
+    while pos < len(part):
+        start = pos
+        while pos < len(part) and not part[pos].isdigit():
+            pos += 1
+        text = tuple(char_order(c) for c in part[start:pos]) + (0,)
+        start = pos
+        while pos < len(part) and part[pos].isdigit():
+            pos += 1
+        key.append((text, int(part[start:pos] or 0)))
+    end = ((0,), 0)
+    while key and key[-1] == end:
+        key.pop()
+    key.append(end)
+    return tuple(key)
+
+
+def version_key(version: str):
+    """Sort key for a Debian version, as epoch, upstream version and revision"""
+    # the epoch ends at the first colon, as upstream versions may contain colons too
+    epoch, _, rest = version.partition(":") if ":" in version else ("0", "", version)
+    upstream, _, revision = rest.rpartition("-") if "-" in rest else (rest, "", "")
+    return (int(epoch or 0), part_key(upstream), part_key(revision))
+
+
+def compare_versions(a: str, b: str):
+    """Negative, zero or positive as Debian version a sorts before, with or after b"""
+    key_a, key_b = version_key(a), version_key(b)
+    return (key_a > key_b) - (key_a < key_b)
+
+
+def native_arch(installed: dict):
+    """dpkg's native architecture, as that of dpkg itself, else the most installed one"""
+    counts = {}
+    for package, arch in installed:
+        if package == "dpkg":
+            return arch
+        if arch != "all":
+            counts[arch] = counts.get(arch, 0) + 1
+    return max(counts, key=counts.get, default=None)
+
+
+def upgrades(installed: dict, available: dict, packages=None):
+    """(package, architecture, installed, latest, foreign) for each installed package
+
+    Only packages with a newer version available, unless packages names those to report.
+    foreign marks a package installed for other than the native architecture
+    """
+    results = []
+    native = native_arch(installed)
+    for (package, arch), version in installed.items():
+        if packages and package not in packages:
+            continue
+        latest = version
+        for candidate in (available.get((package, arch)), available.get((package, "all"))):
+            if candidate and candidate != latest and compare_versions(candidate, latest) > 0:
+                latest = candidate
+        if packages or latest != version:
+            results.append((package, arch, version, latest, arch not in (native, "all", None)))
+    return results
+
+
+class ControlFileCache:
+    """Parsed dpkg control files, reparsed only when a file's mtime or size changes"""
+
+    def __init__(self):
+        self.entries = {}
+        self.parses = 0
+
+    def signature(self, paths):
+        signature = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            signature.append((path, st.st_mtime_ns, st.st_size))
+        return tuple(signature)
+
+    def get(self, key, signature, parse):
+        cached = self.entries.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        self.parses += 1
+        parsed = self.entries[key] = (signature, parse())
+        return parsed[1]
+
+
+def container_key(c):
+    # sparse container listings carry ImageID rather than Image
+    return (c.id, c.attrs.get("ImageID") or c.attrs.get("Image"))
+
+
+def read_text(path: str):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def read_archive(container, path: str):
+    """Text of each regular file under path in container, by file name"""
+    try:
+        chunks, _stat = container.get_archive(path)
+    except docker.errors.NotFound:
+        return {}
+    with tarfile.open(fileobj=io.BytesIO(b"".join(chunks))) as tar:
+        return {
+            os.path.basename(member.name): tar.extractfile(member).read().decode("utf-8", "replace")
+            for member in tar.getmembers()
+            if member.isfile()
+        }
+
+
+@dataclass(slots=True, frozen=True)
+class AptFields(CustomFields):
+    package: Optional[str] = None
+    architecture: Optional[str] = None
+    container: Optional[str] = None
+
+
+class AptProvider(ReleaseProvider):
+    """Upgradable apt packages on this host, and in containers listing `REL2MQTT_APT_PKGS`
+
+    dpkg status and apt lists are parsed directly rather than asking apt, and only
+    reparsed when changed, by file mtime on the host and by container and image id
+    for containers. The latest version is the highest one listed, ignoring pinning.
+    """
+
+    custom_type = AptFields
+
+    def __init__(self, cfg: AptConfig, client: docker.DockerClient = None):
+        self.cfg = cfg
+        self.source_type = "apt"
+        self.discoveries = {}
+        self.client = client
+        self.cache = ControlFileCache()
+        self.container_packages = {}
+        self.log = structlog.get_logger().bind(integration="apt")
+
+    def host_upgrades(self):
+        lists = sorted(glob.glob(os.path.join(self.cfg.lists_path, "*_Packages")))
+        status_signature = self.cache.signature([self.cfg.dpkg_status_path])
+        if not status_signature:
+            self.log.warn("No dpkg status found", path=self.cfg.dpkg_status_path)
+            return []
+        lists_signature = self.cache.signature(lists)
+
+        def compare():
+            installed = self.cache.get(
+                "status", status_signature, lambda: parse_installed(read_text(self.cfg.dpkg_status_path))
+            )
+            available = self.cache.get("lists", lists_signature, lambda: self.merge_lists(lists))
+            return upgrades(installed, available, self.cfg.packages)
+
+        return self.cache.get("upgrades", (status_signature, lists_signature), compare)
+
+    def merge_lists(self, lists):
+        available = {}
+        for path in lists:
+            parse_available(read_text(path), available)
+        return available
+
+    def container_upgrades(self, c):
+        """Upgrades for the packages a container lists, cached until it is recreated"""
+        key = container_key(c)
+        if key not in self.container_packages:
+            if "Config" not in c.attrs:
+                c.reload()
+            env = dict(e.split("=", 1) for e in c.attrs["Config"]["Env"] or [] if "=" in e)
+            packages = (env.get("REL2MQTT_APT_PKGS") or "").replace(",", " ").split()
+            results = []
+            if packages:
+                with REGISTRY.timer("analyze_seconds", phase="apt_archive"):
+                    status = read_archive(c, DPKG_STATUS_PATH).get("status", "")
+                    lists = read_archive(c, APT_LISTS_PATH)
+                available = {}
+                for name, text in lists.items():
+                    if name.endswith("_Packages"):
+                        parse_available(text, available)
+                results = upgrades(parse_installed(status), available, packages)
+            self.container_packages[key] = results
+        return self.container_packages[key]
+
+    def discovery(self, session, package, arch, current, latest, foreign=False, container=None):
+        # multiarch installs of a package need their own entity
+        name = "%s_%s" % (package, arch) if foreign else package
+        name = UNSAFE_NAME_RE.sub("_", "%s_%s" % (container, name) if container else name)
+        return Discovery(
+            self,
+            name,
+            session,
+            current_version=current,
+            latest_version=latest,
+            title_template=(
+                "Apt package update for {name} in %s on {node}" % container
+                if container
+                else "Apt package update for {name} on {node}"
+            ),
+            device_icon=self.cfg.device_icon,
+            can_update=False,
+            custom=AptFields(package=package, architecture=arch, container=container),
+        )
+
+    def host_discoveries(self, session: str):
+        with REGISTRY.timer("analyze_seconds", phase="apt"):
+            return [self.discovery(session, *upgrade) for upgrade in self.host_upgrades()]
+
+    def container_discoveries(self, c, session: str):
+        try:
+            return [
+                self.discovery(session, *upgrade, container=c.name)
+                for upgrade in self.container_upgrades(c)
+            ]
+        except Exception as e:
+            self.log.warn("Container packages unavailable: %s", e, container=c.name)
+            return []
+
+    async def scan(self, session: str):
+        slog = self.log.bind(session=session, action="scan")
+        loop = asyncio.get_running_loop()
+        pending = []
+        if self.cfg.host:
+            pending.append(loop.run_in_executor(None, self.host_discoveries, session))
+        if self.cfg.containers:
+            try:
+                if self.client is None:
+                    self.client = docker.from_env()
+                containers = await loop.run_in_executor(
+                    None, lambda: self.client.containers.list(sparse=True)
+                )
+            except docker.errors.DockerException as e:
+                slog.warn("Unable to list containers: %s", e)
+                containers = []
+            current_ids = {c.id for c in containers}
+            self.container_packages = {
+                key: results
+                for key, results in self.container_packages.items()
+                if key[0] in current_ids
+            }
+            pending.extend(
+                loop.run_in_executor(None, self.container_discoveries, c, session)
+                for c in containers
+            )
+        results = 0
+        for next_done in asyncio.as_completed(pending):
+            for discovery in await next_done:
+                self.discoveries[discovery.name] = discovery
+                results += 1
+                yield discovery
+        slog.info("Completed", result_count=results, parses=self.cache.parses)
+
+    def restore(self, records):
+        restored = super().restore(records)
+        for discovery in restored:
+            self.discoveries.setdefault(discovery.name, discovery)
+        return restored
+
+    def rescan(self, discovery: Discovery, refresh=False):
+        container = discovery.custom.container
+        if container is None:
+            candidates = self.host_discoveries(discovery.session)
+        else:
+            try:
+                c = self.client.containers.get(container)
+            except docker.errors.NotFound:
+                return None
+            if refresh:
+                self.container_packages.pop(container_key(c), None)
+            candidates = self.container_discoveries(c, discovery.session)
+        for candidate in candidates:
+            if candidate.name == discovery.name:
+                self.discoveries[candidate.name] = candidate
+                return candidate
+
+    def command(self, discovery_name, command, on_update_start, on_update_end):
+        self.log.warn("Apt packages are reported only, ignoring command", command=command)
+        return False
+
+    def hass_state_format(self, discovery):
+        return {
+            "apt_package": discovery.custom.package,
+            "apt_architecture": discovery.custom.architecture,
+            "container": discovery.custom.container,
+        }
@@ -1,13 +1,28 @@
+import asyncio
+from collections import defaultdict
+from dataclasses import dataclass, replace
+import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 import docker
-from config import DockerConfig, UpdateInfoConfig
+from config import DockerConfig, DockerHostConfig, PackageIndex
 from docker.models.containers import Container
 import os.path
+import re
+from typing import Optional
+from urllib.parse import urlparse
 import structlog
-from model import Discovery, ReleaseProvider
+from metrics import REGISTRY
+from model import CustomFields, Discovery, ReleaseProvider
 import subprocess
+import threading
 import time
+from integrations.registry import MANIFEST_LIST_TYPES, RegistryClient
+from integrations.registry_cache import RegistryDigestCache
 from integrations.git_utils import (
+    git_cached_update_available,
     git_check_update_available,
+    git_check_updates,
     git_pull,
     git_timestamp,
     git_trust,
@@ -17,46 +32,236 @@ from integrations.git_utils import (
 
 log = structlog.get_logger()
 
+# Home Assistant only accepts these in a discovery topic's node id
+UNSAFE_NODE_RE = re.compile(r"[^A-Za-z0-9_-]")
+
+EVENT_FILTERS = {
+    "type": ["container", "image"],
+    "event": ["create", "start", "stop", "die", "destroy", "pull", "tag"],
+}
+EVENT_RECONNECT_DELAY = 30
+
+
+
+def registry_host(image_ref: str):
+    first = image_ref.split("/")[0]
+    if "/" in image_ref and ("." in first or ":" in first or first == "localhost"):
+        return first
+    return "docker.io"
+
+
+def container_name(c: Container):
+    # sparse container listings carry Names rather than Name
+    if c.name:
+        return c.name
+    names = c.attrs.get("Names")
+    return names[0].lstrip("/") if names else None
+
+
+def parse_interval(value: str):
+    """Seconds from an int, optionally suffixed with s, m, h or d"""
+    if not value:
+        return None
+    try:
+        units = {"s": 1, "m": 60, "h": 60 * 60, "d": 60 * 60 * 24}
+        if value[-1].lower() in units:
+            return int(value[:-1]) * units[value[-1].lower()]
+        return int(value)
+    except (TypeError, ValueError):
+        log.warn("Invalid scan interval: %s", value)
+
+
+def host_node_name(url: str):
+    """Node name derived from a docker host url, or None for one without a host name"""
+    hostname = urlparse(url).hostname
+    return hostname and UNSAFE_NODE_RE.sub("_", hostname)
+
+
+def git_full_path(compose_path: str, git_repo_path: str):
+    if compose_path and not os.path.isabs(git_repo_path):
+        return os.path.join(compose_path, git_repo_path)
+    return git_repo_path
+
+
+def progress_for(discoveries, on_update_start):
+    """Pull progress callback, reporting to each discovery waiting on the pull"""
+
+    def on_progress(percent: int):
+        for discovery in discoveries:
+            on_update_start(discovery, progress=percent)
+
+    return on_progress
+
+
 safe_json_dt = lambda t: time.strftime("%Y-%m-%dT%H:%M:%S.0000", time.gmtime(t)) if t else None
 
 
+@dataclass(slots=True, frozen=True)
+class DockerFields(CustomFields):
+    platform: Optional[str] = None
+    image_ref: Optional[str] = None
+    compose_path: Optional[str] = None
+    compose_version: Optional[str] = None
+    git_repo_path: Optional[str] = None
+    apt_pkgs: Optional[str] = None
+    git_local_timestamp: Optional[datetime.datetime] = None
+    git_update_available: Optional[bool] = None
+
+
 class DockerProvider(ReleaseProvider):
-    def __init__(self, cfg: DockerConfig, common_pkg_cfg: UpdateInfoConfig):
-        self.client = docker.from_env()
+    custom_type = DockerFields
+    supports_install_all = True
+
+    def __init__(
+        self,
+        cfg: DockerConfig,
+        pkg_index: PackageIndex,
+        host: DockerHostConfig = None,
+        registry_cache: RegistryDigestCache = None,
+    ):
+        self.host = host
+        self.node_name = None if host is None else host.node or host_node_name(host.url)
+        # compose and git run here, against paths that only exist on the docker host
+        self.local = host is None or urlparse(host.url).scheme == "unix"
+        self.supports_install_all = self.local
+        self.docker_client = None
+        self.client_lock = threading.Lock()
         self.cfg = cfg
-        self.common_pkgs = common_pkg_cfg.common_packages
+        self.pkg_index = pkg_index
         self.source_type = "docker"
         self.discoveries = {}
-        self.log = structlog.get_logger().bind(integration="docker")
-
-    def update(self, discovery: Discovery):
-        log = self.log.bind(container=discovery.name, action="update")
-        log.info("Updating - last at %s", discovery.update_last_attempt)
-        discovery.update_last_attempt = time.time()
-        self.fetch(discovery)
-        restarted = self.restart(discovery)
-        log.info("Updated - recorded at %s", discovery.update_last_attempt)
+        self.session = None
+        self.event_stream = None
+        self.watching = threading.Event()
+        self.compose_locks = defaultdict(threading.Lock)
+        self.pulls = {}
+        self.pulls_lock = threading.Lock()
+        self.inspections = {}
+        self.git_due = set()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, cfg.scan_workers), thread_name_prefix="docker_scan"
+        )
+        self.registry_cache = registry_cache or RegistryDigestCache(
+            ttl=cfg.registry_cache_ttl,
+            max_size=cfg.registry_cache_size,
+            path=cfg.registry_cache_path,
+        )
+        self.registry_client = None
+        if cfg.registry_client == "http":
+            self.registry_client = RegistryClient(
+                timeout=cfg.registry_timeout,
+                insecure_registries=cfg.insecure_registries,
+                pool_size=cfg.scan_workers,
+            )
+        self.log = structlog.get_logger().bind(integration="docker", node=self.node_name)
+
+    @property
+    def client(self):
+        """Docker client, created on first use so startup doesn't wait on the daemon"""
+        if self.docker_client is None:
+            with self.client_lock:
+                if self.docker_client is None:
+                    if self.host is None:
+                        self.docker_client = docker.from_env()
+                    else:
+                        self.docker_client = docker.DockerClient(
+                            base_url=self.host.url,
+                            tls=self.host.tls,
+                            use_ssh_client=self.host.use_ssh_client,
+                        )
+        return self.docker_client
+
+    def update(self, discovery: Discovery, on_update_start=None):
+        return self.update_project([discovery], on_update_start=on_update_start)
+
+    def update_project(self, discoveries, on_update_start=None):
+        """Fetch and restart containers from one compose project, each image or build once"""
+        compose_path = discoveries[0].custom.compose_path
+        log = self.log.bind(
+            containers=[d.name for d in discoveries], compose_path=compose_path, action="update"
+        )
+        with self.compose_lock(compose_path):
+            for discovery in discoveries:
+                log.info("Updating %s - last at %s", discovery.name, discovery.update_last_attempt)
+                discovery.update_last_attempt = time.time()
+            self.fetch(discoveries, on_update_start=on_update_start)
+            restarted = self.restart(discoveries[0])
+        log.info("Updated")
         return restarted
 
-    def fetch(self, discovery: Discovery):
-        log = self.log.bind(container=discovery.name, action="fetch")
-        git_repo_path = discovery.custom.get("git_repo_path")
-        compose_path = discovery.custom.get("compose_path")
-        image_ref = discovery.custom.get("image_ref")
-        platform = discovery.custom.get("platform")
-        if git_repo_path:
-            if compose_path and not os.path.isabs(git_repo_path):
-                full_repo_path = os.path.join(compose_path, git_repo_path)
-            else:
-                full_repo_path = git_repo_path
+    def compose_lock(self, compose_path: str):
+        """Serialize builds and restarts within one compose project"""
+        if not compose_path:
+            return nullcontext()
+        return self.compose_locks[compose_path]
+
+    def fetch(self, discoveries, on_update_start=None):
+        """Pull each image or build each git repo once, reporting pull progress per container"""
+        log = self.log.bind(action="fetch")
+        compose_path = discoveries[0].custom.compose_path
+        repo_paths = {}
+        images = defaultdict(list)
+        for discovery in discoveries:
+            if discovery.custom.git_repo_path:
+                full_repo_path = git_full_path(compose_path, discovery.custom.git_repo_path)
+                repo_paths.setdefault(full_repo_path, discovery)
+            elif discovery.custom.image_ref:
+                images[(discovery.custom.image_ref, discovery.custom.platform)].append(discovery)
+        for full_repo_path in repo_paths:
             if git_check_update_available(full_repo_path):
                 git_pull(full_repo_path)
-            self.build(discovery, compose_path)
-        elif image_ref:
+        if repo_paths:
+            self.build(next(iter(repo_paths.values())), compose_path)
+        for (image_ref, platform), waiting in images.items():
             log.info("Pulling", image_ref=image_ref, platform=platform)
-            image = self.client.images.pull(image_ref, platform=platform)
+            image = self.pull(
+                image_ref,
+                platform,
+                on_progress=on_update_start and progress_for(waiting, on_update_start),
+            )
             log.info("Pulled", image_id=image.id)
 
+    def pull(self, image_ref: str, platform: str, on_progress=None):
+        """Pull image_ref, joining any pull of the same image already under way
+
+        Progress is reported as a percentage, at most every `pull_progress_interval`
+        seconds, to everyone waiting on the pull
+        """
+        key = (image_ref, platform)
+        with self.pulls_lock:
+            pull = self.pulls.get(key)
+            joining = pull is not None
+            if not joining:
+                pull = self.pulls[key] = ImagePull(self.cfg.pull_progress_interval)
+            if on_progress:
+                pull.listeners.append(on_progress)
+        if joining:
+            self.log.info("Joining pull in progress", image_ref=image_ref, platform=platform)
+            return pull.future.result()
+        try:
+            image = self.stream_pull(image_ref, platform, pull)
+            pull.future.set_result(image)
+            return image
+        except Exception as e:
+            pull.future.set_exception(e)
+            raise
+        finally:
+            with self.pulls_lock:
+                del self.pulls[key]
+
+    def stream_pull(self, image_ref: str, platform: str, pull: "ImagePull"):
+        repository, tag = docker.utils.parse_repository_tag(image_ref)
+        with REGISTRY.timer("pull_seconds"):
+            for event in self.client.api.pull(
+                repository, tag=tag or "latest", platform=platform or None, stream=True, decode=True
+            ):
+                if "error" in event:
+                    raise docker.errors.APIError(event["error"])
+                pull.update(event)
+        if pull.reported != 100:
+            pull.report(100)
+        return self.client.images.get(image_ref)
+
     def build(self, discovery: Discovery, compose_path: str):
         log = self.log.bind(container=discovery.name, action="build")
         log.info("Building")
@@ -72,7 +277,7 @@ class DockerProvider(ReleaseProvider):
 
     def restart(self, discovery: Discovery):
         log = self.log.bind(container=discovery.name, action="restart")
-        compose_path = discovery.custom.get("compose_path")
+        compose_path = discovery.custom.compose_path
         if compose_path:
             log.info("Restarting")
             proc = subprocess.run(
@@ -87,149 +292,455 @@ class DockerProvider(ReleaseProvider):
                     proc.returncode,
                 )
 
-    def rescan(self, discovery: Discovery):
+    def restore(self, records):
+        restored = super().restore(records)
+        for discovery in restored:
+            self.discoveries.setdefault(discovery.name, discovery)
+        return restored
+
+    def rescan(self, discovery: Discovery, refresh=False):
+        """Analyze discovery's container again, bypassing the registry cache if refresh"""
         log = self.log.bind(container=discovery.name, action="rescan")
-        c = self.client.containers.get(discovery.name)
+        try:
+            c = self.client.containers.get(discovery.name)
+        except docker.errors.NotFound:
+            c = None
         if c:
-            return self.analyze(c, discovery.session, original_discovery=discovery)
+            if refresh and discovery.custom.image_ref:
+                self.registry_cache.invalidate(discovery.custom.image_ref)
+            if refresh and discovery.custom.git_repo_path:
+                git_check_update_available(
+                    git_full_path(discovery.custom.compose_path, discovery.custom.git_repo_path),
+                    timeout=self.cfg.git_check_budget,
+                    max_age=self.cfg.git_check_ttl,
+                )
+            result = self.analyze(c, discovery.session, original_discovery=discovery)
+            if result:
+                self.discoveries[result.name] = result
+            return result
         else:
             log.warn("Unable to find container for rescan")
 
-    def analyze(self, c: Container, session: str, original_discovery=None):
-        log = self.log.bind(container=c.name, action="analyze")
+    def inspect(self, c: Container):
+        """Static facts about a container and its image, cached by container and image id
+
+        Only a changed or recreated container pays for the container and image inspection
+        """
+        key = (c.id, c.attrs.get("ImageID") or c.attrs.get("Image"))
+        cached = self.inspections.get(key)
+        if cached is not None:
+            return cached
+
+        with REGISTRY.timer("analyze_seconds", phase="inspect"):
+            if "Config" not in c.attrs:
+                # sparse listing, fetch full container details
+                c.reload()
+            image = c.image
+        log = self.log.bind(container=c.name, action="inspect")
         try:
-            image_ref = c.image.tags[0]
+            image_ref = image.tags[0]
             image_name = image_ref.split(":")[0]
         except:
             log.warn("No tags found")
             image_ref = None
             image_name = None
         try:
-            local_versions = [ i.split("@")[1][7:19] for i in c.image.attrs["RepoDigests"] ]
+            local_digests = [ i.split("@")[1] for i in image.attrs["RepoDigests"] ]
+            local_versions = [ d[7:19] for d in local_digests ]
         except Exception as e:
             log.warn("Cannot determine local version: %s", e)
-            log.warn("RepoDigests=%s", c.image.attrs.get("RepoDigests"))
-            local_versions = None
+            log.warn("RepoDigests=%s", image.attrs.get("RepoDigests"))
+            local_digests = local_versions = None
 
         relnotes_url = None
         picture_url = self.cfg.default_entity_picture_url
 
-        for pkg in self.common_pkgs.values():
-            if (
-                pkg.docker is not None
-                and pkg.docker.image_name is not None
-                and pkg.docker.image_name == image_name
-            ):
-                picture_url = pkg.logo_url
-                relnotes_url = pkg.release_notes_url
+        pkg = self.pkg_index.lookup(image_name)
+        if pkg is not None:
+            picture_url = pkg.logo_url
+            relnotes_url = pkg.release_notes_url
 
         env_override = (
             lambda env_var, default: default
             if c_env.get(env_var) is None
             else c_env.get(env_var)
         )
-        try:
-            env_str = c.attrs["Config"]["Env"]
-            c_env = dict(env.split("=") for env in env_str if "==" not in env)
-            picture_url = env_override("REL2MQTT_PICTURE", picture_url)
-            relnotes_url = env_override("REL2MQTT_RELNOTES", relnotes_url)
+        env_str = c.attrs["Config"]["Env"]
+        c_env = dict(env.split("=") for env in env_str if "==" not in env)
+
+        if c_env.get("REL2MQTT_UPDATE") == "AUTO":
+            log.debug("Auto update policy detected")
+            update_policy = "Auto"
+        else:
+            update_policy = "Passive"
 
-            platform = "/".join(
+        inspection = {
+            "name": c.name,
+            "image_ref": image_ref,
+            "local_versions": local_versions,
+            "local_digests": local_digests,
+            "picture_url": env_override("REL2MQTT_PICTURE", picture_url),
+            "relnotes_url": env_override("REL2MQTT_RELNOTES", relnotes_url),
+            "platform": "/".join(
                 filter(
                     None,
                     [
-                        c.image.attrs["Os"],
-                        c.image.attrs["Architecture"],
-                        c.image.attrs.get("Variant"),
+                        image.attrs["Os"],
+                        image.attrs["Architecture"],
+                        image.attrs.get("Variant"),
                     ],
                 )
-            )
+            ),
+            "compose_path": c.labels.get("com.docker.compose.project.working_dir"),
+            "compose_version": c.labels.get("com.docker.compose.version"),
+            "git_repo_path": c_env.get("REL2MQTT_GIT_REPO_PATH"),
+            "apt_pkgs": c_env.get("REL2MQTT_APT_PKGS"),
+            "update_policy": update_policy,
+            "scan_interval": parse_interval(
+                c_env.get("REL2MQTT_SCAN_INTERVAL")
+                or c.labels.get("rel2mqtt.scan_interval")
+            ),
+        }
+        if key[1] is not None:
+            self.inspections[key] = inspection
+        return inspection
+
+    def analyze(self, c: Container, session: str, original_discovery=None, when_due=False):
+        """Discovery for a container, checking the registry for the latest version
+
+        If when_due, the latest version of an unchanged image is taken from
+        original_discovery until the scheduler has it due a check, and git repos
+        due a check are noted in `git_due` for check_git_repos
+        """
+        log = self.log.bind(container=container_name(c), action="analyze")
+        try:
+            inspection = self.inspect(c)
+            image_ref = inspection["image_ref"]
+            local_versions = inspection["local_versions"]
+            platform = inspection["platform"]
 
-            reg_data = None
             latest_version = local_version = 'Unknown'
-            
-            if image_ref and local_versions:
-                retries_left = 3
-                while reg_data is None and retries_left > 0:
-                    try:
-                        reg_data = self.client.images.get_registry_data(image_ref)
-                        latest_version = reg_data and reg_data.short_id[7:]
-                    except Exception as e:
-                        retries_left -= 1
-                        if retries_left == 0:
-                            log.warn("Failed to fetch registry data")
-                        else:
-                            log.debug("Failed to fetch registry data, retrying")
+            up_to_date = False
+            # decided before yielding, as the scheduler reschedules what scans yield
+            due = original_discovery is None or self.due(original_discovery)
+
+            if (
+                when_due
+                and not due
+                and original_discovery.custom.image_ref == image_ref
+                and original_discovery.current_version in (local_versions or ())
+            ):
+                latest_version = original_discovery.latest_version
+                up_to_date = latest_version == original_discovery.current_version
+                local_versions = [original_discovery.current_version]
+            elif image_ref and local_versions and self.registry_client is not None:
+                digest = self.latest_digest(image_ref, platform, inspection["local_digests"])
+                if digest:
+                    latest_version = digest[7:19]
+                    up_to_date = digest in inspection["local_digests"]
+            elif image_ref and local_versions:
+                short_id = self.registry_cache.get(
+                    image_ref, platform, self.fetch_registry_short_id
+                )
+                if short_id:
+                    latest_version = short_id[7:]
+                    # the docker api only gives a short id to compare
+                    up_to_date = latest_version in local_versions
 
             if local_versions:
                 # might be multiple RepoDigests if image has been pulled multiple times with diff manifests
-                if latest_version in local_versions:
+                if up_to_date:
                     local_version = latest_version
                 else:
                     local_version = local_versions[0]
                     
             image_ref = image_ref or ""
-            compose_path = c.labels.get("com.docker.compose.project.working_dir")
-
-            custom = {}
-            custom["platform"] = platform
-            custom["image_ref"] = image_ref
-            custom["compose_path"] = compose_path
-            custom["compose_version"] = c.labels.get("com.docker.compose.version")
-            custom["git_repo_path"] = c_env.get("REL2MQTT_GIT_REPO_PATH")
-            custom["apt_pkgs"] = c_env.get("REL2MQTT_APT_PKGS")
-
-            if c_env.get("REL2MQTT_UPDATE") == "AUTO":
-                log.debug("Auto update policy detected")
-                update_policy = "Auto"
-            else:
-                update_policy = "Passive"
+            compose_path = inspection["compose_path"]
 
-            if custom["git_repo_path"]:
-                full_repo_path = os.path.join(compose_path, custom["git_repo_path"])
-                git_trust(full_repo_path)
-                custom["git_local_timestamp"] = git_timestamp(full_repo_path)
-            can_update = (
+            git_repo_path = inspection["git_repo_path"]
+            git_local_timestamp = git_update_available = None
+            if git_repo_path:
+                full_repo_path = git_full_path(compose_path, git_repo_path)
+                with REGISTRY.timer("analyze_seconds", phase="git"):
+                    git_trust(full_repo_path)
+                    git_local_timestamp = git_timestamp(full_repo_path)
+                # remotes are checked by check_git_repos, not once per container here
+                git_update_available = git_cached_update_available(full_repo_path)
+                if when_due and due:
+                    self.git_due.add(full_repo_path)
+            can_update = self.local and (
                 (self.cfg.allow_pull and image_ref)
                 or (self.cfg.allow_restart and compose_path)
-                or (self.cfg.allow_build and custom["git_repo_path"])
+                or (self.cfg.allow_build and git_repo_path)
             )
             return Discovery(
                 self,
-                c.name,
+                inspection["name"],
                 session,
-                entity_picture_url=picture_url,
-                release_url=relnotes_url,
+                entity_picture_url=inspection["picture_url"],
+                release_url=inspection["relnotes_url"],
                 current_version=local_version,
-                update_policy=update_policy,
+                update_policy=inspection["update_policy"],
                 update_last_attempt=original_discovery and original_discovery.update_last_attempt or None,
                 latest_version=latest_version if latest_version !='Unknown' else local_version,
                 title_template="Docker image update for {name} on {node}",
                 device_icon=self.cfg.device_icon,
                 can_update=can_update,
                 status=c.status == "running" and "on" or "off",
-                custom=custom,
+                scan_interval=inspection["scan_interval"],
+                custom=DockerFields(
+                    platform=platform,
+                    image_ref=image_ref,
+                    compose_path=compose_path,
+                    compose_version=inspection["compose_version"],
+                    git_repo_path=git_repo_path,
+                    apt_pkgs=inspection["apt_pkgs"],
+                    git_local_timestamp=git_local_timestamp,
+                    git_update_available=git_update_available,
+                ),
             )
         except Exception as e:
             log.error("ERROR %s", e, exc_info=1, container_attrs=c.attrs)
 
+    def due(self, discovery: Discovery):
+        return self.is_due is None or self.is_due(discovery)
+
+    def check_git_repos(self, session: str, repo_paths):
+        """Check the remotes of repo_paths all at once, for a scan that found them
+
+        Returns the scan's discoveries whose update availability changed
+        """
+        repo_discoveries = defaultdict(list)
+        for d in self.discoveries.values():
+            if d.session == session and d.custom.git_repo_path:
+                full_repo_path = git_full_path(d.custom.compose_path, d.custom.git_repo_path)
+                if full_repo_path in repo_paths:
+                    repo_discoveries[full_repo_path].append(d)
+        if not repo_discoveries:
+            return []
+        with REGISTRY.timer("analyze_seconds", phase="git_remote"):
+            git_check_updates(
+                repo_discoveries,
+                budget=self.cfg.git_check_budget,
+                max_age=self.cfg.git_check_ttl,
+            )
+        changed = []
+        for full_repo_path, discoveries in repo_discoveries.items():
+            available = git_cached_update_available(full_repo_path)
+            for d in discoveries:
+                if d.custom.git_update_available != available:
+                    changed.append(
+                        replace(d, custom=replace(d.custom, git_update_available=available))
+                    )
+        return changed
+
+    def fetch_registry_short_id(self, image_ref: str):
+        reg_data = self.fetch_registry(image_ref, self.client.images.get_registry_data)
+        return reg_data and reg_data.short_id
+
+    def fetch_registry_head(self, image_ref: str):
+        return self.fetch_registry(image_ref, self.registry_client.head_digest)
+
+    def fetch_registry(self, image_ref: str, fetch):
+        log = self.log.bind(image_ref=image_ref, action="registry")
+        registry = registry_host(image_ref)
+        retries_left = 3
+        while retries_left > 0:
+            try:
+                with REGISTRY.timer("analyze_seconds", phase="registry", registry=registry):
+                    result = fetch(image_ref)
+                REGISTRY.inc("registry_fetch_total", registry=registry, result="ok")
+                return result
+            except Exception:
+                REGISTRY.inc("registry_fetch_total", registry=registry, result="error")
+                retries_left -= 1
+                if retries_left == 0:
+                    log.warn("Failed to fetch registry data")
+                else:
+                    log.debug("Failed to fetch registry data, retrying")
+
+    def latest_digest(self, image_ref: str, platform: str, local_digests):
+        """Registry digest to compare in full with the local image's RepoDigests
+
+        The manifest list digest from a HEAD request is enough when it matches the
+        local image. Otherwise the platform's own manifest is looked up in both the
+        registry's list and the lists the local RepoDigests name, so a list updated
+        only for other platforms returns the matching local digest
+        """
+        head = self.registry_cache.get(image_ref, platform, self.fetch_registry_head)
+        if head is not None and not isinstance(head, dict):
+            # cached by the docker api client before a switch of registry_client
+            self.registry_cache.invalidate(image_ref)
+            head = self.registry_cache.get(image_ref, platform, self.fetch_registry_head)
+        if head is None:
+            return None
+        if head["digest"] in local_digests or head["media_type"] not in MANIFEST_LIST_TYPES:
+            return head["digest"]
+        platform_digest = self.platform_digest(image_ref, head["digest"], platform)
+        if platform_digest is None:
+            return head["digest"]
+        for local_digest in local_digests:
+            # an image pulled by platform digest names the platform manifest itself
+            if local_digest == platform_digest or platform_digest == self.platform_digest(
+                image_ref, local_digest, platform
+            ):
+                return local_digest
+        return head["digest"]
+
+    def platform_digest(self, image_ref: str, index_digest: str, platform: str):
+        try:
+            return self.registry_client.platform_digest(image_ref, index_digest, platform)
+        except Exception as e:
+            self.log.warn("Unable to resolve platform digest for %s: %s", image_ref, e)
+
     async def scan(self, session: str):
+        """Analyze all containers in the worker pool, yielding discoveries as they complete"""
         log = self.log.bind(session=session, action="scan")
-        containers=results=0
-        for c in self.client.containers.list():
-            containers=containers+1
-            result = self.analyze(c, session)
-            if result:
-                self.discoveries[result.name] = result
-                results=results+1
-                yield result
-        log.info('Completed',container_count=containers,result_count=results)
+        self.session = session
+        self.git_due = set()
+        loop = asyncio.get_running_loop()
+        containers = await loop.run_in_executor(
+            self.executor, lambda: self.client.containers.list(sparse=True)
+        )
+        current_ids = {c.id for c in containers}
+        self.inspections = {
+            key: inspection for key, inspection in self.inspections.items() if key[0] in current_ids
+        }
+        results = 0
+        pending = [
+            loop.run_in_executor(
+                self.executor,
+                self.analyze,
+                c,
+                session,
+                self.discoveries.get(container_name(c)),
+                True,
+            )
+            for c in containers
+        ]
+        try:
+            for next_done in asyncio.as_completed(pending):
+                result = await next_done
+                if result:
+                    self.discoveries[result.name] = result
+                    results = results + 1
+                    yield result
+        finally:
+            for future in pending:
+                future.cancel()
+        # analysis used the last known remote state, so republish what the check changed
+        for result in await loop.run_in_executor(
+            self.executor, self.check_git_repos, session, self.git_due
+        ):
+            self.discoveries[result.name] = result
+            yield result
+        self.registry_cache.save()
+        log.info(
+            "Completed",
+            container_count=len(containers),
+            result_count=results,
+            **self.registry_cache.stats()
+        )
+
+    async def watch(self):
+        """Rescan containers affected by docker daemon events, yielding the results"""
+        if not self.cfg.watch_events:
+            return
+        log = self.log.bind(action="watch")
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        self.watching.set()
+        listener = threading.Thread(
+            target=self.listen_events, args=(loop, events), daemon=True, name="docker_events"
+        )
+        listener.start()
+        try:
+            while True:
+                batch = [await events.get()]
+                # let bursts like create/start or pull/tag settle before rescanning
+                await asyncio.sleep(self.cfg.events_debounce)
+                while not events.empty():
+                    batch.append(events.get_nowait())
+                targets = self.event_targets(batch)
+                log.debug("Handling events", event_count=len(batch), targets=targets)
+                for target in targets:
+                    result = await loop.run_in_executor(
+                        self.executor, self.rescan_container, target
+                    )
+                    if result:
+                        yield result
+        finally:
+            self.watching.clear()
+            if self.event_stream is not None:
+                self.event_stream.close()
+
+    def listen_events(self, loop, events: asyncio.Queue):
+        log = self.log.bind(action="events")
+        while self.watching.is_set():
+            try:
+                self.event_stream = self.client.events(decode=True, filters=EVENT_FILTERS)
+                log.info("Listening for docker events")
+                for event in self.event_stream:
+                    loop.call_soon_threadsafe(events.put_nowait, event)
+            except Exception as e:
+                log.warn("Docker event stream failed: %s", e)
+            if self.watching.is_set():
+                time.sleep(EVENT_RECONNECT_DELAY)
+
+    def event_targets(self, batch):
+        """Reduce a batch of docker events to the container ids or names needing rescan"""
+        targets = []
+        image_refs = set()
+        for event in batch:
+            actor = event.get("Actor", {})
+            if event.get("Type") == "container":
+                name = actor.get("Attributes", {}).get("name")
+                if event.get("Action") == "destroy":
+                    if name in self.discoveries:
+                        self.log.info("Container removed", container=name)
+                        del self.discoveries[name]
+                    if actor.get("ID") in targets:
+                        targets.remove(actor.get("ID"))
+                elif actor.get("ID") and actor.get("ID") not in targets:
+                    targets.append(actor.get("ID"))
+            elif event.get("Type") == "image":
+                for ref in (actor.get("ID"), actor.get("Attributes", {}).get("name")):
+                    if ref and not ref.startswith("sha256:"):
+                        image_refs.add(ref)
+        for image_ref in image_refs:
+            self.registry_cache.invalidate(image_ref)
+        for discovery in list(self.discoveries.values()):
+            image_ref = discovery.custom.image_ref
+            if (
+                image_ref
+                and (image_ref in image_refs or image_ref.split(":")[0] in image_refs)
+                and discovery.name not in targets
+            ):
+                targets.append(discovery.name)
+        return targets
+
+    def rescan_container(self, container_id: str):
+        log = self.log.bind(container=container_id, action="rescan")
+        try:
+            c = self.client.containers.get(container_id)
+        except docker.errors.NotFound:
+            log.debug("Container no longer present")
+            return None
+        result = self.analyze(
+            c, self.session, original_discovery=self.discoveries.get(container_name(c))
+        )
+        if result:
+            self.discoveries[result.name] = result
+        return result
 
     def command(self, discovery_name, command, on_update_start, on_update_end):
         log = self.log.bind(container=discovery_name, action="command", command=command)
         log.info("Executing")
         updated = False
+        discovery = None
         try:
+            if command == "install_all":
+                return self.install_all(on_update_start, on_update_end)
             discovery = self.discoveries.get(discovery_name)
             if not discovery:
                 log.warn("Unknown entity",entity=discovery_name)
@@ -239,7 +750,7 @@ class DockerProvider(ReleaseProvider):
                 if discovery.can_update:
                     log.info("Starting update ...")
                     on_update_start(discovery)
-                    if self.update(discovery):
+                    if self.update(discovery, on_update_start=on_update_start):
                         log.info("Rescanning ...")
                         updated = self.rescan(discovery)
                         log.info("Rescanned %s", updated)
@@ -252,8 +763,98 @@ class DockerProvider(ReleaseProvider):
                 on_update_end(discovery)
         return updated
 
+    def install_all(self, on_update_start, on_update_end):
+        """Update all containers with an update pending, once per compose project
+
+        Projects are updated in parallel, up to `batch_update_workers` at a time
+        """
+        pending = [
+            d
+            for d in self.discoveries.values()
+            if d.can_update
+            and (d.current_version != d.latest_version or d.custom.git_update_available)
+        ]
+        projects = defaultdict(list)
+        for discovery in pending:
+            if discovery.custom.compose_path:
+                projects[("compose", discovery.custom.compose_path)].append(discovery)
+            else:
+                projects[("container", discovery.name)].append(discovery)
+        self.log.info("Updating all", containers=len(pending), projects=len(projects))
+        for discovery in pending:
+            on_update_start(discovery)
+
+        def run_project(discoveries):
+            try:
+                restarted = self.update_project(discoveries, on_update_start=on_update_start)
+            except Exception as e:
+                self.log.error("Project update failed: %s", e, exc_info=1)
+                restarted = False
+            results = []
+            for discovery in discoveries:
+                result = self.rescan(discovery) if restarted else None
+                if result:
+                    results.append(result)
+                else:
+                    on_update_end(discovery)
+            return results
+
+        updated = []
+        with ThreadPoolExecutor(
+            max_workers=max(1, self.cfg.batch_update_workers), thread_name_prefix="docker_update"
+        ) as pool:
+            for results in pool.map(run_project, projects.values()):
+                updated.extend(results)
+        return updated
+
     def hass_state_format(self, discovery):
         return {
-            "docker_image_ref": discovery.custom.get("image_ref"),
+            "docker_image_ref": discovery.custom.image_ref,
+            "git_update_available": discovery.custom.git_update_available,
             "last_update_attempt": safe_json_dt(discovery.update_last_attempt),
         }
+
+
+class ImagePull:
+    """Progress of one streaming pull, aggregated over its layers
+
+    Each layer counts once, half for download and half for extraction, with layers
+    the daemon already has counted as complete
+    """
+
+    def __init__(self, interval: float = 2.0):
+        self.interval = interval
+        self.future = Future()
+        self.listeners = []
+        self.layers = {}
+        self.reported = None
+        self.reported_at = 0
+
+    def update(self, event):
+        layer = event.get("id")
+        status = event.get("status", "")
+        if not layer or layer == "latest" or status.startswith(("Pulling from", "Digest", "Status")):
+            return
+        detail = event.get("progressDetail") or {}
+        fraction = self.layers.get(layer, 0.0)
+        if status == "Downloading" and detail.get("total"):
+            fraction = 0.5 * detail.get("current", 0) / detail["total"]
+        elif status == "Download complete" or status == "Verifying Checksum":
+            fraction = 0.5
+        elif status == "Extracting" and detail.get("total"):
+            fraction = 0.5 + 0.5 * detail.get("current", 0) / detail["total"]
+        elif status in ("Pull complete", "Already exists"):
+            fraction = 1.0
+        self.layers[layer] = max(fraction, self.layers.get(layer, 0.0))
+        percent = int(100 * sum(self.layers.values()) / len(self.layers))
+        if percent != self.reported and time.time() - self.reported_at >= self.interval:
+            self.report(percent)
+
+    def report(self, percent: int):
+        self.reported = percent
+        self.reported_at = time.time()
+        for listener in list(self.listeners):
+            try:
+                listener(percent)
+            except Exception as e:
+                log.warn("Pull progress listener failed: %s", e)
@@ -1,54 +1,189 @@
-import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait
 import datetime
+import os
+import os.path
+import subprocess
+import threading
+import time
 import structlog
 
 log = structlog.get_logger()
 
-def git_trust(repo_path: str):  
+# never block a scan on a credential prompt for a remote
+GIT_ENV = {"GIT_TERMINAL_PROMPT": "0", "GIT_SSH_COMMAND": "ssh -o BatchMode=yes"}
+
+trusted_repos = set()
+trust_lock = threading.Lock()
+timestamps = {}
+upstreams = {}
+remote_checks = {}
+
+
+def git(repo_path: str, *args, timeout: int = 30):
+    return subprocess.run(
+        ["git", *args],
+        cwd=repo_path,
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+        env=dict(os.environ, **GIT_ENV),
+    )
+
+
+def git_trust(repo_path: str):
+    """Add repo to global safe.directory, once per process and only if not already there"""
+    with trust_lock:
+        if repo_path in trusted_repos:
+            return
+        try:
+            existing = git(repo_path, "config", "--global", "--get-all", "safe.directory")
+            safe_dirs = existing.stdout.split("\n")
+            if repo_path not in safe_dirs and "*" not in safe_dirs:
+                git(repo_path, "config", "--global", "--add", "safe.directory", repo_path)
+            trusted_repos.add(repo_path)
+        except Exception as e:
+            log.warn('GIT Unable to trust repo at %s: %s', repo_path, e)
+
+
+def git_head(repo_path: str):
+    """Current branch and commit, read from the ref files rather than a subprocess"""
+    git_dir = os.path.join(repo_path, ".git")
     try:
-        subprocess.run("git config --global --add safe.directory %s" % repo_path,shell=True,cwd=repo_path)
-    except Exception as e:
-        log.warn('GIT Unable to trust repo at %s: %s',repo_path,e)
-   
+        with open(os.path.join(git_dir, "HEAD")) as f:
+            head = f.read().strip()
+        if not head.startswith("ref: "):
+            return None, head
+        ref = head[5:]
+        branch = ref.removeprefix("refs/heads/")
+        ref_path = os.path.join(git_dir, ref)
+        if os.path.exists(ref_path):
+            with open(ref_path) as f:
+                return branch, f.read().strip()
+        with open(os.path.join(git_dir, "packed-refs")) as f:
+            for line in f:
+                if line.rstrip().endswith(" %s" % ref):
+                    return branch, line.split(" ")[0]
+        return branch, None
+    except Exception:
+        result = git(repo_path, "rev-parse", "--abbrev-ref", "HEAD", "HEAD")
+        if result.returncode != 0:
+            return None, None
+        branch, sha = result.stdout.split()
+        return (None if branch == "HEAD" else branch), sha
+
 
 def git_timestamp(repo_path: str):
-    result=None
+    result = None
     try:
-        result=subprocess.run("git log -1 --format=%cI --no-show-signature",
-                            cwd=repo_path,
-                            shell=True,
-                            text=True,
-                            capture_output=True)
-        return datetime.datetime.fromisoformat(result.stdout.strip())
+        _, sha = git_head(repo_path)
+        if sha and (repo_path, sha) in timestamps:
+            return timestamps[(repo_path, sha)]
+        result = git(repo_path, "log", "-1", "--format=%cI", "--no-show-signature")
+        timestamp = datetime.datetime.fromisoformat(result.stdout.strip())
+        if sha:
+            timestamps[(repo_path, sha)] = timestamp
+        return timestamp
     except Exception as e:
-        log.warn('GIT Unable to parse timestamp at %s - %s: %s',repo_path, result.stdout if result else '<NO RESULT>',e)
-    
+        log.warn('GIT Unable to parse timestamp at %s - %s: %s', repo_path, result.stdout if result else '<NO RESULT>', e)
+
+
+def git_upstream(repo_path: str, branch: str):
+    """Remote name and ref tracked by branch, cached per repo"""
+    key = (repo_path, branch)
+    if key not in upstreams:
+        remote = git(repo_path, "config", "--get", "branch.%s.remote" % branch).stdout.strip()
+        merge = git(repo_path, "config", "--get", "branch.%s.merge" % branch).stdout.strip()
+        upstreams[key] = (remote or "origin", merge or "refs/heads/%s" % branch)
+    return upstreams[key]
+
+
+def git_remote_head(repo_path: str, timeout: int = 120):
+    branch, _ = git_head(repo_path)
+    if branch is None:
+        return None
+    remote, ref = git_upstream(repo_path, branch)
+    result = git(repo_path, "ls-remote", remote, ref, timeout=timeout)
+    if result.returncode == 0 and result.stdout:
+        return result.stdout.split()[0]
 
-def git_check_update_available(repo_path:str, timeout: int=120):
-    result=None
+
+def git_contains(repo_path: str, sha: str):
+    """Whether HEAD already has commit sha, so the branch is ahead rather than behind
+
+    False when sha hasn't been fetched, as then the remote has commits HEAD lacks
+    """
+    return git(repo_path, "merge-base", "--is-ancestor", sha, "HEAD").returncode == 0
+
+
+def git_check_update_available(repo_path: str, timeout: int = 120, max_age: int = 0):
+    """Whether the remote's upstream branch head has commits local HEAD lacks
+
+    Results are cached per repo, and reused if younger than `max_age` seconds. A
+    failed check is cached too, keeping the last known result
+    """
+    cached = remote_checks.get(repo_path)
+    if cached and time.time() - cached[0] < max_age:
+        return cached[1]
+    result = None
     try:
-        result = subprocess.run(
-            "git status -uno",
-            capture_output=True,
-            text=True,
-            shell=True,
-            cwd=repo_path,
-            timeout=timeout,
-        )
-        if result.returncode == 0 and "Your branch is behind" in result.stdout:
-            return True
+        _, local_sha = git_head(repo_path)
+        remote_sha = git_remote_head(repo_path, timeout=timeout)
+        if local_sha and remote_sha:
+            result = local_sha != remote_sha and not git_contains(repo_path, remote_sha)
     except Exception as e:
-        log.warn('GIT Unable to check status %s: %s',result.stdout if result else '<NO RESULT>',e)
- 
-    
-def git_pull(repo_path:str):
-    log.info("GIT Pulling git at %s",repo_path)
-    proc = subprocess.run(
-        "git pull", shell=True, cwd=repo_path, timeout=300
-    )
+        log.warn('GIT Unable to check remote for %s: %s', repo_path, e)
+    if result is None:
+        git_check_failed(repo_path)
+        return cached and cached[1]
+    remote_checks[repo_path] = (time.time(), result)
+    return result
+
+
+def git_check_failed(repo_path: str):
+    """Hold off checking repo_path again until max_age, keeping its last known result"""
+    cached = remote_checks.get(repo_path)
+    remote_checks[repo_path] = (time.time(), cached and cached[1])
+
+
+def git_cached_update_available(repo_path: str):
+    """Last known result of git_check_update_available, without contacting the remote"""
+    cached = remote_checks.get(repo_path)
+    return cached and cached[1]
+
+
+def git_check_updates(repo_paths, budget: int = 30, workers: int = 8, max_age: int = 0):
+    """Check many repos against their remotes concurrently, within a time budget
+
+    Repos not answered within the budget are reported as None, and treated as
+    failed checks until `max_age`
+    """
+    results = {}
+    repo_paths = set(repo_paths)
+    if not repo_paths:
+        return results
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="git_check")
+    futures = {
+        pool.submit(git_check_update_available, path, budget, max_age): path
+        for path in repo_paths
+    }
+    done, _ = wait(futures, timeout=budget)
+    pool.shutdown(wait=False, cancel_futures=True)
+    for future, path in futures.items():
+        if future in done:
+            results[path] = future.result()
+        else:
+            git_check_failed(path)
+            results[path] = None
+    return results
+
+
+def git_pull(repo_path: str):
+    log.info("GIT Pulling git at %s", repo_path)
+    proc = git(repo_path, "pull", timeout=300)
+    remote_checks.pop(repo_path, None)
     if proc.returncode == 0:
         log.info("GIT pull at %s successful", repo_path)
         return True
     else:
-        log.warn("GIT pull at %s failed: %s",repo_path,proc.returncode)
-        return False
\ No newline at end of file
+        log.warn("GIT pull at %s failed: %s %s", repo_path, proc.returncode, proc.stderr)
+        return False
@@ -0,0 +1,142 @@
+import re
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import structlog
+
+log = structlog.get_logger()
+
+DOCKER_HUB = "registry-1.docker.io"
+MANIFEST_LIST_TYPES = (
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+)
+MANIFEST_TYPES = (
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+)
+ACCEPT = ", ".join(MANIFEST_LIST_TYPES + MANIFEST_TYPES)
+
+
+def parse_image_ref(image_ref: str):
+    """Split an image ref into registry host, repository and tag or digest"""
+    name, _, digest = image_ref.partition("@")
+    tag = None
+    if ":" in name.rsplit("/", 1)[-1]:
+        name, tag = name.rsplit(":", 1)
+    parts = name.split("/")
+    if len(parts) > 1 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        registry = parts[0]
+        repository = "/".join(parts[1:])
+    else:
+        registry = DOCKER_HUB
+        repository = name if len(parts) > 1 else "library/%s" % name
+    if registry == "docker.io":
+        registry = DOCKER_HUB
+    return registry, repository, digest or tag or "latest"
+
+
+class RegistryClient:
+    """Minimal OCI distribution client for manifest digests
+
+    Uses HEAD requests for the top level digest, and only fetches a manifest list
+    when the platform specific digest is needed. Connections are pooled and kept
+    alive per registry.
+    """
+
+    def __init__(self, timeout: int = 10, insecure_registries=(), pool_size: int = 4):
+        self.timeout = timeout
+        self.insecure_registries = set(insecure_registries)
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.tokens = {}
+        self.platform_digests = {}
+        self.lock = threading.Lock()
+        self.log = structlog.get_logger().bind(integration="registry")
+
+    def session(self, registry: str):
+        with self.lock:
+            session = self.sessions.get(registry)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[registry] = session
+            return session
+
+    def request(self, method: str, registry: str, repository: str, reference: str):
+        scheme = "http" if registry in self.insecure_registries else "https"
+        url = "%s://%s/v2/%s/manifests/%s" % (scheme, registry, repository, reference)
+        session = self.session(registry)
+        headers = {"Accept": ACCEPT}
+        token = self.tokens.get((registry, repository))
+        if token:
+            headers["Authorization"] = "Bearer %s" % token
+        response = session.request(method, url, headers=headers, timeout=self.timeout)
+        if response.status_code == 401:
+            token = self.authenticate(session, registry, repository, response)
+            if token:
+                headers["Authorization"] = "Bearer %s" % token
+                response = session.request(method, url, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def authenticate(self, session, registry: str, repository: str, challenge):
+        """Fetch an anonymous bearer token as directed by a 401 challenge"""
+        header = challenge.headers.get("WWW-Authenticate", "")
+        if not header.lower().startswith("bearer "):
+            return None
+        params = dict(re.findall(r'(\w+)="([^"]*)"', header))
+        realm = params.pop("realm", None)
+        if not realm:
+            return None
+        params.setdefault("scope", "repository:%s:pull" % repository)
+        response = session.get(realm, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        body = response.json()
+        token = body.get("token") or body.get("access_token")
+        self.tokens[(registry, repository)] = token
+        return token
+
+    def head_digest(self, image_ref: str):
+        """Top level manifest digest and media type, from a HEAD request"""
+        registry, repository, reference = parse_image_ref(image_ref)
+        response = self.request("HEAD", registry, repository, reference)
+        return {
+            "digest": response.headers.get("Docker-Content-Digest"),
+            "media_type": response.headers.get("Content-Type", "").split(";")[0],
+        }
+
+    def platform_digest(self, image_ref: str, index_digest: str, platform: str):
+        """Digest of the platform's manifest within a manifest list
+
+        Manifest lists are content addressed, so results are kept for the index digest
+        """
+        key = (index_digest, platform)
+        if key not in self.platform_digests:
+            registry, repository, _ = parse_image_ref(image_ref)
+            index = self.request("GET", registry, repository, index_digest).json()
+            self.platform_digests[key] = select_platform(index.get("manifests", []), platform)
+        return self.platform_digests[key]
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+def select_platform(manifests, platform: str):
+    if not platform:
+        return None
+    os_name, _, arch_variant = platform.partition("/")
+    arch, _, variant = arch_variant.partition("/")
+    fallback = None
+    for manifest in manifests:
+        spec = manifest.get("platform", {})
+        if spec.get("os") == os_name and spec.get("architecture") == arch:
+            if not variant or spec.get("variant") == variant:
+                return manifest.get("digest")
+            fallback = fallback or manifest.get("digest")
+    return fallback
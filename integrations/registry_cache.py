@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import json
+import os
+import os.path
+import threading
+import time
+import structlog
+
+log = structlog.get_logger()
+
+
+class RegistryDigestCache:
+    """LRU cache of registry digests, keyed by image ref and platform
+
+    Expired entries are revalidated against the registry rather than dropped, so an
+    unchanged digest is counted separately from a changed one, and a stale digest
+    is still served if the registry can't be reached.
+    """
+
+    def __init__(self, ttl: int = 3600, max_size: int = 1000, path: str = None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.dirty = False
+        self.hits = self.misses = self.evictions = 0
+        self.revalidated = self.changed = self.stale = 0
+        self.log = structlog.get_logger().bind(integration="registry_cache")
+        if path:
+            self.load()
+
+    def get(self, image_ref: str, platform: str, fetch):
+        """Return cached digest for image, calling `fetch(image_ref)` on miss or expiry
+
+        Concurrent lookups of the same key wait for a single fetch.
+        """
+        key = (image_ref, platform)
+        with self.lock:
+            # lock and count of lookups using it, dropped once the last one is done
+            key_lock = self.key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                with self.lock:
+                    entry = self.entries.get(key)
+                    if entry is not None:
+                        self.entries.move_to_end(key)
+                        if time.time() - entry[1] < self.ttl:
+                            self.hits += 1
+                            return entry[0]
+                    else:
+                        self.misses += 1
+
+                digest = fetch(image_ref)
+
+                with self.lock:
+                    if digest is None:
+                        if entry is not None:
+                            self.stale += 1
+                            return entry[0]
+                        return None
+                    if entry is not None:
+                        if entry[0] == digest:
+                            self.revalidated += 1
+                        else:
+                            self.changed += 1
+                    self.entries[key] = (digest, time.time())
+                    self.entries.move_to_end(key)
+                    self.dirty = True
+                    self.evict()
+                    return digest
+        finally:
+            with self.lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self.key_locks[key]
+
+    def invalidate(self, image_ref: str):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == image_ref]:
+                del self.entries[key]
+                self.dirty = True
+
+    def evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "cache_size": len(self.entries),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "cache_evictions": self.evictions,
+            "cache_revalidated": self.revalidated,
+            "cache_changed": self.changed,
+            "cache_stale": self.stale,
+        }
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                for record in json.load(f):
+                    key = (record["image_ref"], record["platform"])
+                    self.entries[key] = (record["digest"], record["fetched_at"])
+            self.evict()
+            self.log.info("Loaded registry cache", path=self.path, size=len(self.entries))
+        except Exception as e:
+            self.log.warn("Unable to load registry cache from %s: %s", self.path, e)
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            records = [
+                {
+                    "image_ref": key[0],
+                    "platform": key[1],
+                    "digest": digest,
+                    "fetched_at": fetched_at,
+                }
+                for key, (digest, fetched_at) in self.entries.items()
+            ]
+            self.dirty = False
+        try:
+            tmp_path = "%s.tmp" % self.path
+            with open(tmp_path, "w") as f:
+                json.dump(records, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.log.warn("Unable to save registry cache to %s: %s", self.path, e)
@@ -0,0 +1,148 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+import structlog
+
+log = structlog.get_logger()
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+PREFIX = "release2mqtt_"
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.last = None
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.last = value
+
+
+class Metrics:
+    """Counters and timing histograms, rendered in Prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted({key[0] for key in self.counters}):
+                lines.append("# TYPE %s%s counter" % (PREFIX, name))
+                for (cname, labels), value in sorted(self.counters.items()):
+                    if cname == name:
+                        lines.append("%s%s%s %s" % (PREFIX, name, label_str(labels), value))
+            for name in sorted({key[0] for key in self.histograms}):
+                lines.append("# TYPE %s%s histogram" % (PREFIX, name))
+                for (hname, labels), histogram in sorted(self.histograms.items()):
+                    if hname != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(
+                            "%s%s_bucket%s %s"
+                            % (PREFIX, name, label_str(labels + (("le", bound),)), count)
+                        )
+                    lines.append(
+                        "%s%s_bucket%s %s"
+                        % (PREFIX, name, label_str(labels + (("le", "+Inf"),)), histogram.count)
+                    )
+                    lines.append("%s%s_sum%s %s" % (PREFIX, name, label_str(labels), histogram.sum))
+                    lines.append("%s%s_count%s %s" % (PREFIX, name, label_str(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Flat dict of counter totals and last/mean timings, for MQTT diagnostics"""
+        results = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                results[flat_name(name, labels)] = value
+            for (name, labels), histogram in self.histograms.items():
+                results["%s_last" % flat_name(name, labels)] = round(histogram.last, 3)
+                results["%s_mean" % flat_name(name, labels)] = round(
+                    histogram.sum / histogram.count, 3
+                )
+        return results
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def label_str(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+
+def flat_name(name, labels):
+    return "_".join([name] + [str(v) for _, v in labels])
+
+
+REGISTRY = Metrics()
+
+
+class MetricsServer:
+    """Serves the registry on /metrics from a background thread"""
+
+    def __init__(self, host: str, port: int, registry: Metrics = REGISTRY):
+        registry_ref = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry_ref.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True, name="metrics"
+        )
+
+    def start(self):
+        self.thread.start()
+        log.info("Serving metrics", address=self.server.server_address)
+
+    def stop(self):
+        self.server.shutdown()
@@ -1,57 +1,132 @@
+import datetime
+from dataclasses import asdict, dataclass, field, fields
+from operator import attrgetter
+from typing import Optional
+
+
+@dataclass(slots=True, frozen=True)
+class CustomFields:
+    """Provider specific fields of a discovery, subclassed by each provider"""
+
+    def as_record(self):
+        return asdict(self)
+
+    @classmethod
+    def from_record(cls, record):
+        values = {}
+        for f in fields(cls):
+            if f.name not in (record or {}):
+                continue
+            value = record[f.name]
+            # datetimes are stored as strings, by the serializer's `default=str`
+            if isinstance(value, str) and datetime.datetime in getattr(f.type, "__args__", (f.type,)):
+                value = datetime.datetime.fromisoformat(value)
+            values[f.name] = value
+        return cls(**values)
+
+
+@dataclass(slots=True, repr=False)
 class Discovery:
-    """Discovered component from a scan"""
-
-    def __init__(
-        self,
-        provider,
-        name,
-        session=None,
-        entity_picture_url=None,
-        current_version=None,
-        latest_version=None,
-        can_update=False,
-        status="on",
-        update_policy=None,
-        update_last_attempt=None,
-        release_url=None,
-        release_summary=None,
-        title_template="Update for {name} on {node}",
-        device_icon=None,
-        custom=None,
-    ):
-        self.provider = provider
-        self.source_type = provider.source_type
-        self.session = session
-        self.name = name
-        self.entity_picture_url = entity_picture_url
-        self.current_version = current_version
-        self.latest_version = latest_version
-        self.can_update = can_update
-        self.release_url = release_url
-        self.release_summary = release_summary
-        self.title_template = title_template
-        self.device_icon = device_icon
-        self.status = status
-        self.update_policy = update_policy
-        self.update_last_attempt = update_last_attempt
-        self.custom = custom or {}
-        
+    """Discovered component from a scan
+
+    Equality ignores the provider and scan session, so a rescan that found nothing
+    new compares equal to the previous discovery
+    """
+
+    provider: "ReleaseProvider" = field(compare=False)
+    name: str
+    session: Optional[str] = field(default=None, compare=False)
+    entity_picture_url: Optional[str] = None
+    current_version: Optional[str] = None
+    latest_version: Optional[str] = None
+    can_update: bool = False
+    status: str = "on"
+    update_policy: Optional[str] = None
+    update_last_attempt: Optional[float] = None
+    release_url: Optional[str] = None
+    release_summary: Optional[str] = None
+    title_template: str = "Update for {name} on {node}"
+    device_icon: Optional[str] = None
+    scan_interval: Optional[int] = None
+    custom: CustomFields = None
+    source_type: str = field(init=False)
+
+    def __post_init__(self):
+        self.source_type = self.provider.source_type
+        if self.custom is None:
+            self.custom = CustomFields()
+
+    RECORD_FIELDS = (
+        "name",
+        "session",
+        "entity_picture_url",
+        "current_version",
+        "latest_version",
+        "can_update",
+        "status",
+        "update_policy",
+        "update_last_attempt",
+        "release_url",
+        "release_summary",
+        "title_template",
+        "device_icon",
+        "scan_interval",
+        "custom",
+    )
+
+    def as_record(self):
+        """Provider independent fields, suitable for JSON storage"""
+        record = {field: getattr(self, field) for field in self.RECORD_FIELDS}
+        record["custom"] = self.custom.as_record()
+        return record
+
+    @classmethod
+    def from_record(cls, provider, record):
+        values = {k: v for k, v in record.items() if k in cls.RECORD_FIELDS}
+        values["custom"] = provider.custom_type.from_record(record.get("custom"))
+        return cls(provider, **values)
+
+    def fingerprint(self):
+        """Hash of the compared fields, to check for change without serializing"""
+        return hash(compared_values(self))
+
+    def changes(self, other: "Discovery"):
+        """Names of compared fields that differ from other"""
+        return [name for name in COMPARED_FIELDS if getattr(self, name) != getattr(other, name)]
+
     def __repr__(self):
         return f'Discovery(\'{self.name}\',\'{self.source_type}\')'
 
 
+COMPARED_FIELDS = tuple(f.name for f in fields(Discovery) if f.compare)
+compared_values = attrgetter(*COMPARED_FIELDS)
+
+
 class ReleaseProvider:
     source_type = "base"
+    custom_type = CustomFields
+    supports_install_all = False
+    # set by the app when scheduling, so full scans can skip checks not yet due
+    is_due = None
 
     def update(self, command, discovery):
         pass
 
-    def rescan(self, discovery):
+    def rescan(self, discovery, refresh=False):
         pass
 
     def scan(self, session):
         pass
 
+    def restore(self, records):
+        """Rebuild discoveries saved by a previous run"""
+        return [Discovery.from_record(self, record) for record in records]
+
+    async def watch(self):
+        """Yield discoveries for changes noticed between scans, if supported"""
+        return
+        yield
+
     def hass_config_format(self, discovery):
         return {}
 
@@ -1,43 +1,109 @@
 import paho.mqtt.client as mqtt
-import paho.mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from config import MqttConfig, NodeConfig, HomeAssistantConfig
 import logging as log
 import asyncio
+from dataclasses import dataclass
+import hashlib
+import sys
+import threading
 import time
-import json
-from hass_formatter import hass_format_config, hass_format_state
+from executor import UpdateExecutor
+from metrics import REGISTRY
+import serializer
+from hass_formatter import (
+    hass_config_key,
+    hass_format_button,
+    hass_format_config,
+    hass_state_dynamic,
+    hass_state_static,
+    hass_state_static_key,
+)
 import structlog
 
 log = structlog.get_logger()
 
+# provider wide commands, with no entity name
+BATCH_COMMANDS = ("install_all",)
+PROTOCOLS = {"3.1.1": mqtt.MQTTv311, "5": mqtt.MQTTv5}
+# CONNACK reason from a broker that doesn't speak MQTT 5
+UNSUPPORTED_PROTOCOL_VERSION = 132
+
 
 class MqttClient:
     def __init__(
-        self, cfg: MqttConfig, node_cfg: NodeConfig, hass_cfg: HomeAssistantConfig
+        self,
+        cfg: MqttConfig,
+        node_cfg: NodeConfig,
+        hass_cfg: HomeAssistantConfig,
+        executor: UpdateExecutor = None,
     ):
         self.cfg = cfg
         self.node_cfg = node_cfg
         self.hass_cfg = hass_cfg
+        self.executor = executor or UpdateExecutor()
+        self.executor.on_change = self.publish_executor_state
         self.providers_by_topic = {}
+        self.sweeps = []
+        self.published = {}
+        self.refresh_at = {}
+        self.published_fingerprints = {}
+        self.publications = {}
+        self.topic_sessions = {}
+        self.sent_count = self.suppressed_count = 0
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.connected = asyncio.Event()
+        self.socket_loop = None
+        self.state_listener = None
+        self.connect_listener = None
+        self.sweep_subscriptions = {}
+        self.legacy_swept = set()
+        self.protocol = PROTOCOLS[str(cfg.protocol)]
+        self.topic_aliases = {}
+        self.alias_maximum = 0
+        self.alias_lock = threading.Lock()
         self.log = structlog.get_logger().bind(host=cfg.host, integration="mqtt")
 
     def start(self, event_loop=None):
+        """Begin connecting to the broker in the background, retrying until it is up
+
+        Subscriptions made before the connection completes are sent once it does,
+        but paho drops retained publishes made until then. Use `wait_connected`, or
+        `connect_listener` which is called on the event loop on every connect, to
+        publish once connected.
+        """
         log = self.log.bind(action="start")
         try:
             self.event_loop = event_loop or asyncio.get_event_loop()
+            if self.protocol == mqtt.MQTTv5:
+                # MQTT 5 replaces clean session with a clean start on connect
+                session_args, connect_args = {}, {"clean_start": True}
+            else:
+                session_args, connect_args = {"clean_session": True}, {}
             self.client = mqtt.Client(
-                client_id="release2mqtt_%s" % self.node_cfg.name, clean_session=True
+                client_id="release2mqtt_%s" % self.node_cfg.name,
+                protocol=self.protocol,
+                **session_args
             )
             self.client.username_pw_set(self.cfg.user, password=self.cfg.password)
-            self.client.connect(host=self.cfg.host, port=self.cfg.port, keepalive=60)
-
             self.client.on_connect = self.on_connect
             self.client.on_disconnect = self.on_disconnect
             self.client.on_message = self.on_message
+            self.client.on_publish = self.on_publish
+            self.client.connect_async(
+                host=self.cfg.host, port=self.cfg.port, keepalive=60, **connect_args
+            )
 
-            self.client.loop_start()
+            if self.cfg.transport == "asyncio":
+                self.socket_loop = AsyncioSocketLoop(self.client, self.event_loop)
+            else:
+                self.client.loop_start()
 
-            log.info("Connected to broker",host=self.cfg.host,port=self.cfg.port)
+            log.info("Connecting to broker", host=self.cfg.host, port=self.cfg.port)
         except Exception as e:
             log.error(
                 "Failed to connect to broker %s:%s - %s",
@@ -52,99 +118,229 @@ class MqttClient:
             )
 
     def stop(self):
-        self.client.loop_stop()
+        if self.socket_loop is None:
+            self.client.loop_stop()
+        else:
+            self.socket_loop.stop()
         self.client.disconnect()
 
-    def on_connect(self, _client, _userdata, _flags, rc):
+    async def wait_connected(self, timeout: float = None):
+        """Wait until connected to the broker, returning False if timeout passes first"""
+        try:
+            async with asyncio.timeout(timeout):
+                await self.connected.wait()
+            return True
+        except TimeoutError:
+            return False
+
+    def on_connect(self, _client, _userdata, _flags, rc, properties=None):
         self.log.info("Connected to broker", result_code=rc)
+        if self.protocol == mqtt.MQTTv5 and rc == UNSUPPORTED_PROTOCOL_VERSION:
+            asyncio.run_coroutine_threadsafe(self.fall_back_to_v311(), self.event_loop)
+            return
+        # aliases only last as long as the connection
+        with self.alias_lock:
+            self.topic_aliases = {}
+            self.alias_maximum = getattr(properties, "TopicAliasMaximum", 0)
+        with self.pending_lock:
+            self.pending = 0
+        # broker may have lost retained messages, so don't suppress the next publish
+        self.published.clear()
         for topic in self.providers_by_topic:
             self.log.info("(Re)subscribing", topic=topic)
             self.client.subscribe(topic)
+        if rc == 0:
+            self.event_loop.call_soon_threadsafe(self.mark_connected)
 
-    def on_disconnect(self, _client, _userdata, rc):
+    def mark_connected(self):
+        # listener first, so anything waiting on the connection finds its publishes made
+        try:
+            if self.connect_listener:
+                self.connect_listener()
+        finally:
+            self.connected.set()
+
+    async def fall_back_to_v311(self):
+        """Reconnect with MQTT 3.1.1, without message expiry or topic aliases"""
+        if self.protocol != mqtt.MQTTv5:
+            return
+        self.log.warn("Broker does not support MQTT 5, falling back to 3.1.1")
+        self.protocol = mqtt.MQTTv311
+        if self.socket_loop is None:
+            # joining the network thread can wait out its reconnect delay
+            await self.event_loop.run_in_executor(None, self.stop)
+        else:
+            self.stop()
+        self.refresh_at.clear()
+        self.start(self.event_loop)
+
+    def on_disconnect(self, _client, _userdata, rc, properties=None):
         self.log.info("Disconnected from broker", result_code=rc)
+        with self.alias_lock:
+            self.topic_aliases = {}
+            self.alias_maximum = 0
+        with self.pending_lock:
+            self.pending = 0
+        self.event_loop.call_soon_threadsafe(self.connected.clear)
+        self.event_loop.call_soon_threadsafe(self.drained.set)
+
+    def on_publish(self, _client, _userdata, _mid):
+        with self.pending_lock:
+            self.pending -= 1
+            pending = self.pending
+        if pending <= self.cfg.max_pending // 2 and not self.drained.is_set():
+            self.event_loop.call_soon_threadsafe(self.drained.set)
+
+    def track_pending(self, info):
+        """Count a publish paho accepted, which on_publish will count off again"""
+        # paho drops QoS 0 publishes it refuses, so no on_publish follows those
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        with self.pending_lock:
+            self.pending += 1
+        return True
+
+    async def drain(self):
+        """Wait while too many publishes are still queued for the broker"""
+        while self.pending > self.cfg.max_pending:
+            self.drained.clear()
+            # on_publish skips the set while the event still looked set, so check again
+            if self.pending > self.cfg.max_pending:
+                await self.drained.wait()
+
+    async def clean_topics(
+        self, provider, last_scan_session, timeout=30, quiet_period=2
+    ):
+        """Remove retained topics for provider not refreshed in the last scan session
 
-    async def clean_topics(self, provider, last_scan_session, timeout=30):
+        Uses the main connection, and finishes once the broker has gone quiet after
+        replaying retained messages, or at the timeout. With MQTT 5 message expiry,
+        there's no replay, and only topics published by this run are checked.
+
+        The first clean for a provider also sweeps config topics in the layout used
+        before they were grouped by node, which replays every node's config topics
+        """
         log = self.log.bind(action="clean")
         log.info("Starting clean cycle")
-        cleaner = mqtt.Client(
-            client_id="release2mqtt_clean_%s" % self.node_cfg.name, clean_session=True
-        )
-        cleaner.username_pw_set(self.cfg.user, password=self.cfg.password)
-        cleaner.connect(host=self.cfg.host, port=self.cfg.port, keepalive=60)
+        started = time.perf_counter()
+        prefix = self.hass_cfg.discovery.prefix
+        node_source = "%s_%s" % (self.node_name(provider), provider.source_type)
+        prefixes = ["%s/" % self.command_topic(provider), "%s/update/%s/" % (prefix, node_source)]
+        sweep_topics = [
+            "%s/+" % self.command_topic(provider),
+            "%s/update/%s/+/config" % (prefix, node_source),
+        ]
+        legacy = provider not in self.legacy_swept
+        if legacy:
+            prefixes.append("%s/update/%s_" % (prefix, node_source))
+            sweep_topics.append("%s/update/+/update/config" % prefix)
+        sweep = TopicSweep(prefixes)
+        if self.message_expiry() and not legacy:
+            # the broker expires topics this run never published, so only check known ones
+            sweep.retained.update(
+                topic for topic in self.topic_sessions if sweep.matches(topic)
+            )
+        else:
+            await self.sweep(sweep, sweep_topics, timeout, quiet_period)
+            self.legacy_swept.add(provider)
 
-        def cleanup(_client, _userdata, msg):
-            if msg.retain:
-                session = None
-                try:
-                    payload = json.loads(msg.payload)
-                    session = payload.get("source_session")
-                except Exception as e:
-                    log.warn(
-                        "Unable to handle payload for %s: %s",
-                        msg.topic,
-                        e,
-                        exc_info=1,
-                    )
-                if session is None or session != last_scan_session:
-                    log.info("Removing %s [%s]", msg.topic, session)
-                    cleaner.publish(msg.topic, "", retain=True)
-                else:
-                    log.debug(
-                        "Retaining topic with current sesssion: %s",
-                        msg.topic,
-                    )
+        removed = 0
+        for topic in sweep.retained:
+            session = self.topic_sessions.get(topic)
+            if session is None or session != last_scan_session:
+                log.info("Removing %s [%s]", topic, session)
+                self.delete(topic)
+                removed += 1
             else:
-                log.debug("Skipping clean of %s", msg.topic)
-
-        cleaner.on_message = cleanup
-        options = paho.mqtt.subscribeoptions.SubscribeOptions(noLocal=True)
-        cleaner.subscribe(
-            "%s/update/%s_%s/#"
-            % (
-                self.hass_cfg.discovery.prefix,
-                self.node_cfg.name,
-                provider.source_type,
-            ),
-            options=options,
+                log.debug("Retaining topic with current sesssion: %s", topic)
+        if removed:
+            self.publications = {
+                key: entry
+                for key, entry in self.publications.items()
+                if entry.state_topic in self.topic_sessions
+                or entry.config_topic in self.topic_sessions
+            }
+
+        REGISTRY.observe(
+            "clean_seconds", time.perf_counter() - started, source_type=provider.source_type
         )
-        cleaner.subscribe(
-            "%s/%s/%s/#"
-            % (
-                self.cfg.topic_root,
-                self.node_cfg.name,
-                provider.source_type,
-            ),
-            options=options,
+        REGISTRY.inc("clean_removed_total", removed, source_type=provider.source_type)
+        log.info(
+            "Completed clean cycle",
+            retained=len(sweep.retained),
+            removed=removed,
+            **self.publish_stats()
         )
-        loop_end = time.time() + timeout
-        while time.time() <= loop_end:
-            cleaner.loop()
 
-        log.info("Completed clean cycle")
+    async def sweep(self, sweep, sweep_topics, timeout, quiet_period):
+        """Collect retained topics the broker replays, until it goes quiet"""
+        self.sweeps.append(sweep)
+        for topic in sweep_topics:
+            self.sweep_subscribe(topic)
+        try:
+            loop_end = time.time() + timeout
+            while (
+                time.time() - sweep.last_activity < quiet_period
+                and time.time() <= loop_end
+            ):
+                await asyncio.sleep(0.1)
+        finally:
+            for topic in sweep_topics:
+                self.sweep_unsubscribe(topic)
+            self.sweeps.remove(sweep)
+
+    def sweep_subscribe(self, topic):
+        self.sweep_subscriptions[topic] = self.sweep_subscriptions.get(topic, 0) + 1
+        if self.sweep_subscriptions[topic] == 1:
+            self.client.message_callback_add(topic, self.on_sweep_message)
+        # resubscribing makes the broker replay retained messages for this sweep too
+        self.client.subscribe(topic)
+
+    def sweep_unsubscribe(self, topic):
+        self.sweep_subscriptions[topic] -= 1
+        if self.sweep_subscriptions[topic] == 0:
+            del self.sweep_subscriptions[topic]
+            self.client.unsubscribe(topic)
+            self.client.message_callback_remove(topic)
+
+    def on_sweep_message(self, _client, _userdata, msg):
+        # sweeps are only touched on the event loop, as clean_topics reads them there
+        self.event_loop.call_soon_threadsafe(self.offer_sweeps, msg)
+
+    def offer_sweeps(self, msg):
+        for sweep in self.sweeps:
+            sweep.offer(msg)
 
     async def execute_command(self, msg, on_update_start, on_update_end):
         try:
             log = self.log.bind(topic=msg.topic, payload=msg.payload)
             log.info("Execution starting")
-            payload = json.loads(msg.payload)
+            payload = serializer.loads(msg.payload)
             provider = self.providers_by_topic[msg.topic]
             if provider.source_type != payload["source_type"]:
                 log.warn("Unexpected source type %s", payload["source_type"])
-            elif "command" not in payload or "name" not in payload:
+            elif "command" not in payload or (
+                "name" not in payload and payload["command"] not in BATCH_COMMANDS
+            ):
                 log.warn("Invalid payload in command message")
             else:
                 log.info(
                     "Passing %s command to %s scanner for %s",
                     payload["command"],
                     provider.source_type,
-                    payload["name"],
+                    payload.get("name", "all"),
                 )
-                updated = provider.command(
-                    payload["name"], payload["command"], on_update_start, on_update_end
+                updated = await self.executor.submit(
+                    (msg.topic, payload.get("name") or payload["command"]),
+                    provider.command,
+                    payload.get("name"),
+                    payload["command"],
+                    on_update_start,
+                    on_update_end,
                 )
                 if updated:
-                    self.publish_hass_state(updated)
+                    for discovery in updated if isinstance(updated, list) else [updated]:
+                        self.publish_hass_state(discovery)
                 else:
                     log.debug("No change to republish after execution")
             log.info("Execution ended")
@@ -154,7 +350,7 @@ class MqttClient:
     def local_message(self, discovery, command):
         msg = LocalMessage()
         msg.topic = self.command_topic(discovery.provider)
-        msg.payload = json.dumps(
+        msg.payload = serializer.dumps(
             {
                 "source_type": discovery.source_type,
                 "name": discovery.name,
@@ -164,8 +360,8 @@ class MqttClient:
         self.on_message(None, None, msg)
 
     def on_message(self, _client, _userdata, msg):
-        def update_start(discovery):
-            self.publish_hass_state(discovery, in_progress=True)
+        def update_start(discovery, progress=None):
+            self.publish_hass_state(discovery, in_progress=True, progress=progress)
 
         def update_end(discovery):
             self.publish_hass_state(discovery, in_progress=False)
@@ -178,10 +374,14 @@ class MqttClient:
         else:
             self.log.warn("Unhandled message: %s", msg.topic)
 
+    def node_name(self, provider):
+        """Node for provider topics, which may scan a host other than this one"""
+        return getattr(provider, "node_name", None) or self.node_cfg.name
+
     def config_topic(self, discovery, sub_topic=None):
-        return "%s/update/%s_%s_%s/update/config" % (
+        return "%s/update/%s_%s/%s/config" % (
             self.hass_cfg.discovery.prefix,
-            self.node_cfg.name,
+            self.node_name(discovery.provider),
             discovery.source_type,
             discovery.name,
         )
@@ -189,7 +389,7 @@ class MqttClient:
     def state_topic(self, discovery):
         return "%s/%s/%s/%s" % (
             self.cfg.topic_root,
-            self.node_cfg.name,
+            self.node_name(discovery.provider),
             discovery.source_type,
             discovery.name,
         )
@@ -197,39 +397,106 @@ class MqttClient:
     def command_topic(self, provider):
         return "%s/%s/%s" % (
             self.cfg.topic_root,
-            self.node_cfg.name,
+            self.node_name(provider),
             provider.source_type,
         )
 
-    def publish_hass_state(self, discovery, in_progress=False):
-        self.publish(
-            self.state_topic(discovery),
-            hass_format_state(
-                discovery,
-                self.node_cfg.name,
-                discovery.session,
-                in_progress=in_progress,
-            ),
-        )
+    def executor_topic(self):
+        return "%s/%s/executor" % (self.cfg.topic_root, self.node_cfg.name)
 
-    def publish_hass_config(self, discovery):
-        object_id = "%s_%s_%s" % (
-            discovery.source_type,
-            self.node_cfg.name,
-            discovery.name,
+    def publish_executor_state(self, status):
+        if getattr(self, "client", None) is not None:
+            self.publish(self.executor_topic(), status)
+
+    def diagnostics_topic(self):
+        return "%s/%s/diagnostics" % (self.cfg.topic_root, self.node_cfg.name)
+
+    def publish_diagnostics(self, summary):
+        """Publish metrics summary, with a Home Assistant diagnostic sensor to show it"""
+        if self.hass_cfg.discovery.enabled:
+            object_id = "release2mqtt_%s_diagnostics" % self.node_cfg.name
+            self.publish(
+                "%s/sensor/%s/config" % (self.hass_cfg.discovery.prefix, object_id),
+                {
+                    "name": "release2mqtt scan time on %s" % self.node_cfg.name,
+                    "unique_id": object_id,
+                    "entity_category": "diagnostic",
+                    "device_class": "duration",
+                    "unit_of_measurement": "s",
+                    "state_topic": self.diagnostics_topic(),
+                    "value_template": "{{ value_json.scan_seconds }}",
+                    "json_attributes_topic": self.diagnostics_topic(),
+                },
+            )
+        self.publish(self.diagnostics_topic(), summary)
+
+    def publication(self, discovery):
+        """Topics and serialized payload parts for discovery's entity, built once"""
+        key = (discovery.provider, discovery.name)
+        entry = self.publications.get(key)
+        if entry is None:
+            node_name = self.node_name(discovery.provider)
+            entry = self.publications[key] = Publication(
+                node_name=node_name,
+                object_id=sys.intern(
+                    "%s_%s_%s" % (discovery.source_type, node_name, discovery.name)
+                ),
+                config_topic=sys.intern(self.config_topic(discovery)),
+                state_topic=sys.intern(self.state_topic(discovery)),
+                command_topic=sys.intern(self.command_topic(discovery.provider)),
+            )
+        return entry
+
+    def publish_hass_state(self, discovery, in_progress=False, progress=None):
+        if self.state_listener:
+            self.state_listener(discovery)
+        entry = self.publication(discovery)
+        topic = entry.state_topic
+        if self.unchanged(
+            topic, (discovery.fingerprint(), in_progress, progress), discovery.session
+        ):
+            return
+        static_key = hass_state_static_key(discovery)
+        if entry.state_static_key != static_key:
+            # static fields as a json object missing its closing brace
+            entry.state_static = serializer.dumps(hass_state_static(discovery, entry.node_name))[:-1]
+            entry.state_static_key = static_key
+        dynamic = serializer.dumps(
+            hass_state_dynamic(discovery, in_progress=in_progress, progress=progress)
         )
-        command_topic = (
-            self.command_topic(discovery.provider) if discovery.can_update else None
+        self.publish_encoded(
+            topic, "%s,%s" % (entry.state_static, dynamic[1:]), session=discovery.session
         )
+
+    def publish_hass_config(self, discovery):
+        entry = self.publication(discovery)
+        config_key = hass_config_key(discovery)
+        if self.unchanged(entry.config_topic, config_key, discovery.session):
+            return
+        if entry.config_key != config_key:
+            entry.config = serializer.dumps(
+                hass_format_config(
+                    discovery,
+                    entry.object_id,
+                    entry.node_name,
+                    entry.state_topic,
+                    entry.command_topic if discovery.can_update else None,
+                )
+            )
+            entry.config_key = config_key
+        self.publish_encoded(entry.config_topic, entry.config, session=discovery.session)
+
+    def publish_hass_install_all(self, provider):
+        """Home Assistant button to update everything pending for provider"""
+        node_name = self.node_name(provider)
+        object_id = "release2mqtt_%s_%s_install_all" % (node_name, provider.source_type)
         self.publish(
-            self.config_topic(discovery),
-            hass_format_config(
-                discovery,
+            "%s/button/%s/config" % (self.hass_cfg.discovery.prefix, object_id),
+            hass_format_button(
+                "Install all %s updates on %s" % (provider.source_type, node_name),
                 object_id,
-                self.node_cfg.name,
-                self.state_topic(discovery),
-                command_topic,
-                discovery.session,
+                self.command_topic(provider),
+                serializer.dumps({"source_type": provider.source_type, "command": "install_all"}),
             ),
         )
 
@@ -246,8 +513,192 @@ class MqttClient:
     def loop_once(self):
         self.client.loop()
 
-    def publish(self, topic, payload):
-        self.client.publish(topic, payload=json.dumps(payload), qos=0, retain=True)
+    def unchanged(self, topic, fingerprint, session):
+        """Whether a discovery is as last published on topic, so formatting can be skipped"""
+        if self.published_fingerprints.get(topic) == fingerprint and self.fresh(topic):
+            self.topic_sessions[topic] = session
+            self.suppressed_count += 1
+            REGISTRY.inc("mqtt_publish_total", result="suppressed")
+            return True
+        self.published_fingerprints[topic] = fingerprint
+        return False
+
+    def publish(self, topic, payload, session=None):
+        """Publish retained payload, unless identical to the last one sent on topic
+
+        The scan session is tracked locally per topic for `clean_topics`
+        """
+        self.publish_encoded(topic, serializer.dumps(payload), session=session)
+
+    def fresh(self, topic):
+        """Whether the broker still retains the last publish on topic, as far as is known
+
+        Expiring messages count as stale halfway through their expiry, so an unchanged
+        payload is sent again well before the broker drops it
+        """
+        if topic not in self.published:
+            return False
+        refresh_at = self.refresh_at.get(topic)
+        return refresh_at is None or time.monotonic() < refresh_at
+
+    def message_expiry(self):
+        """Expiry for retained entity topics, only available with MQTT 5"""
+        if self.protocol == mqtt.MQTTv5 and self.cfg.message_expiry:
+            return self.cfg.message_expiry
+
+    def publish_encoded(self, topic, encoded, session=None):
+        if session is not None:
+            self.topic_sessions[topic] = session
+        digest = hashlib.blake2b(encoded.encode(), digest_size=16).digest()
+        if self.published.get(topic) == digest and self.fresh(topic):
+            self.suppressed_count += 1
+            REGISTRY.inc("mqtt_publish_total", result="suppressed")
+            return
+        with REGISTRY.timer("mqtt_publish_seconds"):
+            if self.protocol == mqtt.MQTTv5:
+                # only entity topics, which carry a session, are refreshed by each scan
+                info = self.publish_v5(
+                    topic, encoded, expiry=session is not None and self.message_expiry()
+                )
+            else:
+                info = self.client.publish(topic, payload=encoded, qos=0, retain=True)
+        if not self.track_pending(info):
+            # dropped by paho while disconnected, so on_connect's republish isn't suppressed
+            REGISTRY.inc("mqtt_publish_total", result="dropped")
+            return
+        self.published[topic] = digest
+        self.sent_count += 1
+        REGISTRY.inc("mqtt_publish_total", result="sent")
+
+    def publish_v5(self, topic, encoded, expiry=None):
+        """Publish with message expiry, and a topic alias once the broker knows it"""
+        properties = Properties(PacketTypes.PUBLISH)
+        if expiry:
+            properties.MessageExpiryInterval = expiry
+            self.refresh_at[topic] = time.monotonic() + expiry / 2
+        else:
+            self.refresh_at.pop(topic, None)
+        with self.alias_lock:
+            alias = self.topic_aliases.get(topic)
+            if alias is not None:
+                properties.TopicAlias = alias
+                topic = ""
+            elif len(self.topic_aliases) < self.alias_maximum:
+                alias = self.topic_aliases[topic] = len(self.topic_aliases) + 1
+                properties.TopicAlias = alias
+            # under the lock, so an alias is never used ahead of the publish defining it
+            return self.client.publish(
+                topic, payload=encoded, qos=0, retain=True, properties=properties
+            )
+
+    def delete(self, topic):
+        """Remove retained message for topic"""
+        self.track_pending(self.client.publish(topic, "", retain=True))
+        self.published.pop(topic, None)
+        self.refresh_at.pop(topic, None)
+        self.published_fingerprints.pop(topic, None)
+        self.topic_sessions.pop(topic, None)
+
+    def publish_stats(self):
+        return {
+            "publish_sent": self.sent_count,
+            "publish_suppressed": self.suppressed_count,
+        }
+
+
+class AsyncioSocketLoop:
+    """Drives the paho client socket from the asyncio event loop, instead of a thread
+
+    Writes are deferred to the loop's writer callback, so publishes made in the
+    same loop iteration go out together once the socket is writable.
+    """
+
+    def __init__(self, client: mqtt.Client, event_loop, reconnect_delay: int = 5):
+        self.client = client
+        self.event_loop = event_loop
+        self.reconnect_delay = reconnect_delay
+        self.misc = None
+        self.stopped = False
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        self.misc = event_loop.create_task(self.misc_loop())
+
+    def in_loop(self, fn, *args):
+        # paho may call back from a worker thread when publishing outside the loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.event_loop:
+            fn(*args)
+        else:
+            self.event_loop.call_soon_threadsafe(fn, *args)
+
+    def on_socket_open(self, client, _userdata, sock):
+        self.in_loop(self.event_loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, _client, _userdata, sock):
+        self.in_loop(self.event_loop.remove_reader, sock)
+
+    def on_socket_register_write(self, client, _userdata, sock):
+        self.in_loop(self.event_loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, _client, _userdata, sock):
+        self.in_loop(self.event_loop.remove_writer, sock)
+
+    async def misc_loop(self):
+        while not self.stopped:
+            if self.client.loop_misc() != mqtt.MQTT_ERR_SUCCESS:
+                # (re)connect off the loop, as name lookup and socket connect block
+                try:
+                    await self.event_loop.run_in_executor(None, self.client.reconnect)
+                except Exception as e:
+                    log.warn("Connect to broker failed: %s", e)
+                await asyncio.sleep(self.reconnect_delay)
+            else:
+                await asyncio.sleep(1)
+
+    def stop(self):
+        self.stopped = True
+        if self.misc:
+            self.misc.cancel()
+
+
+@dataclass(slots=True)
+class Publication:
+    """Precomputed topics and serialized payload parts for one entity"""
+
+    node_name: str
+    object_id: str
+    config_topic: str
+    state_topic: str
+    command_topic: str
+    config_key: tuple = None
+    config: str = None
+    state_static_key: tuple = None
+    state_static: str = None
+
+
+class TopicSweep:
+    """Retained topics replayed by the broker for one provider's clean cycle"""
+
+    def __init__(self, prefixes):
+        self.prefixes = tuple(prefixes)
+        self.retained = set()
+        self.last_activity = time.time()
+
+    def matches(self, topic):
+        return topic.startswith(self.prefixes)
+
+    def offer(self, msg):
+        # other nodes' topics are still replay in progress, so count towards activity
+        self.last_activity = time.time()
+        if not self.matches(msg.topic):
+            return
+        if msg.retain and msg.payload:
+            self.retained.add(msg.topic)
 
 
 class LocalMessage:
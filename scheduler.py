@@ -0,0 +1,80 @@
+from dataclasses import dataclass
+import random
+import time
+from config import ScheduleConfig
+from model import Discovery
+
+
+@dataclass
+class ScheduleEntry:
+    discovery: Discovery
+    interval: float
+    next_check: float
+    checks: int = 0
+    changes: int = 0
+
+
+class ScanScheduler:
+    """Next check time per discovery, adapting each interval to how often it changes
+
+    An interval halves when the latest version has moved since the last check, and
+    backs off when it hasn't, within the configured bounds. A container can pin its
+    own interval with `REL2MQTT_SCAN_INTERVAL`. Check times are jittered so that
+    many nodes don't hit a registry together.
+    """
+
+    def __init__(self, cfg: ScheduleConfig, initial_interval: int):
+        self.cfg = cfg
+        self.initial_interval = initial_interval
+        self.entries = {}
+
+    @staticmethod
+    def key(discovery: Discovery):
+        return (
+            getattr(discovery.provider, "node_name", None),
+            discovery.source_type,
+            discovery.name,
+        )
+
+    def record(self, discovery: Discovery, now: float = None):
+        """Note the latest analysis of discovery, and schedule its next check
+
+        Only counts as a check once due, as full scans and events rescan sooner
+        """
+        now = time.time() if now is None else now
+        key = self.key(discovery)
+        entry = self.entries.get(key)
+        if entry is not None and entry.next_check > now:
+            entry.discovery = discovery
+            return entry
+        if entry is None:
+            interval = self.clamp(self.initial_interval)
+            entry = self.entries[key] = ScheduleEntry(discovery, interval, now)
+        else:
+            entry.checks += 1
+            if discovery.latest_version != entry.discovery.latest_version:
+                entry.changes += 1
+                entry.interval = self.clamp(entry.interval / 2)
+            else:
+                entry.interval = self.clamp(entry.interval * self.cfg.backoff)
+            entry.discovery = discovery
+        interval = discovery.scan_interval or entry.interval
+        entry.next_check = now + interval * random.uniform(
+            1 - self.cfg.jitter, 1 + self.cfg.jitter
+        )
+        return entry
+
+    def clamp(self, interval: float):
+        return max(self.cfg.min_interval, min(self.cfg.max_interval, interval))
+
+    def is_due(self, discovery: Discovery, now: float = None):
+        now = time.time() if now is None else now
+        entry = self.entries.get(self.key(discovery))
+        return entry is None or entry.next_check <= now
+
+    def due(self, now: float = None):
+        now = time.time() if now is None else now
+        return [entry.discovery for entry in self.entries.values() if entry.next_check <= now]
+
+    def forget(self, discovery: Discovery):
+        self.entries.pop(self.key(discovery), None)
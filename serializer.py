@@ -0,0 +1,38 @@
+"""JSON encoding for MQTT payloads and stored state
+
+Uses orjson when it is installed, otherwise the standard library, with compact
+separators and unescaped unicode either way. orjson is told to accept non-str dict
+keys, as json does, and to pass datetimes to `default`, as json has to, while
+integers wider than 64 bits, which orjson refuses, are left to json. Payloads of
+strings, bools, None, ints and those types are then identical with either backend,
+but floats may not be: orjson writes 1e16 as `1e16` and NaN as `null`, where json
+writes `1e+16` and `NaN`
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+ORJSON_OPTIONS = (
+    orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson is not None else 0
+)
+
+
+def dumps(obj, default=None) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS).decode()
+        except orjson.JSONEncodeError as e:
+            if "Integer exceeds 64-bit range" not in str(e):
+                raise
+    return json.dumps(obj, default=default, separators=(",", ":"), ensure_ascii=False)
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,102 @@
+import sqlite3
+import threading
+import time
+import structlog
+from model import Discovery
+import serializer
+
+log = structlog.get_logger()
+
+
+def store_source_type(provider):
+    """Source type qualified by node, for providers scanning another host"""
+    node_name = getattr(provider, "node_name", None)
+    if node_name:
+        return "%s@%s" % (provider.source_type, node_name)
+    return provider.source_type
+
+
+class StateStore:
+    """SQLite store of discoveries, so state can be republished straight after a restart"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.saved = {}
+        self.fingerprints = {}
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS discoveries (
+                source_type TEXT NOT NULL,
+                name TEXT NOT NULL,
+                session TEXT,
+                record TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (source_type, name)
+            )"""
+        )
+        self.log = structlog.get_logger().bind(integration="state_store", path=path)
+
+    def save(self, discovery: Discovery):
+        """Record discovery, skipping the write if nothing has changed since last save
+
+        Unchanged discoveries are spotted by fingerprint, before serializing
+        """
+        source_type = store_source_type(discovery.provider)
+        key = (source_type, discovery.name)
+        fingerprint = (discovery.session, discovery.fingerprint())
+        if self.fingerprints.get(key) == fingerprint:
+            return
+        try:
+            record = serializer.dumps(discovery.as_record(), default=str)
+        except Exception as e:
+            self.log.warn("Unable to serialize %s: %s", discovery.name, e)
+            return
+        with self.lock:
+            if self.saved.get(key) != (discovery.session, record):
+                self.db.execute(
+                    "INSERT OR REPLACE INTO discoveries VALUES (?,?,?,?,?)",
+                    (source_type, discovery.name, discovery.session, record, time.time()),
+                )
+                self.saved[key] = (discovery.session, record)
+            self.fingerprints[key] = fingerprint
+
+    def load(self, source_type: str):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT name, session, record FROM discoveries WHERE source_type=?",
+                (source_type,),
+            ).fetchall()
+        records = []
+        for name, session, record in rows:
+            try:
+                records.append(serializer.loads(record))
+                self.saved[(source_type, name)] = (session, record)
+            except Exception as e:
+                self.log.warn("Discarding unreadable record for %s: %s", name, e)
+        return records
+
+    def prune(self, source_type: str, session: str):
+        """Drop discoveries not seen in the given scan session"""
+        with self.lock:
+            removed = self.db.execute(
+                "DELETE FROM discoveries WHERE source_type=? AND (session IS NULL OR session!=?)",
+                (source_type, session),
+            ).rowcount
+            self.saved = {
+                key: saved
+                for key, saved in self.saved.items()
+                if key[0] != source_type or saved[0] == session
+            }
+            self.fingerprints = {
+                key: fingerprint
+                for key, fingerprint in self.fingerprints.items()
+                if key[0] != source_type or fingerprint[0] == session
+            }
+        if removed:
+            self.log.info("Pruned discoveries", source_type=source_type, count=removed)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
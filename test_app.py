@@ -0,0 +1,195 @@
+import app as mut
+import asyncio
+import os.path
+import time
+import pytest
+from omegaconf import OmegaConf
+from model import Discovery, ReleaseProvider
+
+
+class FakeProvider(ReleaseProvider):
+    """Yields a discovery per name, sleeping before each, then raises if given an error"""
+
+    def __init__(self, source_type, names, delay=0, error=None):
+        self.source_type = source_type
+        self.names = names
+        self.delay = delay
+        self.error = error
+
+    async def scan(self, session):
+        for name in self.names:
+            await asyncio.sleep(self.delay)
+            yield Discovery(self, name, session)
+        if self.error:
+            raise self.error
+
+    def command(self, discovery_name, command, on_update_start, on_update_end):
+        return False
+
+    def hass_state_format(self, discovery):
+        return {}
+
+    def rescan(self, discovery, refresh=False):
+        return None
+
+
+def make_app(mocker, monkeypatch, tmp_path, config=""):
+    pkg_info_file = os.path.abspath(mut.PKG_INFO_FILE)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "conf").mkdir()
+    if config:
+        (tmp_path / "conf" / "config.yaml").write_text(config)
+    mocker.patch.object(mut, "PKG_INFO_FILE", pkg_info_file)
+    mocker.patch("docker.from_env")
+    mocker.patch("docker.DockerClient")
+    return mut.App()
+
+
+@pytest.fixture
+def app(mocker, monkeypatch, tmp_path):
+    return make_app(mocker, monkeypatch, tmp_path)
+
+
+@pytest.fixture
+def scan_app(app, mocker):
+    app.publisher = mocker.AsyncMock()
+    app.publisher.publish_hass_config = mocker.Mock()
+    app.publisher.publish_hass_state = mocker.Mock()
+    app.publisher.publish_diagnostics = mocker.Mock()
+    app.store = None
+    app.scheduler = None
+    return app
+
+
+def test_app_construction(app, tmp_path):
+    uut = app
+
+    assert uut.publisher.executor.pool._max_workers == 2
+    assert (tmp_path / "conf" / "config.yaml").exists()
+
+
+def test_app_rejects_docker_hosts_sharing_node_name(mocker, monkeypatch, tmp_path):
+    config = (
+        "docker:\n"
+        "  hosts:\n"
+        "    - url: unix:///var/run/docker.sock\n"
+        "    - url: unix:///run/user/1000/docker.sock\n"
+    )
+    with pytest.raises(ValueError, match="set `node` for each"):
+        make_app(mocker, monkeypatch, tmp_path, config)
+
+
+@pytest.mark.asyncio
+async def test_run_publishes_saved_state_once_broker_connects(mocker, monkeypatch, tmp_path):
+    config = "mqtt:\n  host: unreachable.invalid\n  user: unit\n  password: test\n"
+    app = make_app(mocker, monkeypatch, tmp_path, config)
+    mocker.patch("mqtt.mqtt.Client")
+    mocker.patch.object(mut, "CONNECT_WAIT", 0.1)
+    mocker.patch.object(app, "scan_loop", mocker.AsyncMock())
+    provider = FakeProvider("fake", [])
+    provider.supports_install_all = True
+    app.scanners = [provider]
+    app.store.save(Discovery(provider, "saved", "sess_1", latest_version="1.1"))
+
+    running = asyncio.create_task(app.run())
+    await asyncio.wait_for(app.ready.wait(), 1)
+    client = app.publisher.client
+    # broker unreachable, so nothing is published for paho to drop
+    client.publish.assert_not_called()
+    client.subscribe.assert_called_once_with("rel2mqtt/%s/fake" % app.cfg.node.name)
+
+    app.publisher.on_connect(None, None, {}, 0)
+    await asyncio.sleep(0)
+    topics = [c.args[0] for c in client.publish.call_args_list]
+    await running
+
+    assert "homeassistant/button/release2mqtt_%s_fake_install_all/config" % app.cfg.node.name in topics
+    assert "homeassistant/update/%s_fake/saved/config" % app.cfg.node.name in topics
+    assert "rel2mqtt/%s/fake/saved" % app.cfg.node.name in topics
+
+
+def published_names(app):
+    return [c.args[0].name for c in app.publisher.publish_hass_state.call_args_list]
+
+
+def cleaned_types(app):
+    return [c.args[0].source_type for c in app.publisher.clean_topics.call_args_list]
+
+
+@pytest.mark.asyncio
+async def test_scan_publishes_providers_concurrently(scan_app):
+    scan_app.scanners = [
+        FakeProvider("slow", ["slow_1", "slow_2"], delay=0.2),
+        FakeProvider("fast", ["fast_1", "fast_2"], delay=0.05),
+    ]
+
+    started = time.perf_counter()
+    await scan_app.scan()
+
+    assert time.perf_counter() - started < 0.6
+    assert published_names(scan_app)[:2] == ["fast_1", "fast_2"]
+    assert sorted(published_names(scan_app)) == ["fast_1", "fast_2", "slow_1", "slow_2"]
+    assert sorted(cleaned_types(scan_app)) == ["fast", "slow"]
+    scan_app.publisher.publish_diagnostics.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_scan_timeout_skips_clean_for_that_provider(scan_app):
+    scan_app.cfg = OmegaConf.merge(scan_app.cfg, {"scan_timeout": 1})
+    scan_app.scanners = [
+        FakeProvider("stuck", ["stuck_1", "stuck_2"], delay=5),
+        FakeProvider("fast", ["fast_1"]),
+    ]
+
+    started = time.perf_counter()
+    await scan_app.scan()
+
+    assert time.perf_counter() - started < 2
+    assert published_names(scan_app) == ["fast_1"]
+    assert cleaned_types(scan_app) == ["fast"]
+
+
+@pytest.mark.asyncio
+async def test_scan_failure_skips_clean_for_that_provider(scan_app):
+    scan_app.scanners = [
+        FakeProvider("broken", ["broken_1"], error=RuntimeError("api down")),
+        FakeProvider("fast", ["fast_1"]),
+    ]
+
+    await scan_app.scan()
+
+    # discoveries before the failure are still published, but none are cleaned
+    assert sorted(published_names(scan_app)) == ["broken_1", "fast_1"]
+    assert cleaned_types(scan_app) == ["fast"]
+
+
+@pytest.mark.asyncio
+async def test_scan_publishes_discoveries_queued_by_failed_providers(scan_app):
+    async def slow_drain():
+        await asyncio.sleep(0.05)
+
+    scan_app.publisher.drain.side_effect = slow_drain
+    scan_app.scanners = [
+        FakeProvider("broken", ["broken_1", "broken_2", "broken_3"], error=RuntimeError("api down")),
+    ]
+
+    await scan_app.scan()
+
+    assert published_names(scan_app) == ["broken_1", "broken_2", "broken_3"]
+    assert cleaned_types(scan_app) == []
+
+
+@pytest.mark.asyncio
+async def test_scan_timeout_covers_publishing(scan_app):
+    async def stuck_drain():
+        await asyncio.sleep(5)
+
+    scan_app.cfg = OmegaConf.merge(scan_app.cfg, {"scan_timeout": 1})
+    scan_app.publisher.drain.side_effect = stuck_drain
+    scan_app.scanners = [FakeProvider("fast", ["fast_1"])]
+
+    started = time.perf_counter()
+    await scan_app.scan()
+
+    assert time.perf_counter() - started < 3
+    assert cleaned_types(scan_app) == []
@@ -0,0 +1,165 @@
+import integrations.apt as mut
+from config import AptConfig
+from docker import DockerClient
+import io
+import os
+import pytest
+import tarfile
+
+STATUS = """Package: curl
+Status: install ok installed
+Architecture: amd64
+Version: 7.88.1-10+deb12u4
+
+Package: tzdata
+Status: install ok installed
+Architecture: all
+Version: 2024a-0+deb12u1
+
+Package: removed
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 1.0-1
+"""
+
+PACKAGES = """Package: curl
+Version: 7.88.1-10+deb12u5
+Architecture: amd64
+
+Package: curl
+Version: 7.88.1-10+deb12u3
+Architecture: amd64
+
+Package: tzdata
+Version: 2024a-0+deb12u1
+Architecture: all
+
+Package: removed
+Version: 2.0-1
+Architecture: amd64
+"""
+
+
+@pytest.mark.parametrize(
+    "older,newer",
+    [
+        ("1.0", "1.0.1"),
+        ("1.0~rc1", "1.0"),
+        ("1.0", "1.0a"),
+        ("1.9", "1.10"),
+        ("1:9.9", "2:1.0"),
+        ("7.88.1-10+deb12u4", "7.88.1-10+deb12u5"),
+        ("1.0-1", "1.0-1.1"),
+        ("1.0-1~bpo1", "1.0-1"),
+        ("1:2.0:1-1", "1:2.0:2-1"),
+        ("9:9.0:9", "10:0.1"),
+    ],
+)
+def test_compare_versions(older, newer):
+    assert mut.compare_versions(older, newer) < 0
+    assert mut.compare_versions(newer, older) > 0
+    assert mut.compare_versions(newer, newer) == 0
+
+
+def test_host_scan_reparses_only_changed_files(tmp_path):
+    status = tmp_path / "status"
+    status.write_text(STATUS)
+    lists = tmp_path / "lists"
+    lists.mkdir()
+    (lists / "deb.debian.org_debian_dists_bookworm_main_binary-amd64_Packages").write_text(PACKAGES)
+    uut = mut.AptProvider(
+        AptConfig(containers=False, dpkg_status_path=str(status), lists_path=str(lists))
+    )
+
+    discoveries = uut.host_discoveries("s1")
+    assert [(d.name, d.current_version, d.latest_version) for d in discoveries] == [
+        ("curl", "7.88.1-10+deb12u4", "7.88.1-10+deb12u5")
+    ]
+    assert discoveries[0].custom == mut.AptFields(package="curl", architecture="amd64")
+    parses = uut.cache.parses
+
+    uut.host_discoveries("s2")
+    assert uut.cache.parses == parses
+
+    status.write_text(STATUS.replace("deb12u4", "deb12u5"))
+    os.utime(status, ns=(0, 0))
+    assert uut.host_discoveries("s3") == []
+
+
+def test_foreign_arch_packages_get_own_entity(tmp_path):
+    multiarch = """Package: dpkg
+Status: install ok installed
+Architecture: amd64
+Version: 1.21.22
+
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Version: 2.36-9+deb12u3
+
+Package: libc6
+Status: install ok installed
+Architecture: i386
+Version: 2.36-9+deb12u3
+"""
+    packages = """Package: libc6
+Version: 2.36-9+deb12u4
+Architecture: amd64
+
+Package: libc6
+Version: 2.36-9+deb12u4
+Architecture: i386
+"""
+    status = tmp_path / "status"
+    status.write_text(multiarch)
+    lists = tmp_path / "lists"
+    lists.mkdir()
+    (lists / "x_Packages").write_text(packages)
+    uut = mut.AptProvider(
+        AptConfig(containers=False, dpkg_status_path=str(status), lists_path=str(lists))
+    )
+
+    discoveries = uut.host_discoveries("s1")
+
+    assert sorted((d.name, d.custom.architecture) for d in discoveries) == [
+        ("libc6", "amd64"),
+        ("libc6_i386", "i386"),
+    ]
+
+
+def archive(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, text in files.items():
+            data = text.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return [buffer.getvalue()]
+
+
+@pytest.mark.asyncio
+async def test_container_packages_cached_by_image(mocker, tmp_path):
+    container = mocker.Mock()
+    container.id = "c1"
+    container.name = "web+app"
+    container.attrs = {"ImageID": "sha256:abc", "Config": {"Env": ["REL2MQTT_APT_PKGS=curl,tzdata"]}}
+    container.get_archive.side_effect = lambda path: (
+        archive({"status": STATUS})
+        if path == mut.DPKG_STATUS_PATH
+        else archive({"lists/x_Packages": PACKAGES, "lists/lock": ""}),
+        {},
+    )
+    client = mocker.Mock(spec=DockerClient)
+    client.containers.list.return_value = [container]
+    uut = mut.AptProvider(AptConfig(host=False), client=client)
+
+    discoveries = [d async for d in uut.scan("s1")]
+    assert [(d.name, d.current_version, d.latest_version) for d in discoveries] == [
+        ("web_app_curl", "7.88.1-10+deb12u4", "7.88.1-10+deb12u5"),
+        ("web_app_tzdata", "2024a-0+deb12u1", "2024a-0+deb12u1"),
+    ]
+    assert discoveries[0].custom.container == "web+app"
+
+    [d async for d in uut.scan("s2")]
+    assert container.get_archive.call_count == 2
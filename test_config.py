@@ -0,0 +1,59 @@
+from config import PackageIndex, load_package_info, normalize_image_name
+
+
+def test_normalize_image_name():
+    assert normalize_image_name("ghcr.io/blakeblackshear/frigate:stable") == "blakeblackshear/frigate"
+    assert normalize_image_name("docker.io/library/caddy:2") == "caddy"
+    assert normalize_image_name("localhost:5000/caddy@sha256:abcd") == "caddy"
+    assert normalize_image_name("louislam/uptime-kuma") == "louislam/uptime-kuma"
+
+
+def test_index_lookup():
+    uut = PackageIndex(
+        {
+            "caddy": {"docker": {"image_name": "caddy"}, "logo_url": "caddy.png"},
+            "linuxserver": {
+                "docker": {"image_pattern": r"(lscr.io/)?linuxserver/.*"},
+                "logo_url": "lsio.png",
+            },
+        }
+    )
+
+    assert uut.lookup("caddy").logo_url == "caddy.png"
+    assert uut.lookup("docker.io/library/caddy").logo_url == "caddy.png"
+    assert uut.lookup("lscr.io/linuxserver/plex").logo_url == "lsio.png"
+    assert uut.lookup("nginx") is None
+    assert uut.lookup(None) is None
+
+
+def test_index_lookup_literal_patterns():
+    uut = PackageIndex(
+        {
+            "lsio_plex": {"docker": {"image_pattern": r"linuxserver/plex"}, "logo_url": "plex.png"},
+            "linuxserver": {"docker": {"image_pattern": r"linuxserver/.*"}, "logo_url": "lsio.png"},
+            "hotio": {"docker": {"image_pattern": r"hotio/(sonarr|radarr)"}, "logo_url": "hotio.png"},
+            "hotio_all": {"docker": {"image_pattern": r"hotio/.*"}, "logo_url": "hotio_all.png"},
+            "home_assistant": {"docker": {"image_pattern": r"homeassistant/.*"}, "logo_url": "ha.png"},
+            "dotted": {"docker": {"image_pattern": r"some\.org/app-.*"}, "logo_url": "dot.png"},
+        }
+    )
+
+    assert len(uut.patterns) == 1
+    assert set(uut.pattern_prefixes) == {"linuxserver/", "hotio/", "homeassistant/", "some.org/app-"}
+    assert uut.lookup("lscr.io/linuxserver/plex").logo_url == "plex.png"
+    assert uut.lookup("linuxserver/sonarr").logo_url == "lsio.png"
+    # listed first, so the regex wins over the indexed prefix
+    assert uut.lookup("ghcr.io/hotio/radarr").logo_url == "hotio.png"
+    assert uut.lookup("ghcr.io/hotio/bazarr").logo_url == "hotio_all.png"
+    assert uut.lookup("ghcr.io/home-assistant/home-assistant") is None
+    assert uut.lookup("homeassistant/home-assistant:stable").logo_url == "ha.png"
+    assert uut.lookup("some.org/app-server").logo_url == "dot.png"
+    assert uut.lookup("someXorg/app-server") is None
+
+
+def test_load_package_info():
+    uut = load_package_info("common_packages.yaml")
+
+    frigate = uut.lookup("ghcr.io/blakeblackshear/frigate")
+    assert frigate.release_notes_url == "https://github.com/blakeblackshear/frigate/releases"
+    assert len(load_package_info("no_such_file.yaml")) == 0
@@ -2,13 +2,31 @@ import integrations.docker as mut
 from docker import DockerClient
 from docker.models.containers import Container, ContainerCollection
 from docker.models.images import Image, RegistryData
+from concurrent.futures import ThreadPoolExecutor
+from config import ScheduleConfig
+from scheduler import ScanScheduler
+import asyncio
 import pytest
+import threading
+import time
 
 
 @pytest.mark.asyncio
 async def test_scanner(mocker):
-    client = mocker.Mock(spec=DockerClient)
-    coll = mocker.Mock(spec=ContainerCollection)
+    client = build_mock_client(
+        mocker,
+        [
+            build_mock_container(mocker, "testy/mctest:latest", opsys="macos"),
+            build_mock_container(mocker, "ubuntu"),
+            build_mock_container(
+                mocker,
+                "testy/mctest",
+                picture="https://piccy",
+                relnotes="https://release",
+                arch="amd64",
+            ),
+        ],
+    )
 
     def reg_data_select(v):
         reg_data = mocker.Mock(spec=RegistryData)
@@ -23,22 +41,8 @@ async def test_scanner(mocker):
                 reg_data.short_id = "sha256:999999999999"
         return reg_data
 
-    client.images.get_registry_data = mocker.Mock(side_effect=reg_data_select)
-
-    client.containers = coll
-    coll.list.return_value = [
-        build_mock_container(mocker, "testy/mctest:latest", opsys="macos"),
-        build_mock_container(mocker, "ubuntu"),
-        build_mock_container(
-            mocker,
-            "testy/mctest",
-            picture="https://piccy",
-            relnotes="https://release",
-            arch="amd64",
-        ),
-    ]
-    mocker.patch("docker.from_env", return_value=client)
-    uut = mut.DockerProvider(mut.DockerConfig(),mut.UpdateInfoConfig())
+    client.images.get_registry_data.side_effect = reg_data_select
+    uut = mut.DockerProvider(mut.DockerConfig(),mut.PackageIndex())
     session='unit_123'
     results = [d async for d in uut.scan(session)]
 
@@ -46,7 +50,7 @@ async def test_scanner(mocker):
     assert len(unchanged) == 1
     assert unchanged[0].entity_picture_url == "https://piccy"
     assert unchanged[0].release_url == "https://release"
-    assert unchanged[0].custom["platform"] == "linux/amd64"
+    assert unchanged[0].custom.platform == "linux/amd64"
     changed = [d for d in results if d.current_version != d.latest_version]
     assert len(changed) == 2
 
@@ -71,3 +75,377 @@ def build_mock_container(
     if relnotes:
         c.attrs["Config"]["Env"].append("REL2MQTT_RELNOTES=%s" % relnotes)
     return c
+
+
+def build_mock_client(mocker, containers=(), patch="docker.from_env"):
+    client = mocker.Mock(spec=DockerClient)
+    client.containers = mocker.Mock(spec=ContainerCollection)
+    client.containers.list.return_value = list(containers)
+    reg_data = mocker.Mock(spec=RegistryData)
+    reg_data.short_id = "sha256:999999999999"
+    client.images.get_registry_data = mocker.Mock(return_value=reg_data)
+    mocker.patch(patch, return_value=client)
+    return client
+
+
+def build_git_containers(mocker, repo_paths):
+    mocker.patch.object(mut, "git_trust")
+    mocker.patch.object(mut, "git_timestamp", return_value=None)
+    mocker.patch.object(mut, "git_cached_update_available", return_value=None)
+    containers = []
+    for name, repo_path in repo_paths.items():
+        c = build_mock_container(mocker, "testy/%s" % name)
+        c.name = name
+        c.labels = {}
+        c.attrs["Config"]["Env"].append("REL2MQTT_GIT_REPO_PATH=%s" % repo_path)
+        containers.append(c)
+    return containers
+
+
+@pytest.mark.asyncio
+async def test_scan_runs_analysis_in_worker_pool(mocker):
+    client = build_mock_client(
+        mocker, [build_mock_container(mocker, "testy/mctest%s" % i) for i in range(4)]
+    )
+    reg_data = client.images.get_registry_data.return_value
+
+    def slow_reg_data(v):
+        time.sleep(0.2)
+        return reg_data
+
+    client.images.get_registry_data.side_effect = slow_reg_data
+    cfg = mut.DockerConfig()
+    cfg.scan_workers = 4
+    uut = mut.DockerProvider(cfg, mut.PackageIndex())
+
+    started = time.time()
+    results = [d async for d in uut.scan("unit_456")]
+
+    assert len(results) == 4
+    assert time.time() - started < 0.6
+
+
+@pytest.mark.asyncio
+async def test_scan_shares_registry_lookups(mocker):
+    client = build_mock_client(
+        mocker, [build_mock_container(mocker, "testy/mctest:latest") for _ in range(10)]
+    )
+    uut = mut.DockerProvider(mut.DockerConfig(), mut.PackageIndex())
+
+    results = [d async for d in uut.scan("unit_1")]
+    results.extend([d async for d in uut.scan("unit_2")])
+
+    assert len(results) == 20
+    assert all(d.latest_version == "999999999999" for d in results)
+    client.images.get_registry_data.assert_called_once_with("testy/mctest:latest")
+    assert uut.registry_cache.stats()["cache_hits"] == 19
+
+
+@pytest.mark.asyncio
+async def test_watch_rescans_containers_from_events(mocker):
+    client = build_mock_client(mocker)
+    container = build_mock_container(mocker, "testy/mctest:latest")
+    container.name = "mctest"
+    client.containers.get.return_value = container
+    client.events.return_value = mocker.MagicMock()
+    client.events.return_value.__iter__.return_value = iter([
+        {"Type": "container", "Action": "create", "Actor": {"ID": "abc123", "Attributes": {"name": "mctest"}}},
+        {"Type": "container", "Action": "start", "Actor": {"ID": "abc123", "Attributes": {"name": "mctest"}}},
+    ])
+    cfg = mut.DockerConfig()
+    cfg.events_debounce = 0.1
+    uut = mut.DockerProvider(cfg, mut.PackageIndex())
+
+    watcher = uut.watch()
+    result = await asyncio.wait_for(anext(watcher), 5)
+    await watcher.aclose()
+
+    assert result.name == "mctest"
+    assert uut.discoveries["mctest"] == result
+    client.containers.get.assert_called_once_with("abc123")
+
+
+def test_event_targets_for_image_and_destroy(mocker):
+    build_mock_client(mocker)
+    uut = mut.DockerProvider(mut.DockerConfig(), mut.PackageIndex())
+    provider = mocker.Mock()
+    uut.discoveries = {
+        "web": mut.Discovery(provider, "web", custom=mut.DockerFields(image_ref="nginx:latest")),
+        "db": mut.Discovery(provider, "db", custom=mut.DockerFields(image_ref="postgres:15")),
+        "old": mut.Discovery(provider, "old", custom=mut.DockerFields(image_ref="busybox")),
+    }
+
+    targets = uut.event_targets(
+        [
+            {"Type": "image", "Action": "pull", "Actor": {"ID": "nginx:latest", "Attributes": {"name": "nginx"}}},
+            {"Type": "container", "Action": "destroy", "Actor": {"ID": "f00", "Attributes": {"name": "old"}}},
+        ]
+    )
+
+    assert targets == ["web"]
+    assert "old" not in uut.discoveries
+
+
+@pytest.mark.asyncio
+async def test_scan_reuses_inspection_until_image_changes(mocker):
+    container = build_mock_container(mocker, "testy/mctest:latest")
+    container.id = "abc123"
+    container.attrs["ImageID"] = "sha256:1111"
+    image = container.image
+    image_lookup = mocker.PropertyMock(return_value=image)
+    type(container).image = image_lookup
+    client = build_mock_client(mocker, [container])
+    uut = mut.DockerProvider(mut.DockerConfig(), mut.PackageIndex())
+
+    first = [d async for d in uut.scan("unit_1")]
+    first[0].update_last_attempt = 1690000000.0
+    second = [d async for d in uut.scan("unit_2")]
+    assert image_lookup.call_count == 1
+    assert second[0].update_last_attempt == 1690000000.0
+
+    container.attrs["ImageID"] = "sha256:2222"
+    [d async for d in uut.scan("unit_3")]
+    assert image_lookup.call_count == 2
+    client.containers.list.assert_called_with(sparse=True)
+
+
+@pytest.mark.asyncio
+async def test_scan_checks_git_remotes_once_after_analysis(mocker):
+    build_mock_client(mocker, build_git_containers(mocker, {"web": "/srv/app", "worker": "/srv/app"}))
+    mocker.patch.object(mut, "git_check_update_available", side_effect=AssertionError)
+
+    def check_remotes(repo_paths, budget, max_age):
+        mut.git_cached_update_available.return_value = True
+
+    check = mocker.patch.object(mut, "git_check_updates", side_effect=check_remotes)
+    uut = mut.DockerProvider(mut.DockerConfig(), mut.PackageIndex())
+
+    first = [d async for d in uut.scan("unit_1")]
+    second = [d async for d in uut.scan("unit_2")]
+
+    # analysis reads the last known result, then the check republishes what changed
+    assert [d.custom.git_update_available for d in first] == [None, None, True, True]
+    assert sorted(d.name for d in first[2:]) == ["web", "worker"]
+    assert [d.custom.git_update_available for d in second] == [True, True]
+    assert check.call_count == 2
+    assert list(check.call_args.args[0]) == ["/srv/app"]
+
+
+@pytest.mark.asyncio
+async def test_scan_reuses_latest_version_until_due(mocker):
+    client = build_mock_client(mocker, [build_mock_container(mocker, "testy/mctest")])
+    reg_data = client.images.get_registry_data.return_value
+    uut = mut.DockerProvider(mut.DockerConfig(), mut.PackageIndex())
+    uut.is_due = mocker.Mock(return_value=False)
+
+    first = [d async for d in uut.scan("unit_1")]
+    uut.registry_cache.invalidate("testy/mctest")
+    reg_data.short_id = "sha256:888888888888"
+    second = [d async for d in uut.scan("unit_2")]
+    uut.is_due.return_value = True
+    third = [d async for d in uut.scan("unit_3")]
+
+    assert [d.latest_version for d in first + second + third] == [
+        "999999999999",
+        "999999999999",
+        "888888888888",
+    ]
+    assert second[0].session == "unit_2"
+    assert client.images.get_registry_data.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_scan_checks_git_remotes_due_before_scheduler_records(mocker):
+    build_mock_client(mocker, build_git_containers(mocker, {"web": "/srv/web", "worker": "/srv/worker"}))
+    check = mocker.patch.object(mut, "git_check_updates")
+    scheduler = ScanScheduler(ScheduleConfig(), initial_interval=3600)
+    uut = mut.DockerProvider(mut.DockerConfig(), mut.PackageIndex())
+    uut.is_due = scheduler.is_due
+
+    # as the app does, recording each discovery as soon as the scan yields it
+    async for discovery in uut.scan("unit_1"):
+        scheduler.record(discovery)
+    assert sorted(check.call_args.args[0]) == ["/srv/web", "/srv/worker"]
+
+    async for discovery in uut.scan("unit_2"):
+        scheduler.record(discovery)
+    assert check.call_count == 1
+
+
+def test_remote_host_provider(mocker):
+    docker_client = mocker.patch("docker.DockerClient")
+    shared_cache = mut.RegistryDigestCache()
+
+    uut = mut.DockerProvider(
+        mut.DockerConfig(),
+        mut.PackageIndex(),
+        host=mut.DockerHostConfig(url="tcp://nas.local:2376", tls=True),
+        registry_cache=shared_cache,
+    )
+
+    assert uut.node_name == "nas_local"
+    assert mut.host_node_name("ssh://admin@192.168.1.20:2222") == "192_168_1_20"
+    assert mut.host_node_name("unix:///var/run/docker.sock") is None
+    assert uut.registry_cache is shared_cache
+    docker_client.assert_not_called()
+
+    assert uut.client is docker_client.return_value
+    assert uut.client is docker_client.return_value
+    docker_client.assert_called_once_with(
+        base_url="tcp://nas.local:2376", tls=True, use_ssh_client=False
+    )
+
+
+@pytest.mark.asyncio
+async def test_remote_host_containers_are_reported_only(mocker):
+    build_mock_client(mocker, [build_mock_container(mocker, "testy/mctest")], patch="docker.DockerClient")
+
+    results = {}
+    for url in ("unix:///run/user/1000/docker.sock", "tcp://nas.local:2376", "ssh://admin@media.local"):
+        uut = mut.DockerProvider(
+            mut.DockerConfig(), mut.PackageIndex(), host=mut.DockerHostConfig(url=url, node="n")
+        )
+        discovery = [d async for d in uut.scan("unit_1")][0]
+        results[url] = (bool(discovery.can_update), uut.supports_install_all)
+
+    assert results == {
+        "unix:///run/user/1000/docker.sock": (True, True),
+        "tcp://nas.local:2376": (False, False),
+        "ssh://admin@media.local": (False, False),
+    }
+
+
+@pytest.mark.asyncio
+async def test_http_registry_compares_platform_digest(mocker):
+    client = build_mock_client(
+        mocker,
+        [
+            build_mock_container(mocker, "testy/mctest:latest"),
+            build_mock_container(mocker, "testy/other:latest"),
+        ],
+    )
+    # RepoDigests of a multi-arch image name the manifest list it was pulled from
+    local_index = "sha256:9e2bbca079387d7965c3a9cee6d0c53f4f4e63ff7637877a83c4c05f2a666112"
+    registry_index = "sha256:" + "1" * 64
+    arm64_digest = "sha256:" + "2" * 64
+    cfg = mut.DockerConfig()
+    cfg.registry_client = "http"
+    uut = mut.DockerProvider(cfg, mut.PackageIndex())
+    uut.registry_client = mocker.Mock(spec=mut.RegistryClient)
+    uut.registry_client.head_digest.return_value = {
+        "digest": registry_index,
+        "media_type": "application/vnd.oci.image.index.v1+json",
+    }
+    platform_digests = {
+        # mctest's list changed for other platforms only, other's arm64 image was rebuilt
+        ("testy/mctest:latest", registry_index): arm64_digest,
+        ("testy/mctest:latest", local_index): arm64_digest,
+        ("testy/other:latest", registry_index): "sha256:" + "4" * 64,
+        ("testy/other:latest", local_index): arm64_digest,
+    }
+    uut.registry_client.platform_digest.side_effect = lambda ref, index, platform: (
+        platform_digests[(ref, index)]
+    )
+
+    results = {d.custom.image_ref: d async for d in uut.scan("unit_1")}
+
+    assert results["testy/mctest:latest"].latest_version == local_index[7:19]
+    assert results["testy/mctest:latest"].current_version == local_index[7:19]
+    assert results["testy/other:latest"].latest_version == "111111111111"
+    assert results["testy/other:latest"].current_version == local_index[7:19]
+    uut.registry_client.platform_digest.assert_any_call(
+        "testy/mctest:latest", local_index, "linux/arm64"
+    )
+    client.images.get_registry_data.assert_not_called()
+
+
+def test_pull_reports_progress_and_joins_same_image(mocker):
+    client = build_mock_client(mocker)
+    client.api = mocker.Mock()
+    started, release = threading.Event(), threading.Event()
+
+    def stream(*_args, **_kwargs):
+        yield {"status": "Pulling from testy/mctest", "id": "latest"}
+        yield {"status": "Pulling fs layer", "id": "aaa"}
+        yield {"status": "Already exists", "id": "bbb"}
+        started.set()
+        release.wait(5)
+        yield {"status": "Downloading", "id": "aaa", "progressDetail": {"current": 50, "total": 100}}
+        yield {"status": "Extracting", "id": "aaa", "progressDetail": {"current": 100, "total": 100}}
+        yield {"status": "Pull complete", "id": "aaa"}
+
+    client.api.pull.side_effect = stream
+    cfg = mut.DockerConfig()
+    cfg.pull_progress_interval = 0
+    uut = mut.DockerProvider(cfg, mut.PackageIndex())
+
+    first, second = [], []
+    with ThreadPoolExecutor(2) as pool:
+        pulling = pool.submit(uut.pull, "testy/mctest:latest", "linux/arm64", first.append)
+        assert started.wait(5)
+        joining = pool.submit(uut.pull, "testy/mctest:latest", "linux/arm64", second.append)
+        key = ("testy/mctest:latest", "linux/arm64")
+        while len(uut.pulls[key].listeners) < 2:
+            time.sleep(0.01)
+        release.set()
+        assert pulling.result(5) is client.images.get.return_value
+        assert joining.result(5) is client.images.get.return_value
+
+    client.api.pull.assert_called_once_with(
+        "testy/mctest", tag="latest", platform="linux/arm64", stream=True, decode=True
+    )
+    assert first == [0, 50, 62, 100]
+    assert second == [62, 100]
+    assert uut.pulls == {}
+
+
+def test_pull_progress_is_throttled():
+    reports = []
+    pull = mut.ImagePull(interval=60)
+    pull.listeners.append(reports.append)
+    for current in range(0, 101, 10):
+        pull.update({"status": "Downloading", "id": "aaa", "progressDetail": {"current": current, "total": 100}})
+    assert reports == [0]
+
+
+def test_install_all_updates_each_project_once(mocker):
+    build_mock_client(mocker)
+    run = mocker.patch.object(mut.subprocess, "run")
+    run.return_value.returncode = 0
+    uut = mut.DockerProvider(mut.DockerConfig(), mut.PackageIndex())
+    uut.pull = mocker.Mock()
+    uut.rescan = mocker.Mock(side_effect=lambda d: d)
+
+    def discovery(name, image_ref, compose_path=None, latest_version="v2"):
+        uut.discoveries[name] = mut.Discovery(
+            uut,
+            name,
+            "session",
+            current_version="v1",
+            latest_version=latest_version,
+            can_update=True,
+            custom=mut.DockerFields(image_ref=image_ref, compose_path=compose_path),
+        )
+
+    discovery("web", "testy/web:latest", "/compose/site")
+    discovery("worker", "testy/web:latest", "/compose/site")
+    discovery("db", "testy/db:latest", "/compose/site")
+    discovery("cache", "testy/cache:latest", "/compose/cache")
+    discovery("current", "testy/current:latest", "/compose/current", latest_version="v1")
+    discovery("solo", "testy/solo:latest")
+
+    started, ended = [], []
+    updated = uut.command(
+        None, "install_all", lambda d, progress=None: started.append(d.name), lambda d: ended.append(d.name)
+    )
+
+    assert sorted(started) == ["cache", "db", "solo", "web", "worker"]
+    assert sorted(d.name for d in updated) == ["cache", "db", "web", "worker"]
+    assert ended == ["solo"]
+    assert sorted(call.args[0] for call in uut.pull.call_args_list) == [
+        "testy/cache:latest",
+        "testy/db:latest",
+        "testy/solo:latest",
+        "testy/web:latest",
+    ]
+    assert sorted(call.kwargs["cwd"] for call in run.call_args_list) == ["/compose/cache", "/compose/site"]
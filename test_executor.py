@@ -0,0 +1,38 @@
+import asyncio
+import threading
+import pytest
+from executor import UpdateExecutor
+
+
+@pytest.mark.asyncio
+async def test_duplicate_jobs_collapse():
+    release = threading.Event()
+    calls = []
+    statuses = []
+
+    def job(name):
+        calls.append(name)
+        release.wait(5)
+        return name
+
+    uut = UpdateExecutor(workers=2, on_change=statuses.append)
+    first = asyncio.create_task(uut.submit(("docker", "frigate"), job, "frigate"))
+    await asyncio.sleep(0.1)
+    duplicate = await uut.submit(("docker", "frigate"), job, "frigate")
+    release.set()
+
+    assert await first == "frigate"
+    assert duplicate is None
+    assert calls == ["frigate"]
+    assert {"queued": 0, "running": 1, "jobs": ["frigate"]} in statuses
+    assert uut.status() == {"queued": 0, "running": 0, "jobs": []}
+
+
+@pytest.mark.asyncio
+async def test_jobs_run_off_event_loop():
+    uut = UpdateExecutor(workers=1)
+    loop_thread = threading.current_thread()
+
+    job_thread = await uut.submit(("docker", "qux"), threading.current_thread)
+
+    assert job_thread is not loop_thread
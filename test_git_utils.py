@@ -0,0 +1,74 @@
+import subprocess
+import pytest
+import integrations.git_utils as mut
+
+
+def run(cwd, *args):
+    subprocess.run(args, cwd=cwd, check=True, capture_output=True)
+
+
+@pytest.fixture
+def repos(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setenv("GIT_AUTHOR_NAME", "unit")
+    monkeypatch.setenv("GIT_AUTHOR_EMAIL", "unit@test")
+    monkeypatch.setenv("GIT_COMMITTER_NAME", "unit")
+    monkeypatch.setenv("GIT_COMMITTER_EMAIL", "unit@test")
+    upstream = tmp_path / "upstream.git"
+    run(tmp_path, "git", "init", "--bare", "-b", "main", str(upstream))
+    local = tmp_path / "local"
+    run(tmp_path, "git", "clone", str(upstream), str(local))
+    run(local, "git", "checkout", "-b", "main")
+    run(local, "git", "commit", "--allow-empty", "-m", "first")
+    run(local, "git", "push", "-u", "origin", "main")
+    other = tmp_path / "other"
+    run(tmp_path, "git", "clone", str(upstream), str(other))
+    mut.remote_checks.clear()
+    return str(local), str(other)
+
+
+def test_remote_change_detected(repos):
+    local, other = repos
+    assert mut.git_check_update_available(local) is False
+
+    run(other, "git", "commit", "--allow-empty", "-m", "second")
+    run(other, "git", "push")
+
+    assert mut.git_check_update_available(local, max_age=300) is False
+    assert mut.git_check_updates([local]) == {local: True}
+    assert mut.git_pull(local)
+    assert mut.git_check_update_available(local) is False
+
+
+def test_local_commits_not_reported_as_update(repos):
+    local, other = repos
+    run(local, "git", "commit", "--allow-empty", "-m", "local only")
+    assert mut.git_check_update_available(local) is False
+
+    run(other, "git", "commit", "--allow-empty", "-m", "upstream")
+    run(other, "git", "push")
+    # diverged, with an upstream commit not fetched yet
+    assert mut.git_check_update_available(local) is True
+
+
+def test_failed_check_cached_with_last_result(repos):
+    local, other = repos
+    assert mut.git_check_update_available(local) is False
+    run(local, "git", "remote", "set-url", "origin", "/nonexistent")
+
+    assert mut.git_check_update_available(local) is False
+    assert mut.git_check_updates([local], max_age=300) == {local: False}
+    assert mut.git_cached_update_available(local) is False
+    assert mut.git_cached_update_available(other) is None
+
+
+def test_trust_once(repos, tmp_path):
+    local, _ = repos
+    mut.trusted_repos.discard(local)
+    mut.git_trust(local)
+    mut.trusted_repos.discard(local)
+    mut.git_trust(local)
+
+    gitconfig = (tmp_path / ".gitconfig").read_text()
+    assert gitconfig.count(local) == 1
+    assert mut.git_timestamp(local) is not None
@@ -0,0 +1,32 @@
+import urllib.request
+from metrics import Metrics, MetricsServer
+
+
+def test_render_counters_and_histograms():
+    uut = Metrics()
+    uut.inc("mqtt_publish_total", result="sent")
+    uut.inc("mqtt_publish_total", result="sent")
+    uut.observe("analyze_seconds", 0.2, phase="registry", registry="docker.io")
+
+    text = uut.render()
+
+    assert 'release2mqtt_mqtt_publish_total{result="sent"} 2' in text
+    assert (
+        'release2mqtt_analyze_seconds_bucket{phase="registry",registry="docker.io",le="0.25"} 1'
+        in text
+    )
+    assert 'release2mqtt_analyze_seconds_bucket{phase="registry",registry="docker.io",le="0.1"} 0' in text
+    assert uut.summary()["analyze_seconds_registry_docker.io_last"] == 0.2
+
+
+def test_metrics_endpoint():
+    registry = Metrics()
+    registry.inc("scan_total")
+    uut = MetricsServer("127.0.0.1", 0, registry)
+    uut.start()
+    try:
+        port = uut.server.server_address[1]
+        body = urllib.request.urlopen("http://127.0.0.1:%s/metrics" % port).read()
+        assert b"release2mqtt_scan_total 1" in body
+    finally:
+        uut.stop()
@@ -3,28 +3,45 @@ import pytest
 from model import ReleaseProvider, Discovery
 from mqtt import MqttClient
 from config import MqttConfig, HomeAssistantConfig, NodeConfig
+from hass_formatter import hass_format_config, hass_format_state
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCode
+import json
 import time
 import asyncio
 
 
+def accepting_client(mocker):
+    """paho client stand-in that accepts every publish"""
+    client = mocker.Mock()
+    client.publish.return_value.rc = mqtt.MQTT_ERR_SUCCESS
+    return client
+
+
 @pytest.mark.capmqtt_decode_utf8
-def test_publish(mocker, mosquitto, capmqtt):
+@pytest.mark.asyncio
+async def test_publish(mocker, mosquitto, capmqtt):
     config = MqttConfig()
     hass_config = HomeAssistantConfig()
     node_config = NodeConfig()
     config.host, config.port = mosquitto
     uut = MqttClient(config, node_config, hass_config)
     uut.start()
+    # paho drops publishes made before the connection is up
+    assert await uut.wait_connected(10)
 
     uut.publish("test.topic.123", {"foo": "abc", "bar": False})
-    assert (
-        MqttMessage(
-            topic="test.topic.123",
-            payload='{"foo": "abc", "bar": false}',
-            userdata=None,
-        )
-        in capmqtt.messages
+    expected = MqttMessage(
+        topic="test.topic.123",
+        payload='{"foo":"abc","bar":false}',
+        userdata=None,
     )
+    cutoff = time.time() + 10
+    while time.time() <= cutoff and expected not in capmqtt.messages:
+        await asyncio.sleep(0.1)
+    assert expected in capmqtt.messages
 
 
 @pytest.mark.capmqtt_decode_utf8
@@ -37,6 +54,7 @@ async def test_handler(mocker, mosquitto, event_loop):
     config.host, config.port = mosquitto
     uut = MqttClient(config, node_config, hass_config)
     uut.start(event_loop=event_loop)
+    assert await uut.wait_connected(10)
 
     provider = mocker.Mock(spec=ReleaseProvider)
     provider.source_type = "unit_test"
@@ -56,3 +74,294 @@ async def test_handler(mocker, mosquitto, event_loop):
         await asyncio.sleep(0.5)
         
     provider.command.assert_called_with("qux", "install", mocker.ANY, mocker.ANY)
+
+
+@pytest.mark.asyncio
+async def test_clean_topics_removes_stale_retained(mocker):
+    node_config = NodeConfig()
+    node_config.name = "testing"
+    uut = MqttClient(MqttConfig(), node_config, HomeAssistantConfig())
+    uut.client = accepting_client(mocker)
+    uut.event_loop = asyncio.get_running_loop()
+    provider = mocker.Mock(spec=ReleaseProvider)
+    provider.source_type = "unit_test"
+    uut.publish("rel2mqtt/testing/unit_test/fresh", {"state": "on"}, session="sess_2")
+    uut.client.publish.reset_mock()
+
+    def retained(topic):
+        msg = MqttMessage(topic=topic, payload='{"state": "on"}', userdata=None)
+        msg.retain = True
+        return msg
+
+    def replay(topic):
+        if topic.startswith("rel2mqtt/"):
+            uut.on_sweep_message(None, None, retained("rel2mqtt/testing/unit_test/fresh"))
+            uut.on_sweep_message(None, None, retained("rel2mqtt/testing/unit_test/stale"))
+        elif topic.endswith("/update/config"):
+            for legacy in ("testing_unit_test_old", "other_unit_test_qux"):
+                uut.on_sweep_message(
+                    None, None, retained("homeassistant/update/%s/update/config" % legacy)
+                )
+
+    uut.client.subscribe.side_effect = replay
+
+    started = time.time()
+    await uut.clean_topics(provider, "sess_2", quiet_period=0.2)
+
+    assert time.time() - started < 1
+    assert sorted(c.args for c in uut.client.publish.call_args_list) == [
+        ("homeassistant/update/testing_unit_test_old/update/config", ""),
+        ("rel2mqtt/testing/unit_test/stale", ""),
+    ]
+    assert uut.client.unsubscribe.call_count == 3
+    assert uut.sweeps == []
+
+    uut.client.reset_mock()
+    await uut.clean_topics(provider, "sess_2", quiet_period=0.2)
+    assert sorted(c.args[0] for c in uut.client.subscribe.call_args_list) == [
+        "homeassistant/update/testing_unit_test/+/config",
+        "rel2mqtt/testing/unit_test/+",
+    ]
+
+
+def test_publish_suppresses_unchanged_payload(mocker):
+    uut = MqttClient(MqttConfig(), NodeConfig(), HomeAssistantConfig())
+    uut.client = accepting_client(mocker)
+    uut.event_loop = mocker.Mock()
+
+    uut.publish("test.topic.123", {"foo": "abc"}, session="sess_1")
+    uut.publish("test.topic.123", {"foo": "abc"}, session="sess_2")
+    uut.publish("test.topic.123", {"foo": "xyz"}, session="sess_2")
+
+    assert uut.client.publish.call_count == 2
+    assert uut.topic_sessions["test.topic.123"] == "sess_2"
+    assert uut.publish_stats() == {"publish_sent": 2, "publish_suppressed": 1}
+
+    uut.on_connect(None, None, None, 0)
+    uut.publish("test.topic.123", {"foo": "xyz"})
+    assert uut.client.publish.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_drain_waits_for_pending_publishes(mocker):
+    config = MqttConfig()
+    config.max_pending = 2
+    uut = MqttClient(config, NodeConfig(), HomeAssistantConfig())
+    uut.client = accepting_client(mocker)
+    uut.event_loop = asyncio.get_running_loop()
+    for i in range(4):
+        uut.publish("test.topic.%s" % i, {"foo": i})
+
+    drain = asyncio.create_task(uut.drain())
+    await asyncio.sleep(0.1)
+    assert not drain.done()
+
+    for _ in range(3):
+        uut.on_publish(None, None, None)
+    await asyncio.wait_for(drain, 1)
+    assert uut.pending == 1
+
+
+
+@pytest.mark.asyncio
+async def test_drain_sees_acks_racing_its_clear(mocker):
+    config = MqttConfig()
+    config.max_pending = 2
+    uut = MqttClient(config, NodeConfig(), HomeAssistantConfig())
+    uut.client = accepting_client(mocker)
+    uut.event_loop = asyncio.get_running_loop()
+    for i in range(4):
+        uut.publish("test.topic.%s" % i, {"foo": i})
+    clear = uut.drained.clear
+
+    def acked_before_clear():
+        # the network thread acks everything while the event still looks set
+        for _ in range(4):
+            uut.on_publish(None, None, None)
+        clear()
+
+    uut.drained.clear = acked_before_clear
+
+    await asyncio.wait_for(uut.drain(), 1)
+    assert uut.pending == 0
+
+def test_pending_counts_only_accepted_publishes(mocker):
+    uut = MqttClient(MqttConfig(), NodeConfig(), HomeAssistantConfig())
+    uut.client = accepting_client(mocker)
+    uut.event_loop = mocker.Mock()
+    uut.client.publish.return_value.rc = mqtt.MQTT_ERR_NO_CONN
+
+    uut.publish("test.topic.1", {"foo": 1})
+    uut.delete("test.topic.2")
+    assert uut.pending == 0
+
+    uut.client.publish.return_value.rc = mqtt.MQTT_ERR_SUCCESS
+    uut.publish("test.topic.1", {"foo": 2})
+    uut.delete("test.topic.2")
+    assert uut.pending == 2
+
+
+def test_topics_use_provider_node(mocker):
+    node_config = NodeConfig()
+    node_config.name = "local"
+    uut = MqttClient(MqttConfig(), node_config, HomeAssistantConfig())
+    local_provider = ReleaseProvider()
+    remote_provider = ReleaseProvider()
+    remote_provider.node_name = "remote"
+
+    assert uut.state_topic(Discovery(local_provider, "qux")) == "rel2mqtt/local/base/qux"
+    assert uut.state_topic(Discovery(remote_provider, "qux")) == "rel2mqtt/remote/base/qux"
+    assert uut.command_topic(remote_provider) == "rel2mqtt/remote/base"
+    assert (
+        uut.config_topic(Discovery(remote_provider, "qux"))
+        == "homeassistant/update/remote_base/qux/config"
+    )
+
+
+def test_hass_payloads_reuse_static_parts(mocker):
+    node_config = NodeConfig()
+    node_config.name = "local"
+    uut = MqttClient(MqttConfig(), node_config, HomeAssistantConfig())
+    uut.client = accepting_client(mocker)
+    format_config = mocker.patch("mqtt.hass_format_config", wraps=hass_format_config)
+    provider = ReleaseProvider()
+    discovery = Discovery(provider, "qux", session="s1", current_version="1", latest_version="2")
+
+    uut.publish_hass_config(discovery)
+    uut.publish_hass_state(discovery)
+    rescanned = Discovery(provider, "qux", session="s2", current_version="1", latest_version="3")
+    uut.publish_hass_config(rescanned)
+    uut.publish_hass_state(rescanned, in_progress=True)
+
+    assert format_config.call_count == 1
+    topics = [c.args[0] for c in uut.client.publish.call_args_list]
+    assert topics == [
+        "homeassistant/update/local_base/qux/config",
+        "rel2mqtt/local/base/qux",
+        "rel2mqtt/local/base/qux",
+    ]
+    state = json.loads(uut.client.publish.call_args.kwargs["payload"])
+    assert state == hass_format_state(rescanned, "local", in_progress=True)
+    assert uut.topic_sessions[topics[0]] == "s2"
+
+
+@pytest.mark.asyncio
+async def test_install_all_button_runs_batch_command(mocker):
+    node_config = NodeConfig()
+    node_config.name = "local"
+    uut = MqttClient(MqttConfig(), node_config, HomeAssistantConfig())
+    uut.client = accepting_client(mocker)
+    uut.event_loop = asyncio.get_running_loop()
+    provider = ReleaseProvider()
+    updated = Discovery(provider, "qux", session="s1", current_version="2", latest_version="2")
+    provider.command = mocker.Mock(return_value=[updated])
+    uut.subscribe_hass_command(provider)
+
+    uut.publish_hass_install_all(provider)
+    assert (
+        uut.client.publish.call_args.args[0]
+        == "homeassistant/button/release2mqtt_local_base_install_all/config"
+    )
+    button = json.loads(uut.client.publish.call_args.kwargs["payload"])
+    assert button["command_topic"] == "rel2mqtt/local/base"
+
+    msg = mocker.Mock(topic=button["command_topic"], payload=button["payload_press"])
+    await uut.execute_command(msg, mocker.Mock(), mocker.Mock())
+
+    assert provider.command.call_args.args[:2] == (None, "install_all")
+    assert uut.client.publish.call_args.args[0] == "rel2mqtt/local/base/qux"
+
+
+@pytest.mark.asyncio
+async def test_wait_connected_follows_broker_connection(mocker):
+    uut = MqttClient(MqttConfig(), NodeConfig(), HomeAssistantConfig())
+    uut.client = accepting_client(mocker)
+    uut.event_loop = asyncio.get_running_loop()
+
+    assert not await uut.wait_connected(0.01)
+    uut.on_connect(None, None, None, 5)
+    assert not await uut.wait_connected(0.01)
+    uut.on_connect(None, None, None, 0)
+    assert await uut.wait_connected(1)
+    uut.on_disconnect(None, None, 7)
+    await asyncio.sleep(0)
+    assert not await uut.wait_connected(0.01)
+
+
+def test_v5_aliases_topics_and_refreshes_before_expiry(mocker):
+    config = MqttConfig()
+    config.protocol = "5"
+    config.message_expiry = 100
+    uut = MqttClient(config, NodeConfig(), HomeAssistantConfig())
+    uut.client = accepting_client(mocker)
+    uut.event_loop = mocker.Mock()
+    connack = Properties(PacketTypes.CONNACK)
+    connack.TopicAliasMaximum = 1
+    uut.on_connect(None, None, {}, ReasonCode(PacketTypes.CONNACK, identifier=0), connack)
+    now = mocker.patch("mqtt.time.monotonic", return_value=1000)
+
+    uut.publish("homeassistant/update/long/update/config", {"foo": "abc"}, session="sess_1")
+    uut.publish("homeassistant/update/long/update/config", {"foo": "abc"}, session="sess_1")
+    now.return_value = 1060
+    uut.publish("homeassistant/update/long/update/config", {"foo": "abc"}, session="sess_2")
+    uut.publish("rel2mqtt/executor", {"foo": "abc"})
+
+    sent = [(c.args[0], c.kwargs["properties"]) for c in uut.client.publish.call_args_list]
+    assert [topic for topic, _ in sent] == [
+        "homeassistant/update/long/update/config",
+        "",
+        "rel2mqtt/executor",
+    ]
+    assert [getattr(p, "TopicAlias", None) for _, p in sent] == [1, 1, None]
+    assert [getattr(p, "MessageExpiryInterval", None) for _, p in sent] == [100, 100, None]
+
+    uut.on_disconnect(None, None, 0)
+    uut.on_connect(None, None, {}, ReasonCode(PacketTypes.CONNACK, identifier=0), connack)
+    uut.publish("homeassistant/update/long/update/config", {"foo": "xyz"}, session="sess_2")
+    assert uut.client.publish.call_args.args[0] == "homeassistant/update/long/update/config"
+
+
+@pytest.mark.asyncio
+async def test_v5_rejected_falls_back_to_v311(mocker):
+    config = MqttConfig()
+    config.protocol = "5"
+    uut = MqttClient(config, NodeConfig(), HomeAssistantConfig())
+    uut.event_loop = asyncio.get_running_loop()
+    uut.socket_loop = mocker.Mock()
+    mocker.patch.object(uut, "stop")
+    start = mocker.patch.object(uut, "start")
+
+    uut.on_connect(
+        None, None, {}, ReasonCode(PacketTypes.CONNACK, aName="Unsupported protocol version")
+    )
+    await asyncio.sleep(0.1)
+
+    assert uut.protocol == mqtt.MQTTv311
+    assert uut.message_expiry() is None
+    start.assert_called_once_with(uut.event_loop)
+    assert not uut.connected.is_set()
+
+
+@pytest.mark.asyncio
+async def test_v5_clean_topics_skips_broker_sweep(mocker):
+    config = MqttConfig()
+    config.protocol = "5"
+    node_config = NodeConfig()
+    node_config.name = "testing"
+    uut = MqttClient(config, node_config, HomeAssistantConfig())
+    uut.client = accepting_client(mocker)
+    uut.event_loop = asyncio.get_running_loop()
+    provider = mocker.Mock(spec=ReleaseProvider)
+    provider.source_type = "unit_test"
+    uut.publish("rel2mqtt/testing/unit_test/fresh", {"state": "on"}, session="sess_2")
+    uut.publish("rel2mqtt/testing/unit_test/stale", {"state": "on"}, session="sess_1")
+    uut.client.publish.reset_mock()
+    # past the first clean, which sweeps topics in the previous layout
+    uut.legacy_swept.add(provider)
+
+    await uut.clean_topics(provider, "sess_2")
+
+    uut.client.subscribe.assert_not_called()
+    uut.client.publish.assert_called_once_with(
+        "rel2mqtt/testing/unit_test/stale", "", retain=True
+    )
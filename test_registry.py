@@ -0,0 +1,100 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import pytest
+from integrations.registry import RegistryClient, parse_image_ref, select_platform
+
+INDEX_DIGEST = "sha256:" + "1" * 64
+AMD64_DIGEST = "sha256:" + "2" * 64
+ARM64_DIGEST = "sha256:" + "3" * 64
+INDEX = {
+    "schemaVersion": 2,
+    "mediaType": "application/vnd.oci.image.index.v1+json",
+    "manifests": [
+        {"digest": AMD64_DIGEST, "platform": {"os": "linux", "architecture": "amd64"}},
+        {"digest": ARM64_DIGEST, "platform": {"os": "linux", "architecture": "arm64", "variant": "v8"}},
+    ],
+}
+
+
+@pytest.fixture
+def registry():
+    requests_seen = []
+
+    class StandIn(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def respond(self, with_body):
+            requests_seen.append((self.command, self.path))
+            if self.path.startswith("/token"):
+                body = json.dumps({"token": "tok123"}).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if self.headers.get("Authorization") != "Bearer tok123":
+                self.send_response(401)
+                self.send_header(
+                    "WWW-Authenticate",
+                    'Bearer realm="http://%s:%s/token",service="stand-in"' % self.server.server_address,
+                )
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = json.dumps(INDEX).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", INDEX["mediaType"])
+            self.send_header("Docker-Content-Digest", INDEX_DIGEST)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if with_body:
+                self.wfile.write(body)
+
+        def do_HEAD(self):
+            self.respond(False)
+
+        def do_GET(self):
+            self.respond(True)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "127.0.0.1:%s" % server.server_address[1], requests_seen
+    server.shutdown()
+
+
+def test_parse_image_ref():
+    assert parse_image_ref("ubuntu") == ("registry-1.docker.io", "library/ubuntu", "latest")
+    assert parse_image_ref("louislam/uptime-kuma:1") == ("registry-1.docker.io", "louislam/uptime-kuma", "1")
+    assert parse_image_ref("ghcr.io/blakeblackshear/frigate:stable") == (
+        "ghcr.io",
+        "blakeblackshear/frigate",
+        "stable",
+    )
+    assert parse_image_ref("localhost:5000/app@sha256:abc") == ("localhost:5000", "app", "sha256:abc")
+
+
+def test_select_platform():
+    assert select_platform(INDEX["manifests"], "linux/amd64") == AMD64_DIGEST
+    assert select_platform(INDEX["manifests"], "linux/arm64/v8") == ARM64_DIGEST
+    assert select_platform(INDEX["manifests"], "windows/amd64") is None
+
+
+def test_head_then_platform_digest(registry):
+    host, requests_seen = registry
+    uut = RegistryClient(insecure_registries=[host])
+
+    head = uut.head_digest("%s/testy/mctest:latest" % host)
+    assert head == {"digest": INDEX_DIGEST, "media_type": "application/vnd.oci.image.index.v1+json"}
+    assert uut.head_digest("%s/testy/mctest:latest" % host)["digest"] == INDEX_DIGEST
+
+    image_ref = "%s/testy/mctest:latest" % host
+    assert uut.platform_digest(image_ref, INDEX_DIGEST, "linux/arm64/v8") == ARM64_DIGEST
+    assert uut.platform_digest(image_ref, INDEX_DIGEST, "linux/arm64/v8") == ARM64_DIGEST
+
+    assert [r[0] for r in requests_seen] == ["HEAD", "GET", "HEAD", "HEAD", "GET"]
+    assert requests_seen[-1][1] == "/v2/testy/mctest/manifests/%s" % INDEX_DIGEST
+    uut.close()
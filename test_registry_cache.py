@@ -0,0 +1,53 @@
+from integrations.registry_cache import RegistryDigestCache
+
+
+def test_lru_eviction():
+    uut = RegistryDigestCache(max_size=2)
+    uut.get("a", "linux/amd64", lambda ref: "sha256:a")
+    uut.get("b", "linux/amd64", lambda ref: "sha256:b")
+    uut.get("a", "linux/amd64", lambda ref: "sha256:changed")
+    uut.get("c", "linux/amd64", lambda ref: "sha256:c")
+
+    assert list(uut.entries) == [("a", "linux/amd64"), ("c", "linux/amd64")]
+    assert uut.stats()["cache_evictions"] == 1
+    assert uut.stats()["cache_hits"] == 1
+
+
+def test_expired_entry_revalidated_or_served_stale():
+    uut = RegistryDigestCache(ttl=0)
+    assert uut.get("a", None, lambda ref: "sha256:a") == "sha256:a"
+    assert uut.get("a", None, lambda ref: "sha256:a") == "sha256:a"
+    assert uut.get("a", None, lambda ref: None) == "sha256:a"
+    assert uut.get("a", None, lambda ref: "sha256:b") == "sha256:b"
+
+    stats = uut.stats()
+    assert stats["cache_revalidated"] == 1
+    assert stats["cache_stale"] == 1
+    assert stats["cache_changed"] == 1
+
+
+def test_persistence(tmp_path):
+    path = str(tmp_path / "registry.json")
+    uut = RegistryDigestCache(path=path)
+    uut.get("a", "linux/arm64", lambda ref: "sha256:a")
+    uut.save()
+
+    reloaded = RegistryDigestCache(path=path)
+    assert reloaded.get("a", "linux/arm64", lambda ref: None) == "sha256:a"
+    assert reloaded.stats()["cache_hits"] == 1
+
+
+def test_key_locks_released_after_failed_fetch():
+    uut = RegistryDigestCache()
+
+    def fail(ref):
+        raise ConnectionError("registry down")
+
+    for ref in ("a", "b"):
+        try:
+            uut.get(ref, None, fail)
+        except ConnectionError:
+            pass
+    uut.get("c", None, lambda ref: None)
+
+    assert uut.key_locks == {}
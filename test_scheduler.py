@@ -0,0 +1,58 @@
+from config import ScheduleConfig
+from model import Discovery, ReleaseProvider
+from scheduler import ScanScheduler
+
+
+def test_interval_adapts_to_changes():
+    cfg = ScheduleConfig(min_interval=100, max_interval=10000, backoff=2, jitter=0)
+    uut = ScanScheduler(cfg, initial_interval=1000)
+    provider = ReleaseProvider()
+
+    def check(name, version):
+        entry = uut.entries.get((None, "base", name))
+        now = 0 if entry is None else entry.next_check
+        return uut.record(Discovery(provider, name, latest_version=version), now=now)
+
+    assert check("nightly", "a").interval == 1000
+    assert check("nightly", "b").interval == 500
+    assert check("nightly", "c").interval == 250
+    assert check("nightly", "d").interval == 125
+    assert check("nightly", "e").interval == 100
+
+    assert check("pinned", "a").interval == 1000
+    entry = check("pinned", "a")
+    assert entry.interval == 2000
+    assert entry.next_check == 3000
+
+    nightly = uut.entries[(None, "base", "nightly")]
+    assert uut.due(now=nightly.next_check) == [nightly.discovery]
+
+
+def test_analysis_before_due_is_not_a_check():
+    cfg = ScheduleConfig(min_interval=100, max_interval=10000, backoff=2, jitter=0)
+    uut = ScanScheduler(cfg, initial_interval=1000)
+    provider = ReleaseProvider()
+    uut.record(Discovery(provider, "app", latest_version="a"), now=0)
+
+    entry = uut.record(Discovery(provider, "app", latest_version="b"), now=500)
+
+    assert (entry.checks, entry.changes, entry.interval, entry.next_check) == (0, 0, 1000, 1000)
+    assert entry.discovery.latest_version == "b"
+    assert not uut.is_due(entry.discovery, now=500)
+    assert uut.is_due(entry.discovery, now=1000)
+    assert uut.is_due(Discovery(provider, "unknown"), now=0)
+
+
+def test_override_and_jitter():
+    cfg = ScheduleConfig(min_interval=100, max_interval=10000, jitter=0.2)
+    uut = ScanScheduler(cfg, initial_interval=1000)
+    provider = ReleaseProvider()
+
+    for i in range(20):
+        entry = uut.record(Discovery(provider, "jittery%d" % i, latest_version="a"), now=0)
+        assert entry.interval * 0.8 <= entry.next_check <= entry.interval * 1.2
+
+    entry = uut.record(
+        Discovery(provider, "custom", latest_version="a", scan_interval=60), now=0
+    )
+    assert 48 <= entry.next_check <= 72
@@ -0,0 +1,51 @@
+import datetime
+import pytest
+import serializer
+
+
+class Thing:
+    def __str__(self):
+        return "thing"
+
+
+def test_compact_round_trip():
+    encoded = serializer.dumps({"foo": "abc", "bar": False, "baz": None})
+    assert encoded == '{"foo":"abc","bar":false,"baz":null}'
+    assert serializer.loads(encoded.encode()) == {"foo": "abc", "bar": False, "baz": None}
+
+
+def test_stdlib_fallback_matches(monkeypatch):
+    expected = serializer.dumps({"foo": [1, 2.5, "x"], "thing": Thing()}, default=str)
+    monkeypatch.setattr(serializer, "orjson", None)
+    assert serializer.dumps({"foo": [1, 2.5, "x"], "thing": Thing()}, default=str) == expected
+    assert expected == '{"foo":[1,2.5,"x"],"thing":"thing"}'
+    assert serializer.loads(b'{"a":1}') == {"a": 1}
+
+
+def test_stdlib_keeps_unicode(monkeypatch):
+    monkeypatch.setattr(serializer, "orjson", None)
+    assert serializer.dumps({"name": "café ☕"}) == '{"name":"café ☕"}'
+
+
+def test_orjson_matches_stdlib(monkeypatch):
+    orjson = pytest.importorskip("orjson")
+    monkeypatch.setattr(serializer, "orjson", orjson)
+    payloads = [
+        {"name": "café ☕", "foo": [1, 2.5, "x"], "thing": Thing()},
+        {1: "int key", None: "none key", 2.5: "float key"},
+        {"huge": 2**64, "negative": -(2**63) - 1},
+        {"at": datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)},
+    ]
+    for payload in payloads:
+        encoded = serializer.dumps(payload, default=str)
+        monkeypatch.setattr(serializer, "orjson", None)
+        assert serializer.dumps(payload, default=str) == encoded
+        monkeypatch.setattr(serializer, "orjson", orjson)
+    assert serializer.loads(b'{"a":1}') == {"a": 1}
+
+
+def test_orjson_still_raises_for_unencodable(monkeypatch):
+    orjson = pytest.importorskip("orjson")
+    monkeypatch.setattr(serializer, "orjson", orjson)
+    with pytest.raises(TypeError):
+        serializer.dumps({"thing": Thing()})
@@ -0,0 +1,71 @@
+import datetime
+from integrations.docker import DockerFields
+from model import Discovery, ReleaseProvider
+from state_store import StateStore
+
+
+class DockerRecords(ReleaseProvider):
+    source_type = "docker"
+    custom_type = DockerFields
+
+
+def test_discoveries_survive_restart(tmp_path):
+    path = str(tmp_path / "state.db")
+    provider = DockerRecords()
+    uut = StateStore(path)
+    uut.save(
+        Discovery(
+            provider,
+            "frigate",
+            session="sess_1",
+            current_version="abc",
+            latest_version="def",
+            update_last_attempt=1690000000.0,
+            custom=DockerFields(
+                image_ref="ghcr.io/blakeblackshear/frigate:stable",
+                git_local_timestamp=datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+            ),
+        )
+    )
+    uut.close()
+
+    restored = provider.restore(StateStore(path).load("docker"))
+
+    assert len(restored) == 1
+    assert restored[0].name == "frigate"
+    assert restored[0].latest_version == "def"
+    assert restored[0].update_last_attempt == 1690000000.0
+    assert restored[0].custom.image_ref == "ghcr.io/blakeblackshear/frigate:stable"
+    assert restored[0].custom.git_local_timestamp == datetime.datetime(
+        2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc
+    )
+
+
+def test_prune_drops_discoveries_from_old_sessions(tmp_path):
+    provider = ReleaseProvider()
+    uut = StateStore(str(tmp_path / "state.db"))
+    uut.save(Discovery(provider, "kept", session="sess_2"))
+    uut.save(Discovery(provider, "gone", session="sess_1"))
+
+    uut.prune("base", "sess_2")
+
+    assert [r["name"] for r in uut.load("base")] == ["kept"]
+
+
+def test_unchanged_discovery_skips_serializing(tmp_path, mocker):
+    provider = DockerRecords()
+    uut = StateStore(str(tmp_path / "state.db"))
+    first = Discovery(provider, "web", session="s1", custom=DockerFields(image_ref="nginx"))
+    rescanned = Discovery(provider, "web", session="s1", custom=DockerFields(image_ref="nginx"))
+    assert rescanned == first
+    assert rescanned.fingerprint() == first.fingerprint()
+
+    uut.save(first)
+    as_record = mocker.spy(Discovery, "as_record")
+    uut.save(rescanned)
+    as_record.assert_not_called()
+
+    rescanned.latest_version = "abc"
+    assert rescanned.changes(first) == ["latest_version"]
+    uut.save(rescanned)
+    as_record.assert_called_once()